@@ -0,0 +1,148 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# api.bench.py: This file benchmarks the list endpoints of the API against the
+# size of the response
+#
+
+# System imports
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from typing import Callable, List
+
+CATEGORIES = ['Groceries', 'General Spending', 'Dining/Take out', 'Transport']
+
+
+def populate(rows: int) -> None:
+    '''
+    Fill the database with transactions, each with one categorised allocation
+
+    Args:
+        rows: The number of transactions
+    '''
+    from database import Database
+
+    rand = random.Random(rows)
+    with Database() as db:
+        with db.transaction():
+            db.db.executemany('INSERT INTO txn (date, amount, description, source, balance, pending) VALUES (?, ?, ?, ?, ?, ?)',
+                              [(f'2023-{rand.randint(1, 12):02}-{rand.randint(1, 28):02}', -rand.randint(100, 100000),
+                                f'MERCHANT {rand.randint(0, 999)} SOMETOWN', 'Bank of Foo', 0, 0) for _ in range(rows)])
+            for name in CATEGORIES:
+                db.db.execute('INSERT OR IGNORE INTO category (name) VALUES (?)', (name, ))
+            db.db.execute('SELECT id FROM category')
+            category_ids = [row[0] for row in db.db.fetchall()]
+            db.db.execute('SELECT id, amount FROM txn')
+            db.db.executemany('INSERT INTO allocation (txn_id, amount, category_id, location_id) VALUES (?, ?, ?, 1)',
+                              [(txn_id, amount, rand.choice(category_ids)) for txn_id, amount in db.db.fetchall()])
+
+
+def add_baseline(app) -> None:
+    '''
+    Add the endpoints as they were before the list endpoints skipped the
+    models, so they can be compared
+
+    Args:
+        app: The API
+    '''
+    from database import Database
+    from model import TransactionList, AllocationList
+
+    @app.get('/baseline/transaction/', response_model=TransactionList)
+    def get_transactions(start: str, end: str) -> TransactionList:
+        with Database() as db:
+            return db.get_transaction_list('date BETWEEN ? AND ? ORDER BY date desc, id desc', (start, end))
+
+    @app.get('/baseline/allocation/', response_model=AllocationList)
+    def get_allocations(start: str, end: str) -> AllocationList:
+        with Database() as db:
+            return db.get_allocation_list('txn.date BETWEEN ? AND ? ORDER BY category.name asc', (start, end))
+
+    @app.get('/baseline/dashboard/')
+    def get_dashboard(start: str, end: str) -> List[int]:
+        with Database() as db:
+            return [-sum([alloc.amount for alloc in db.get_allocation_list('txn.date BETWEEN ? AND ? AND category.name = ?', (start, end, name)).allocations])
+                    for name in CATEGORIES]
+
+
+def measure(get: Callable, url: str, count: int) -> float:
+    '''
+    Time a request
+
+    Args:
+        get: Makes a request
+        url: The URL to request
+        count: How many times to make the request
+
+    Returns:
+        The fastest time taken, in seconds
+    '''
+    best = float('inf')
+    for _ in range(count):
+        start = time.perf_counter()
+        response = get(url)
+        best = min(best, time.perf_counter() - start)
+        assert response.status_code == 200, response.text
+    return best
+
+
+def main(args) -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        # api loads its config and database when it's imported
+        os.environ['CONFIG_PATH'] = os.path.join(tmp, 'budget.json')
+        os.environ['DB_PATH'] = os.path.join(tmp, 'bench.db')
+        with open(os.environ['CONFIG_PATH'], 'w') as fp:
+            json.dump({
+                'algorithm': 'HS256',
+                'access_token_key': 'access',
+                'refresh_token_key': 'refresh',
+                'access_token_ttl': 3600,
+                'refresh_token_ttl': 604800,
+                'users': {'user@example.com': {'api': 'rw', 'hash': ''}},
+                'dashboard': [{'category': name, 'limit': 100000} for name in CATEGORIES],
+            }, fp)
+
+        from fastapi.testclient import TestClient
+        from database import Database
+        from responses import RESPONSE_CLASSES
+        from auth import create_token
+        import api
+
+        add_baseline(api.app)
+        client = TestClient(api.app)
+        client.headers['Authorization'] = f'Bearer {create_token("user@example.com").access_token}'
+        query = '?start=2023-01-01&end=2023-12-31'
+
+        print(f'{"rows":>6} {"endpoint":<12} {"encoder":<9} {"time (ms)":>10} {"speedup":>8}')
+        for rows in args.rows:
+            with Database() as db:
+                db.db.execute('DELETE FROM allocation')
+                db.db.execute('DELETE FROM txn')
+            populate(rows)
+
+            for endpoint in ['transaction', 'allocation', 'dashboard']:
+                baseline = measure(client.get, f'/baseline/{endpoint}/{query}', args.count)
+                print(f'{rows:>6} {endpoint:<12} {"models":<9} {baseline * 1000:>10.2f} {1:>7.1f}x')
+                encoders = RESPONSE_CLASSES if endpoint != 'dashboard' else {'models': None}
+                for name, response_class in encoders.items():
+                    if response_class:
+                        api.ListResponse = response_class
+                    elapsed = measure(client.get, f'/api/{endpoint}/{query}', args.count)
+                    label = name if response_class else 'sql'
+                    print(f'{rows:>6} {endpoint:<12} {label:<9} {elapsed * 1000:>10.2f} {baseline / elapsed:>7.1f}x')
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the list endpoints of the API')
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000], help='The numbers of transactions to try')
+    parser.add_argument('--count', type=int, default=10, help='The number of times to make each request')
+    sys.exit(main(parser.parse_args()))
@@ -9,23 +9,61 @@
 # System imports
 import os
 import re
-import difflib
-import math
-import psutil
+import logging
 import datetime
-import subprocess
+from contextlib import asynccontextmanager
 from typing import List, Annotated, Optional, Dict
-from fastapi import FastAPI, Depends, HTTPException, status, Response, Body, Query, Request, BackgroundTasks
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
+from fastapi import FastAPI, Depends, HTTPException, status, Response, Body, Query, Request
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
 # Local imports
 from database import Database
-from model import Transaction, TransactionList, Allocation, AllocationList, Token, OAuth2RequestForm, Categorisation, Score, DashboardPanel, PushSubscription, ScraperState
-from auth import config, create_token, verify_user, validate_access_token, get_cached_token, validate_refresh_token, clear_cached_token
+from merchant import MerchantNormaliser
+from scheduler import Scheduler
+from logs import LOG_PATH, LOG_RETENTION_DAYS, LogStore, LogFollower, tail, parse_time, format_record, compile_filter, setup_logging, stop_logging
+from events import bus, sse_stream
+from responses import get_response_class
+from static import StaticAssets
+from categorise import ENGINES, Categoriser, CategoriserIndex, categorise_batch
+from model import Transaction, TransactionList, Allocation, AllocationList, ChangeList, Token, OAuth2RequestForm, Categorisation, DashboardPanel, PushSubscription, ScraperState, Suggestion, Job, MetricRun, Event
+from auth import config, create_token, password_verifier, token_store, validate_access_token, get_cached_token, validate_refresh_token, clear_cached_token
 
 
-app = FastAPI(openapi_url=None, docs_url=None, redoc_url=None)
+Database.normaliser = MerchantNormaliser(config.get('merchant_rules'))
+categoriser_index = CategoriserIndex()
+scheduler = Scheduler(config.get('schedule'))
+ListResponse = get_response_class(config.get('json_encoder'))
+
+
+def publish_log(line: str) -> None:
+    bus.publish('log', line)
+
+
+log_follower = LogFollower(LOG_PATH, publish_log)
+
+# Stop proxies from buffering event streams
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Map the categorisation index in at startup, rather than on the first
+    # request, if it's the default engine
+    if config.get('categoriser', 'difflib') == 'tfidf':
+        with Database() as db:
+            categoriser_index.get(db)
+    setup_logging(LOG_PATH, logging.INFO, retention_days=config.get('log_retention_days', LOG_RETENTION_DAYS))
+    token_store.load()
+    scheduler.start()
+    yield
+    scheduler.stop(timeout=5)
+    token_store.stop()
+    log_follower.stop(timeout=5)
+    stop_logging()
+
+
+app = FastAPI(openapi_url=None, docs_url=None, redoc_url=None, lifespan=lifespan)
 
 
 @app.post('/api/transaction/', status_code=201, response_model=Transaction, dependencies=[Depends(validate_access_token)])
@@ -35,14 +73,16 @@ def add_transaction(txn: Transaction) -> Transaction:
     return txn
 
 
-@app.get('/api/transaction/', response_model=TransactionList, dependencies=[Depends(validate_access_token)])
+# The list endpoints encode rows straight from the database, as building and
+# validating a model for every row costs far more than encoding it
+@app.get('/api/transaction/', response_model=TransactionList, response_class=ListResponse, dependencies=[Depends(validate_access_token)])
 def get_transactions(start: Optional[str],
                      end: Optional[str],
                      filter: Optional[str] = None,
                      sort_column: str = 'date',
                      sort_order: str = 'desc',
                      limit: Optional[int] = None,
-                     offset: int = 0) -> TransactionList:
+                     offset: int = 0) -> Response:
     with Database() as db:
         filter_list: List[str] = []
         params: List[str | int] = []
@@ -74,7 +114,7 @@ def get_transactions(start: Optional[str],
             )
         query += f' ORDER BY {sort_column} {sort_order}, id {sort_order}'
 
-        return db.get_transaction_list(query, tuple(params), limit, offset)
+        return ListResponse(db.get_transaction_rows(query, tuple(params), limit, offset))
 
 
 @app.get('/api/transaction/{txn_id}', response_model=Optional[Transaction], dependencies=[Depends(validate_access_token)])
@@ -90,62 +130,37 @@ def delete_transactions(id: Annotated[List[int], Query()]) -> None:
         db.delete_transactions(id)
 
 
+def get_categoriser(engine: Optional[str]) -> Categoriser:
+    engine = engine or config.get('categoriser', 'difflib')
+    if engine not in ENGINES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'Invalid categorisation engine: {engine}',
+        )
+
+    with Database() as db:
+        if engine == 'tfidf':
+            return categoriser_index.get(db)
+        return ENGINES[engine].from_database(db)
+
+
 @app.get('/api/categorise/', response_model=Categorisation, dependencies=[Depends(validate_access_token)])
-def get_categorise(description: str) -> Categorisation:
+def get_categorise(description: str, engine: Optional[str] = None) -> Categorisation:
+    return get_categoriser(engine).categorise(description)
+
+
+@app.post('/api/categorise/batch/', response_model=List[Categorisation], dependencies=[Depends(validate_access_token)])
+def get_categorise_batch(descriptions: Annotated[List[str], Body(embed=True)], engine: Optional[str] = None) -> List[Categorisation]:
+    return categorise_batch(get_categoriser(engine), descriptions, config.get('categorise_workers', 1), config.get('categorise_parallel_min', 1000))
+
+
+@app.get('/api/suggestion/{txn_id}', response_model=Optional[Suggestion], dependencies=[Depends(validate_access_token)])
+def get_suggestion(txn_id: int) -> Optional[Suggestion]:
     with Database() as db:
-        all_categories = set([v for v in db.get_category_list() if v != 'Unknown'])
-        all_locations = set([v for v in db.get_location_list() if v != 'Unknown'])
-        descr_map = db.get_description_map()
-
-    category_scores = {k: {'score': 0, 'ratio': 0.0} for k in all_categories}
-    location_scores = {k: {'score': 0, 'ratio': 0.0} for k in all_locations}
-    description = description.lower()
-    for candidate_description, candidate_data in descr_map.items():
-        ratio = difflib.SequenceMatcher(a=description, b=candidate_description).ratio()
-        for category, count in candidate_data['categories'].items():
-            if category == 'Unknown':
-                continue
-            current_score = ratio * ratio * math.sqrt(count)
-            if ratio == 1:
-                current_score *= 10
-            category_scores[category]['score'] += current_score
-            category_scores[category]['ratio'] = max(ratio, category_scores[category]['ratio'])
-
-        for location, count in candidate_data['locations'].items():
-            if location == 'Unknown':
-                continue
-            current_score = ratio * ratio * math.sqrt(count)
-            if ratio == 1:
-                current_score *= 10
-            location_scores[location]['score'] += current_score
-            location_scores[location]['ratio'] = max(ratio, location_scores[location]['ratio'])
-
-    res = Categorisation(categories=[], locations=[])
-
-    if category_scores:
-        # Get the list of categories sorted by score, normalised to the best
-        sorted_category_scores = sorted(category_scores.items(), key=lambda x: x[1]['score'], reverse=True)
-        best_score = sorted_category_scores[0][1]
-        for category, score in sorted_category_scores:
-            value = 0 if best_score['score'] == 0 else score['score'] / best_score['score'] * best_score['ratio']
-            res.categories.append(Score(name=category, score=value))
-            all_categories.discard(category)
-        res.categories.extend(map(lambda x: Score(name=x, score=0.0), sorted(all_categories)))
-
-    if location_scores:
-        # Get the list of locations sorted by score, normalised to the best
-        sorted_location_scores = sorted(location_scores.items(), key=lambda x: x[1]['score'], reverse=True)
-        best_score = sorted_location_scores[0][1]
-        for location, score in sorted_location_scores:
-            value = 0 if best_score['score'] == 0 else score['score'] / best_score['score'] * best_score['ratio']
-            res.locations.append(Score(name=location, score=value))
-            all_locations.discard(location)
-        res.locations.extend(map(lambda x: Score(name=x, score=0.0), sorted(all_locations)))
-
-    return res
-
-
-@app.get('/api/allocation/', response_model=AllocationList, dependencies=[Depends(validate_access_token)])
+        return db.get_suggestion(txn_id)
+
+
+@app.get('/api/allocation/', response_model=AllocationList, response_class=ListResponse, dependencies=[Depends(validate_access_token)])
 def get_allocations(txn: Optional[int] = None,
                     start: Optional[str] = None,
                     end: Optional[str] = None,
@@ -153,7 +168,7 @@ def get_allocations(txn: Optional[int] = None,
                     sort_column: str = 'category',
                     sort_order: str = 'asc',
                     limit: Optional[int] = None,
-                    offset: int = 0) -> AllocationList:
+                    offset: int = 0) -> Response:
     with Database() as db:
         filter_list: List[str] = []
         params: List[str | int] = []
@@ -198,7 +213,7 @@ def get_allocations(txn: Optional[int] = None,
             )
         query += f' ORDER BY {sort_map[sort_column]} {sort_order}'
 
-        return db.get_allocation_list(query, tuple(params), limit, offset)
+        return ListResponse(db.get_allocation_rows(query, tuple(params), limit, offset))
 
 
 @app.get('/api/allocation/{alloc_id}', response_model=None, dependencies=[Depends(validate_access_token)])
@@ -216,6 +231,12 @@ def get_allocation(alloc_id: int) -> Allocation | Response:
         return alloc_list.allocations[0]
 
 
+@app.get('/api/changes/', response_model=ChangeList, response_class=ListResponse, dependencies=[Depends(validate_access_token)])
+def get_changes(since: int = 0) -> Response:
+    with Database() as db:
+        return ListResponse(db.get_changes(since))
+
+
 @app.get('/api/dashboard/', response_model=List[DashboardPanel], dependencies=[Depends(validate_access_token)])
 def get_dashboard(start: str, end: str) -> List[DashboardPanel]:
     dt_start = datetime.datetime.strptime(start, '%Y-%m-%d').date()
@@ -235,9 +256,9 @@ def get_dashboard(start: str, end: str) -> List[DashboardPanel]:
     total_limit = 0
     expected_total_amount = 0
     with Database() as db:
+        totals = db.get_category_totals(start, end)
         for panel_cfg in config['dashboard']:
-            alloc_list = db.get_allocation_list(f'txn.date BETWEEN ? AND ? AND category.name = ?', (start, end, panel_cfg['category'])).allocations
-            amount = -sum([alloc.amount for alloc in alloc_list])
+            amount = -totals.get(panel_cfg['category'], 0)
             expected_amount = ndays / total_ndays * panel_cfg['limit']
             diff = -100 if expected_amount == 0 else (amount - expected_amount) / expected_amount * 100
             resp.append(DashboardPanel(category=panel_cfg['category'], amount=amount, limit=panel_cfg['limit'], diff=diff))
@@ -331,50 +352,118 @@ def delete_push_subscription(sub: Dict) -> None:
 
 
 @app.get('/api/logs/', dependencies=[Depends(validate_access_token)])
-def get_logs(count: int, filter: str) -> List[str]:
-    output = []
-    regex = re.compile(filter)
-    with open('budget.log') as fp:
-        for line in fp:
-            line = line.strip()
-            if regex.search(line):
-                output.append(line)
-    return output[-count:]
+def get_logs(count: int,
+             filter: str = '',
+             start: Optional[str] = None,
+             end: Optional[str] = None,
+             level: Optional[str] = None,
+             event: Optional[str] = None,
+             source: Optional[str] = None) -> List[str]:
+    try:
+        if start is None and end is None and level is None and event is None and source is None:
+            return tail(LOG_PATH, count, filter)
+
+        # Structured queries use the indexed copy of the log
+        min_level = logging.getLevelName(level.upper()) if level else None
+        if level and not isinstance(min_level, int):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f'Invalid level: {level}',
+            )
+        try:
+            start_time = parse_time(start) if start else None
+            end_time = parse_time(end, end=True) if end else None
+        except ValueError as exc:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f'Invalid time range: {exc}',
+            )
+        with LogStore() as store:
+            records = store.query(count, start_time, end_time, min_level, event, source, filter)
+        return [format_record(rec) for rec in records]
+    except re.error as exc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'Invalid filter: {exc}',
+        )
+
+
+@app.get('/api/logs/stream/', dependencies=[Depends(validate_access_token)])
+async def stream_logs(request: Request, filter: str = '', count: int = 0) -> StreamingResponse:
+    try:
+        regex = compile_filter(filter)[0] if filter else None
+    except re.error as exc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'Invalid filter: {exc}',
+        )
+
+    # Subscribe before reading the recent lines, so none are missed in between
+    sub = bus.subscribe(['log'], (lambda event: bool(regex.search(event.data))) if regex else None)
+    log_follower.start()
+    initial = []
+    if count > 0 and os.path.exists(LOG_PATH):
+        lines = await run_in_threadpool(tail, LOG_PATH, count, filter)
+        initial = [Event(id=0, topic='log', data=line) for line in lines]
+    return StreamingResponse(sse_stream(sub, request.is_disconnected, initial), media_type='text/event-stream', headers=STREAM_HEADERS)
+
+
+@app.get('/api/events/', dependencies=[Depends(validate_access_token)])
+async def stream_events(request: Request) -> StreamingResponse:
+    sub = bus.subscribe(['job', 'transactions'])
+
+    # Start with the latest job, so the client doesn't need to fetch it first
+    state = await run_in_threadpool(get_scraper)
+    initial = [Event(id=0, topic='job', data=state.job.dict())] if state.job else []
+    return StreamingResponse(sse_stream(sub, request.is_disconnected, initial), media_type='text/event-stream', headers=STREAM_HEADERS)
 
 
 @app.get('/api/scraper/', response_model=ScraperState, dependencies=[Depends(validate_access_token)])
 def get_scraper() -> ScraperState:
-    for process in psutil.process_iter():
-        try:
-            process_info = process.as_dict()
-            if 'cmdline' in process_info and len(process_info['cmdline']) > 2 and process_info['cmdline'][1] == 'insert_transactions.py':
-                return ScraperState(state='running')
-        except:
-            pass
-
-    return ScraperState(state='idle')
+    with Database() as db:
+        jobs = db.get_job_list(limit=1)
+    if jobs and jobs[0].state != 'done':
+        return ScraperState(state='running', job=jobs[0])
+    return ScraperState(state='idle', job=jobs[0] if jobs else None)
 
 
 @app.put('/api/scraper/', response_class=Response, dependencies=[Depends(validate_access_token)])
-def put_scraper(state: ScraperState, tasks: BackgroundTasks) -> None:
+def put_scraper(state: ScraperState) -> Response:
     if state.state != 'running':
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f'Invalid scraper state \'{state.state}\'',
         )
 
-    tasks.add_task(subprocess.run, ['/bin/sh', './scrapers/run.sh'])
+    # A scrape that is already queued or running covers this request too
+    scheduler.trigger('manual')
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
+@app.get('/api/job/', response_model=List[Job], dependencies=[Depends(validate_access_token)])
+def get_jobs(limit: int = 20) -> List[Job]:
+    with Database() as db:
+        return db.get_job_list(limit=limit)
+
+
+@app.get('/api/metrics/', response_model=List[MetricRun], dependencies=[Depends(validate_access_token)])
+def get_metrics(limit: int = 20, source: Optional[str] = None) -> List[MetricRun]:
+    with Database() as db:
+        return db.get_metric_runs(limit, source)
+
+
+def refresh_token(value: str) -> Token:
+    token = get_cached_token(value)
+    return create_token(validate_refresh_token(token.value), token.value)
+
+
 @app.post('/api/oauth2/token/', response_model=Token)
-def auth(form_data: Annotated[OAuth2RequestForm, Depends()]) -> Token:
+async def auth(form_data: Annotated[OAuth2RequestForm, Depends()]) -> Token:
     if form_data.grant_type == 'refresh_token':
-        token = get_cached_token(form_data.refresh_token)
-        return create_token(validate_refresh_token(token.value), token.value)
+        return await run_in_threadpool(refresh_token, form_data.refresh_token)
     else:
-        verify_user(form_data.username, form_data.password)
-        return create_token(form_data.username)
+        await password_verifier.verify(form_data.username, form_data.password)
+        return await run_in_threadpool(create_token, form_data.username)
 
 
 @app.get('/api/oauth2/token/', response_class=Response, dependencies=[Depends(validate_access_token)])
@@ -389,7 +478,7 @@ def logout(form_data: Annotated[OAuth2RequestForm, Depends()]) -> Response:
 
 
 if os.environ.get('DIST_PATH'):  # pragma: no cover
-    templates = Jinja2Templates(directory=os.environ['DIST_PATH'])
+    assets = StaticAssets(os.environ['DIST_PATH'])
 
     @app.get('/logs')
     @app.get('/logs/')
@@ -401,7 +490,7 @@ if os.environ.get('DIST_PATH'):  # pragma: no cover
     @app.get('/allocations/')
     @app.get('/allocations/{id}')
     @app.get('/allocations/{id}/')
-    def serve_spa(request: Request):
-        return templates.TemplateResponse('index.html', {'request': request})
+    def serve_spa(request: Request) -> Response:
+        return assets.index_response(request)
 
-    app.mount('/', StaticFiles(directory=os.environ.get('DIST_PATH'), html=True))
+    app.mount('/', assets)
@@ -8,14 +8,27 @@
 
 # System imports
 from fastapi.testclient import TestClient
+from unittest.mock import patch
+from typing import List, Optional
 import unittest
+import tempfile
+import threading
+import asyncio
+import json
 import time
+import os
 
 # Local imports
+import api
 from api import app
+from events import bus
+from responses import RESPONSE_CLASSES, get_response_class
 from database import Database
-from model import Transaction, CachedToken
-from auth import config, hash_password, create_token
+from model import Transaction, CachedToken, MetricRun, LogRecord
+from logs import LogStore
+from auth import config, hash_password, create_token, token_cache, TokenCache, VerifiedToken, PasswordVerifier, create_password_context
+from fastapi import HTTPException
+from jose import jwt
 
 
 class TestDatabase(unittest.TestCase):
@@ -30,7 +43,7 @@ class TestDatabase(unittest.TestCase):
 
     def test_tables(self) -> None:
         with self.db:
-            self.assertEqual(set(self.db.get_tables()), {'setting', 'txn', 'category', 'location', 'allocation', 'token', 'push_subscription'})
+            self.assertEqual(set(self.db.get_tables()), {'setting', 'txn', 'category', 'location', 'allocation', 'token', 'push_subscription', 'suggestion', 'merchant', 'job', 'watermark', 'metric_run', 'metric', 'change', 'sqlite_sequence'})
 
     def test_setting_fields(self) -> None:
         with self.db:
@@ -42,7 +55,7 @@ class TestDatabase(unittest.TestCase):
 
     def test_txn_fields(self) -> None:
         with self.db:
-            self.assertEqual(set(self.db.get_fields('txn')), {'id', 'date', 'amount', 'description', 'source', 'balance', 'pending'})
+            self.assertEqual(set(self.db.get_fields('txn')), {'id', 'date', 'amount', 'description', 'source', 'balance', 'pending', 'merchant_id'})
 
     def test_category_fields(self) -> None:
         with self.db:
@@ -60,6 +73,183 @@ class TestDatabase(unittest.TestCase):
         with self.db:
             self.assertEqual(set(self.db.get_fields('push_subscription')), {'id', 'value'})
 
+    def test_merchant_fields(self) -> None:
+        with self.db:
+            self.assertEqual(set(self.db.get_fields('merchant')), {'id', 'name'})
+
+    def test_merchant_map(self) -> None:
+        with self.db:
+            for descr in ['PETROL EXPRESS 1830       SOMETOWN    AU', 'PETROL EXPRESS 2044 SOMETOWN AU XXXX-XXXX-XXXX-2837', 'FOO BAR PTY LTD']:
+                self.db.add_transaction(Transaction(date='2023-07-03', amount=3456, description=descr, source='Bank of Foo'))
+            self.assertEqual(len(self.db.get_description_map()), 3)
+            merchant_map = self.db.get_merchant_map()
+            self.assertEqual(merchant_map, {
+                'petrol express sometown au': {'categories': {'Unknown': 2}, 'locations': {'Unknown': 2}},
+                'foo bar pty ltd': {'categories': {'Unknown': 1}, 'locations': {'Unknown': 1}},
+            })
+
+    def test_merchant_updated_with_description(self) -> None:
+        with self.db:
+            txn = self.db.add_transaction(Transaction(date='2023-07-03', amount=3456, description='PETROL EXPRESS 1830 SOMETOWN', source='Bank of Foo'))
+            txn.description = 'FOO BAR 1234 PTY LTD'
+            self.db.update_transaction(txn.id, txn)
+            self.assertEqual(list(self.db.get_merchant_map().keys()), ['foo bar pty ltd'])
+
+    def test_merchant_migration(self) -> None:
+        with self.db:
+            self.db.add_transaction(Transaction(date='2023-07-03', amount=3456, description='PETROL EXPRESS 1830 SOMETOWN', source='Bank of Foo'))
+            self.db.db.execute('DROP TRIGGER txn_merchant_version')
+            self.db.db.execute('DROP INDEX txn_merchant_idx')
+            self.db.db.execute('ALTER TABLE txn DROP COLUMN merchant_id')
+            self.db.db.execute('DELETE FROM merchant')
+        with self.db:
+            self.assertIn('merchant_id', self.db.get_fields('txn'))
+            self.assertEqual(list(self.db.get_merchant_map().keys()), ['petrol express sometown'])
+
+    def test_suggestion_fields(self) -> None:
+        with self.db:
+            self.assertEqual(set(self.db.get_fields('suggestion')), {'txn_id', 'category', 'category_score', 'location', 'location_score'})
+
+    def test_job_fields(self) -> None:
+        with self.db:
+            self.assertEqual(set(self.db.get_fields('job')), {'id', 'reason', 'schedule_key', 'state', 'pid', 'queued', 'started', 'finished',
+                                                              'inserted', 'failed', 'error'})
+
+    def test_job_lifecycle(self) -> None:
+        with self.db:
+            self.db.db.execute('DELETE FROM job')
+            job = self.db.add_job('manual')
+            assert job is not None and job.id is not None
+            self.assertEqual(job.state, 'queued')
+            self.assertIsNone(job.started)
+
+            # Only one job can be queued or running at a time
+            self.assertIsNone(self.db.add_job('manual'))
+
+            claimed = self.db.claim_job()
+            assert claimed is not None
+            self.assertEqual(claimed.id, job.id)
+            self.assertEqual(claimed.state, 'running')
+            self.assertIsNotNone(claimed.started)
+            self.assertIsNone(self.db.claim_job())
+            self.assertIsNone(self.db.add_job('manual'))
+
+            self.db.set_job_pid(job.id, 1234)
+            self.db.finish_job(job.id, 3, 1, 'oops')
+            self.db.finish_job(job.id, error='ignored')
+            finished = self.db.get_job(job.id)
+            assert finished is not None
+            self.assertEqual((finished.state, finished.pid, finished.inserted, finished.failed, finished.error), ('done', 1234, 3, 1, 'oops'))
+            self.assertGreaterEqual(finished.finished, finished.started)
+
+            # A scheduled run is only queued once
+            scheduled = self.db.add_job('schedule', '0 6 * * *@2023-08-03T06:00:00')
+            assert scheduled is not None and scheduled.id is not None
+            self.db.claim_job()
+            self.db.finish_job(scheduled.id)
+            self.assertIsNone(self.db.add_job('schedule', '0 6 * * *@2023-08-03T06:00:00'))
+            self.assertEqual([job.id for job in self.db.get_job_list(limit=2)], [scheduled.id, job.id])
+
+            # A job started by the CLI is never queued, so the scheduler can't claim it
+            cli = self.db.add_job('cli', state='running')
+            assert cli is not None and cli.id is not None
+            self.assertEqual(cli.state, 'running')
+            self.assertIsNotNone(cli.started)
+            self.assertIsNone(self.db.claim_job())
+            self.assertIsNone(self.db.add_job('cli', state='running'))
+            self.db.finish_job(cli.id)
+
+    def test_watermark(self) -> None:
+        with self.db:
+            self.db.db.execute('DELETE FROM watermark')
+            self.assertIsNone(self.db.get_watermark('Bank of Foo'))
+            watermark = self.db.update_watermark('Bank of Foo')
+            self.assertEqual((watermark.oldest_pending, watermark.last_posted), (None, None))
+
+            self.db.add_transaction(Transaction(date='2023-07-01', amount=100, description='Old', source='Bank of Foo'))
+            self.db.add_transaction(Transaction(date='2023-07-05', amount=100, description='Posted', source='Bank of Foo'))
+            self.db.add_transaction(Transaction(date='2023-07-03', amount=100, description='Pending', source='Bank of Foo', pending=True))
+            self.db.add_transaction(Transaction(date='2023-07-04', amount=100, description='Pending', source='Bank of Foo', pending=True))
+            self.db.add_transaction(Transaction(date='2023-07-09', amount=100, description='Other', source='Bar Inc'))
+            self.db.update_watermark('Bank of Foo')
+            watermark = self.db.get_watermark('Bank of Foo')
+            assert watermark is not None
+            self.assertEqual((watermark.oldest_pending, watermark.last_posted), ('2023-07-03', '2023-07-05'))
+            self.assertIsNone(self.db.get_watermark('Bar Inc'))
+
+    def test_metric_runs(self) -> None:
+        with self.db:
+            self.db.db.execute('DELETE FROM metric_run')
+            self.assertEqual(self.db.get_metric_runs(), [])
+            first = self.db.add_metric_run(MetricRun(started=1.0, finished=2.0, stages={'': {'index': 0.5}}, counts={'Bank of Foo': {'inserted': 3}}))
+            second = self.db.add_metric_run(MetricRun(started=3.0, finished=4.0, stages={'Bank of Foo': {'prune': 0.25}, 'Bar Inc': {'prune': 0.75}},
+                                                      counts={'Bar Inc': {'fetched': 10}}))
+            runs = self.db.get_metric_runs()
+            self.assertEqual([run.id for run in runs], [second.id, first.id])
+            self.assertEqual(runs[0].dict(), second.dict())
+            self.assertEqual(runs[1].dict(), first.dict())
+
+            runs = self.db.get_metric_runs(limit=1, source='Bar Inc')
+            self.assertEqual(len(runs), 1)
+            self.assertEqual((runs[0].stages, runs[0].counts), ({'Bar Inc': {'prune': 0.75}}, {'Bar Inc': {'fetched': 10}}))
+
+    def test_description_map_version(self) -> None:
+        with self.db:
+            version = self.db.get_description_map_version()
+            txn = self.db.add_transaction(Transaction(date='2023-07-03', amount=3456, description='FooBar Enterprises', source='Bank of Foo'))
+            self.assertGreater(self.db.get_description_map_version(), version)
+            version = self.db.get_description_map_version()
+            alloc = self.db.get_txn_allocations(txn.id).allocations[0]
+            alloc.category = 'Groceries'
+            self.db.update_allocation(alloc)
+            self.assertGreater(self.db.get_description_map_version(), version)
+            version = self.db.get_description_map_version()
+            txn.balance = 100
+            self.db.update_transaction(txn.id, txn)
+            self.assertEqual(self.db.get_description_map_version(), version)
+
+    def test_transaction_commit(self) -> None:
+        with self.db:
+            with self.db.transaction():
+                self.db.set_setting('foo', 'bar')
+                self.assertTrue(self.db.con.in_transaction)
+            self.assertFalse(self.db.con.in_transaction)
+            self.assertEqual(self.db.get_setting('foo'), 'bar')
+
+    def test_transaction_rollback(self) -> None:
+        with self.db:
+            txn = self.db.add_transaction(Transaction(date='2023-07-03', amount=3456, description='FooBar Enterprises', source='Bank of Foo'))
+            with self.assertRaises(ValueError):
+                with self.db.transaction():
+                    self.db.delete_transactions([txn.id])
+                    self.db.add_transaction(Transaction(date='2023-07-04', amount=100, description='Rolled Back', source='Bank of Foo'))
+                    raise ValueError()
+            # Changes made before the transaction are kept
+            self.assertIsNotNone(self.db.get_transaction(txn.id))
+            self.assertEqual(len(self.db.get_transaction_list().transactions), 1)
+            self.db.db.execute('SELECT COUNT(*) FROM merchant WHERE name = ?', ('rolled back', ))
+            self.assertEqual(self.db.db.fetchone()[0], 0)
+            # A merchant that was rolled back is created again
+            merchant_id = self.db.get_merchant_id('rolled back')
+            self.db.db.execute('SELECT name FROM merchant WHERE id = ?', (merchant_id, ))
+            self.assertEqual(self.db.db.fetchone()[0], 'rolled back')
+
+    def test_savepoint_rollback(self) -> None:
+        with self.db:
+            with self.db.transaction():
+                self.db.set_setting('foo', 'bar')
+                with self.assertRaises(ValueError):
+                    with self.db.savepoint('test'):
+                        self.db.set_setting('foo', 'baz')
+                        raise ValueError()
+                self.assertEqual(self.db.get_setting('foo'), 'bar')
+                with self.assertRaises(ValueError):
+                    with self.db.transaction():
+                        self.db.set_setting('foo', 'qux')
+                        raise ValueError()
+                self.assertTrue(self.db.con.in_transaction)
+            self.assertEqual(self.db.get_setting('foo'), 'bar')
+
     def test_create_setting(self) -> None:
         with self.db:
             self.db.set_setting('interval', 'monthly')
@@ -362,6 +552,15 @@ class TestAPI(unittest.TestCase):
         self.client.headers.update({'Authorization': f'Bearer {self.token}'})
         return super().setUp()
 
+    def test_lifespan_warms_index(self) -> None:
+        # The TF-IDF index is only loaded at startup if it's the default engine
+        for engine, calls in [('difflib', 0), ('tfidf', 1)]:
+            with patch.dict(config, {'categoriser': engine}), patch.object(api.categoriser_index, 'get') as get, \
+                    patch.object(api.scheduler, 'start'), patch('api.setup_logging'), patch('api.stop_logging'):
+                with TestClient(app):
+                    pass
+            self.assertEqual(get.call_count, calls)
+
     def test_add_a_transaction(self) -> None:
         response = self.client.post('/api/transaction/', json={
             'date': '2023-05-02',
@@ -451,6 +650,278 @@ class TestAPI(unittest.TestCase):
                 self.assertEqual(alloc['date'], '2021-07-17')
                 self.assertEqual(alloc['amount'], 125)
 
+    def test_list_encoders(self) -> None:
+        with self.db:
+            self.db.add_transaction(Transaction(date='2021-08-01', amount=-3456, description='Café Ünicode', source='Bank of Foo', pending=True))
+            self.db.add_transaction(Transaction(date='2021-08-02', amount=125, description='123 Inc', source='Bank of Bar'))
+            txn_list = self.db.get_transaction_list('date BETWEEN ? AND ? ORDER BY date desc, id desc', ('2021-08-01', '2021-08-02'))
+            alloc_list = self.db.get_allocation_list('txn.date BETWEEN ? AND ? ORDER BY category.name asc', ('2021-08-01', '2021-08-02'))
+
+        # Every encoder gives the same response as the models would
+        for encoder in RESPONSE_CLASSES:
+            with patch.object(api, 'ListResponse', get_response_class(encoder)):
+                resp = self.client.get('/api/transaction/?start=2021-08-01&end=2021-08-02')
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.headers['content-type'], 'application/json')
+                self.assertEqual(resp.json(), txn_list.model_dump())
+                resp = self.client.get('/api/allocation/?start=2021-08-01&end=2021-08-02')
+                self.assertEqual(resp.json(), alloc_list.model_dump())
+
+        self.assertIs(get_response_class(), RESPONSE_CLASSES.get('orjson', RESPONSE_CLASSES['json']))
+        with self.assertRaises(ValueError):
+            get_response_class('pickle')
+
+    def test_get_changes(self) -> None:
+        with self.db:
+            txn1 = self.db.add_transaction(Transaction(date='2021-10-01', amount=-100, description='Shop 1', source='Bank of Foo'))
+            txn2 = self.db.add_transaction(Transaction(date='2021-10-02', amount=-200, description='Shop 2', source='Bank of Foo'))
+            alloc2 = self.db.get_txn_allocations(txn2.id).allocations[0]
+
+        resp = self.client.get('/api/changes/?since=0')
+        self.assertEqual(resp.status_code, 200)
+        snapshot = resp.json()
+        self.assertTrue(snapshot['reset'])
+        self.assertIn(txn1.id, [txn['id'] for txn in snapshot['transactions']])
+        self.assertIn(alloc2.id, [alloc['id'] for alloc in snapshot['allocations']])
+        version = snapshot['version']
+
+        # Nothing has changed yet
+        changes = self.client.get(f'/api/changes/?since={version}').json()
+        self.assertEqual(changes, {'version': version, 'reset': False, 'transactions': [], 'allocations': [],
+                                   'deleted_transactions': [], 'deleted_allocations': []})
+
+        with self.db:
+            # Merchant changes aren't visible to clients
+            self.db.db.execute('UPDATE txn SET merchant_id = NULL WHERE id = ?', (txn1.id, ))
+            self.db.db.execute('UPDATE txn SET amount = amount WHERE id = ?', (txn1.id, ))
+            self.db.update_transaction(txn2.id, Transaction(date='2021-10-03', amount=-200, description='Shop 2', source='Bank of Foo'))
+            self.db.delete_transactions([txn1.id])
+        changes = self.client.get(f'/api/changes/?since={version}').json()
+        self.assertFalse(changes['reset'])
+        self.assertGreater(changes['version'], version)
+        self.assertEqual([txn['date'] for txn in changes['transactions']], ['2021-10-03'])
+        self.assertEqual([(alloc['id'], alloc['date']) for alloc in changes['allocations']], [(alloc2.id, '2021-10-03')])
+        self.assertEqual(changes['deleted_transactions'], [txn1.id])
+        self.assertEqual(len(changes['deleted_allocations']), 1)
+
+        # A row changed many times is sent once, as it is now
+        version = changes['version']
+        for note in ['a', 'b', 'c']:
+            self.assertEqual(self.client.put('/api/allocation/', json={**alloc2.model_dump(), 'note': note}).status_code, 200)
+        changes = self.client.get(f'/api/changes/?since={version}').json()
+        self.assertEqual([alloc['note'] for alloc in changes['allocations']], ['c'])
+        self.assertEqual(changes['transactions'], [])
+
+        # A client ahead of the database starts again
+        changes = self.client.get(f'/api/changes/?since={changes["version"] + 100}').json()
+        self.assertTrue(changes['reset'])
+        self.assertNotIn(txn1.id, [txn['id'] for txn in changes['transactions']])
+
+    def test_get_dashboard(self) -> None:
+        with self.db:
+            for amount, category in [(-1000, 'Groceries'), (-500, 'Groceries'), (-2000, 'Transport'), (-300, 'Unknown')]:
+                txn = self.db.add_transaction(Transaction(date='2021-09-10', amount=amount, description='Shop', source='Bank of Foo'))
+                alloc = self.db.get_txn_allocations(txn.id).allocations[0]
+                alloc.category = category
+                self.db.update_allocation(alloc)
+        resp = self.client.get('/api/dashboard/?start=2021-09-01&end=2021-09-30')
+        self.assertEqual(resp.status_code, 200)
+        panels = {panel['category']: panel for panel in resp.json()}
+        self.assertEqual(panels['Groceries']['amount'], 1500)
+        self.assertEqual(panels['Transport']['amount'], 2000)
+        self.assertEqual(panels['General Spending']['amount'], 0)
+        self.assertEqual(panels['Total']['amount'], 3500)
+        self.assertEqual(panels['Total']['limit'], 180000)
+        self.assertAlmostEqual(panels['Transport']['diff'], -80)
+
+    def test_categorise(self) -> None:
+        with self.db:
+            for descr, category in [('Woolworths 1234 Sometown', 'Groceries'), ('Petrol Express 1830 Sometown', 'Transport')]:
+                txn = self.db.add_transaction(Transaction(date='2023-05-02', amount=-3456, description=descr, source='Bank of Foo'))
+                alloc = self.db.get_txn_allocations(txn.id).allocations[0]
+                alloc.category = category
+                alloc.location = 'Sometown'
+                self.db.update_allocation(alloc)
+        for engine in ['difflib', 'tfidf']:
+            resp = self.client.get(f'/api/categorise/?description=WOOLWORTHS 4321 SOMETOWN&engine={engine}')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json()['categories'][0]['name'], 'Groceries')
+            self.assertEqual(resp.json()['locations'][0]['name'], 'Sometown')
+
+    def test_categorise_batch(self) -> None:
+        with self.db:
+            for descr, category in [('Woolworths 1234 Sometown', 'Groceries'), ('Petrol Express 1830 Sometown', 'Transport')]:
+                txn = self.db.add_transaction(Transaction(date='2023-05-02', amount=-3456, description=descr, source='Bank of Foo'))
+                alloc = self.db.get_txn_allocations(txn.id).allocations[0]
+                alloc.category = category
+                alloc.location = 'Sometown'
+                self.db.update_allocation(alloc)
+        descriptions = ['WOOLWORTHS 4321 SOMETOWN', 'PETROL EXPRESS 1234 SOMETOWN', 'Woolworths 1234 Sometown']
+        for engine in ['difflib', 'tfidf']:
+            resp = self.client.post(f'/api/categorise/batch/?engine={engine}', json={'descriptions': descriptions})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([res['categories'][0]['name'] for res in resp.json()], ['Groceries', 'Transport', 'Groceries'])
+            for descr, res in zip(descriptions, resp.json()):
+                single = self.client.get(f'/api/categorise/?description={descr}&engine={engine}').json()
+                self.assertEqual([score['name'] for score in res['categories']], [score['name'] for score in single['categories']])
+                for a, b in zip(res['categories'], single['categories']):
+                    self.assertAlmostEqual(a['score'], b['score'])
+
+    def test_categorise_index_follows_allocations(self) -> None:
+        with self.db:
+            txn = self.db.add_transaction(Transaction(date='2023-05-02', amount=-3456, description='Woolworths 1234 Sometown', source='Bank of Foo'))
+            alloc = self.db.get_txn_allocations(txn.id).allocations[0]
+            alloc.category = 'Groceries'
+            alloc.location = 'Sometown'
+            self.db.update_allocation(alloc)
+        resp = self.client.get('/api/categorise/?description=WOOLWORTHS 4321 SOMETOWN&engine=tfidf')
+        self.assertEqual(resp.json()['categories'][0]['name'], 'Groceries')
+
+        alloc.category = 'General Spending'
+        self.assertEqual(self.client.put('/api/allocation/', json=alloc.dict()).status_code, 200)
+        resp = self.client.get('/api/categorise/?description=WOOLWORTHS 4321 SOMETOWN&engine=tfidf')
+        self.assertEqual(resp.json()['categories'][0]['name'], 'General Spending')
+
+    def test_categorise_invalid_engine(self) -> None:
+        resp = self.client.get('/api/categorise/?description=foo&engine=qwerty')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_scraper_state(self) -> None:
+        with self.db:
+            self.db.db.execute('DELETE FROM job')
+        response = self.client.get('/api/scraper/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'state': 'idle', 'job': None})
+
+        response = self.client.put('/api/scraper/', json={'state': 'running'})
+        self.assertEqual(response.status_code, 204)
+        response = self.client.put('/api/scraper/', json={'state': 'running'})
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get('/api/scraper/')
+        self.assertEqual(response.json()['state'], 'running')
+        self.assertEqual(response.json()['job']['state'], 'queued')
+        self.assertEqual(response.json()['job']['reason'], 'manual')
+
+        # Triggering twice only queues one job
+        response = self.client.get('/api/job/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
+
+        with self.db:
+            self.db.finish_job(response.json()[0]['id'], 2, 0)
+        response = self.client.get('/api/scraper/')
+        self.assertEqual(response.json()['state'], 'idle')
+        self.assertEqual(response.json()['job']['inserted'], 2)
+
+    def test_get_metrics(self) -> None:
+        with self.db:
+            self.db.db.execute('DELETE FROM metric_run')
+            self.db.add_metric_run(MetricRun(started=1.0, finished=2.0, stages={'Bank of Foo': {'scrape': 30.0}}, counts={'Bank of Foo': {'inserted': 3}}))
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
+        self.assertEqual(response.json()[0]['stages'], {'Bank of Foo': {'scrape': 30.0}})
+        self.assertEqual(response.json()[0]['counts'], {'Bank of Foo': {'inserted': 3}})
+
+    def test_get_logs(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'budget.log')
+            with open(path, 'w') as fp:
+                fp.write('2023/08/03 10:00:00 | INFO     | foo\n2023/08/03 10:00:01 | ERROR    | bar\n2023/08/03 10:00:02 | INFO     | baz\n')
+            with patch('api.LOG_PATH', path):
+                response = self.client.get('/api/logs/', params={'count': 2, 'filter': 'INFO'})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json(), ['2023/08/03 10:00:00 | INFO     | foo', '2023/08/03 10:00:02 | INFO     | baz'])
+                response = self.client.get('/api/logs/', params={'count': 2, 'filter': '('})
+                self.assertEqual(response.status_code, 400)
+
+    def test_get_structured_logs(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'budget.db.log')
+            with LogStore(path) as store:
+                store.add([
+                    LogRecord(time=time.mktime((2023, 8, 2, 10, 0, 0, 0, 0, -1)), level='INFO', event='txn_inserted', source='Bank', txn_id=1, message='Inserted 1'),
+                    LogRecord(time=time.mktime((2023, 8, 3, 10, 0, 0, 0, 0, -1)), level='ERROR', event='balance', source='Bank', message='Bad balance'),
+                    LogRecord(time=time.mktime((2023, 8, 3, 11, 0, 0, 0, 0, -1)), level='INFO', event='txn_inserted', source='Bank', txn_id=2, message='Inserted 2'),
+                ])
+            with patch('logs.LOG_DB_PATH', path):
+                response = self.client.get('/api/logs/', params={'count': 10, 'event': 'txn_inserted'})
+                self.assertEqual(response.json(), ['2023/08/02 10:00:00 | INFO     | Inserted 1', '2023/08/03 11:00:00 | INFO     | Inserted 2'])
+                response = self.client.get('/api/logs/', params={'count': 10, 'start': '2023-08-03', 'end': '2023-08-03'})
+                self.assertEqual(len(response.json()), 2)
+                response = self.client.get('/api/logs/', params={'count': 10, 'end': '2023-08-03T10:30', 'level': 'warning'})
+                self.assertEqual(response.json(), ['2023/08/03 10:00:00 | ERROR    | Bad balance'])
+                response = self.client.get('/api/logs/', params={'count': 10, 'source': 'Bank', 'filter': 'Inserted [2]'})
+                self.assertEqual(response.json(), ['2023/08/03 11:00:00 | INFO     | Inserted 2'])
+                self.assertEqual(self.client.get('/api/logs/', params={'count': 10, 'level': 'LOUD'}).status_code, 400)
+                self.assertEqual(self.client.get('/api/logs/', params={'count': 10, 'start': 'yesterday'}).status_code, 400)
+                self.assertEqual(self.client.get('/api/logs/', params={'count': 10, 'event': 'balance', 'filter': '['}).status_code, 400)
+
+    def test_stream_events(self) -> None:
+        with self.db:
+            self.db.db.execute('DELETE FROM job')
+            job = self.db.add_job('manual')
+            assert job is not None
+
+        class Client:
+            def __init__(self) -> None:
+                self.checks = 0
+
+            async def is_disconnected(self) -> bool:
+                self.checks += 1
+                if self.checks == 1:
+                    bus.publish('transactions', {'job_id': 1, 'count': 3})
+                    bus.publish('log', 'Not subscribed')
+                return self.checks > 1
+
+        async def read() -> List[str]:
+            response = await api.stream_events(Client())  # type: ignore
+            self.assertEqual(response.media_type, 'text/event-stream')
+            self.assertEqual(response.headers['cache-control'], 'no-cache')
+            return [text async for text in response.body_iterator]  # type: ignore
+
+        output = asyncio.run(read())
+        self.assertEqual(len(output), 2)
+        self.assertIn('event: job\n', output[0])
+        self.assertEqual(json.loads(output[0].split('data: ')[1])['id'], job.id)
+        self.assertIn('event: transactions\ndata: {"job_id": 1, "count": 3}\n\n', output[1])
+
+    def test_stream_logs(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'budget.log')
+            with open(path, 'w') as fp:
+                fp.write('2023/08/03 10:00:00 | INFO     | foo\n2023/08/03 10:00:01 | ERROR    | bar\n')
+
+            class Client:
+                async def is_disconnected(self) -> bool:
+                    bus.publish('log', '2023/08/03 10:00:02 | INFO     | baz')
+                    bus.publish('log', '2023/08/03 10:00:03 | ERROR    | qux')
+                    await asyncio.sleep(0)
+                    return False
+
+            async def read() -> List[str]:
+                response = await api.stream_logs(Client(), 'ERROR', 5)  # type: ignore
+                output = []
+                async for text in response.body_iterator:
+                    output.append(text)
+                    if len(output) == 2:
+                        break
+                await response.body_iterator.aclose()  # type: ignore
+                return output
+
+            with patch('api.LOG_PATH', path), patch.object(api.log_follower, 'start'):
+                output = asyncio.run(read())
+            self.assertEqual([json.loads(text.split('data: ')[1]) for text in output], [
+                '2023/08/03 10:00:01 | ERROR    | bar', '2023/08/03 10:00:03 | ERROR    | qux'])
+            self.assertEqual(bus.subscribers('log'), 0)
+
+        response = self.client.get('/api/logs/stream/', params={'filter': '('})
+        self.assertEqual(response.status_code, 400)
+
+    def test_scraper_invalid_state(self) -> None:
+        response = self.client.put('/api/scraper/', json={'state': 'idle'})
+        self.assertEqual(response.status_code, 400)
+
     def test_update_an_allocation_category(self) -> None:
         txn_response = self.client.post('/api/transaction/', json={
             'date': '2023-05-23',
@@ -743,6 +1214,91 @@ class TestAPI(unittest.TestCase):
         )
         self.assertEqual(response.status_code, 401)
 
+    def test_token_cache(self) -> None:
+        token_cache.invalidate()
+        with patch('auth.jwt.decode', wraps=jwt.decode) as decode:
+            self.assertEqual(self.client.get('/api/oauth2/token/').status_code, 204)
+            self.assertEqual(self.client.get('/api/oauth2/token/').status_code, 204)
+            self.assertEqual(decode.call_count, 1)
+
+            # A change of permission is picked up straight away
+            config['users']['foo']['api'] = 'r'
+            self.assertEqual(self.client.put('/api/scraper/', json={'state': 'running'}).status_code, 403)
+            self.assertEqual(decode.call_count, 2)
+            config['users']['foo']['api'] = 'rw'
+
+            # So is a change of key
+            key = config['access_token_key']
+            config['access_token_key'] = 'other'
+            try:
+                self.assertEqual(self.client.get('/api/oauth2/token/').status_code, 401)
+            finally:
+                config['access_token_key'] = key
+            self.assertEqual(self.client.get('/api/oauth2/token/').status_code, 204)
+            self.assertEqual(decode.call_count, 4)
+
+            # Logging out drops the user's verified tokens
+            refresh_token = create_token('foo').refresh_token
+            self.client.post('/api/oauth2/logout/', data={'refresh_token': refresh_token, 'grant_type': 'refresh_token'},
+                             headers={'Content-Type': 'application/x-www-form-urlencoded'})
+            self.assertEqual(self.client.get('/api/oauth2/token/').status_code, 204)
+            self.assertEqual(decode.call_count, 5)
+
+    def test_password_verifier(self) -> None:
+        release = threading.Event()
+        verified = []
+
+        def verify_user(username: str, password: str) -> None:
+            release.wait(5)
+            if password != 'bar':
+                raise HTTPException(status_code=401)
+            verified.append(username)
+
+        async def run() -> List[Optional[int]]:
+            verifier = PasswordVerifier(workers=1, queue_size=1)
+            tasks = [asyncio.create_task(verifier.verify('foo', password)) for password in ['bar', 'baz', 'bar']]
+            await asyncio.sleep(0.1)
+            release.set()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            self.assertEqual(verifier.pending, 0)
+            return [res.status_code if isinstance(res, HTTPException) else None for res in results]
+
+        with patch('auth.verify_user', verify_user):
+            self.assertEqual(asyncio.run(run()), [None, 401, 503])
+        self.assertEqual(verified, ['foo'])
+
+    def test_password_verifier_shut_down(self) -> None:
+        verifier = PasswordVerifier()
+        verifier.executor.shutdown()
+        with self.assertRaises(RuntimeError):
+            asyncio.run(verifier.verify('foo', 'bar'))
+        self.assertEqual(verifier.pending, 0)
+
+    def test_password_context(self) -> None:
+        context = create_password_context({'schemes': ['sha256_crypt', 'md5_crypt'], 'deprecated': ['md5_crypt']})
+        self.assertEqual(context.default_scheme(), 'sha256_crypt')
+        self.assertTrue(context.needs_update(context.handler('md5_crypt').hash('bar')))
+        self.assertEqual(create_password_context({}).default_scheme(), 'bcrypt')
+
+    def test_token_cache_limits(self) -> None:
+        cache = TokenCache(2)
+        signer = ('key', 'HS256')
+        config['users']['bar'] = {'api': 'r'}
+        cache.put('a', VerifiedToken('foo', 'rw', time.time() + 60, signer))
+        cache.put('b', VerifiedToken('bar', 'r', time.time() + 60, signer))
+        self.assertIsNotNone(cache.get('a', signer))
+        cache.put('c', VerifiedToken('foo', 'rw', time.time() - 1, signer))
+        self.assertIsNone(cache.get('b', signer))
+        self.assertEqual(cache.get('a', signer), VerifiedToken('foo', 'rw', cache.tokens[TokenCache.key('a')].expire, signer))
+        self.assertIsNone(cache.get('c', signer))
+        self.assertIsNone(cache.get('a', ('other', 'HS256')))
+        self.assertEqual(len(cache.tokens), 0)
+
+        cache = TokenCache(0)
+        cache.put('a', VerifiedToken('foo', 'rw', time.time() + 60, signer))
+        self.assertIsNone(cache.get('a', signer))
+        del config['users']['bar']
+
     def test_check_token_is_valid(self) -> None:
         config['users']['foo'] = {
             "api": "rw",
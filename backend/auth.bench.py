@@ -0,0 +1,126 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# auth.bench.py: This file benchmarks the authentication of API requests, and
+# bursts of logins
+#
+
+# System imports
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+from types import SimpleNamespace
+from typing import List, Tuple
+
+
+async def login_burst(app, logins: int, token: str) -> Tuple[float, int, int, List[float]]:
+    '''
+    Log in many times at once, while timing another request every 10ms
+
+    Args:
+        app: The API
+        logins: The number of logins
+        token: An access token for the other requests
+
+    Returns:
+        The time taken, the number of successful and rejected logins, and the
+        times of the other requests
+    '''
+    import httpx
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+        done = asyncio.Event()
+        latencies: List[float] = []
+
+        async def probe() -> None:
+            while not done.is_set():
+                start = time.perf_counter()
+                await client.get('/api/oauth2/token/', headers={'Authorization': f'Bearer {token}'})
+                latencies.append(time.perf_counter() - start)
+                await asyncio.sleep(0.01)
+
+        async def login(i: int) -> int:
+            response = await client.post('/api/oauth2/token/', data={'username': 'user0@example.com', 'password': 'password', 'grant_type': 'password'})
+            return response.status_code
+
+        probe_task = asyncio.create_task(probe())
+        start = time.perf_counter()
+        codes = await asyncio.gather(*[login(i) for i in range(logins)])
+        elapsed = time.perf_counter() - start
+        done.set()
+        await probe_task
+    return elapsed, codes.count(200), codes.count(503), latencies
+
+
+def main(args) -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        # auth loads its config when it's imported
+        os.environ['CONFIG_PATH'] = os.path.join(tmp, 'budget.json')
+        os.environ['DB_PATH'] = os.path.join(tmp, 'bench.db')
+        with open(os.environ['CONFIG_PATH'], 'w') as fp:
+            json.dump({
+                'algorithm': 'HS256',
+                'access_token_key': 'access',
+                'refresh_token_key': 'refresh',
+                'access_token_ttl': 3600,
+                'refresh_token_ttl': 604800,
+                'users': {f'user{i}@example.com': {'api': 'rw', 'hash': ''} for i in range(args.users)},
+            }, fp)
+
+        from fastapi.testclient import TestClient
+        from auth import TokenCache, create_token, validate_access_token
+        import auth
+        import api
+
+        tokens = [create_token(user).access_token for user in auth.config['users']]
+        request = SimpleNamespace(method='GET')
+        client = TestClient(api.app)
+
+        print(f'{"cache":<10} {"validate (us)":>14} {"request (us)":>14}')
+        for name, cache in [('none', TokenCache(0)), ('lru', TokenCache())]:
+            auth.token_cache = cache
+
+            start = time.perf_counter()
+            for i in range(args.count):
+                validate_access_token(tokens[i % len(tokens)], request)  # type: ignore
+            validate_time = (time.perf_counter() - start) / args.count
+
+            start = time.perf_counter()
+            for i in range(args.requests):
+                client.get('/api/oauth2/token/', headers={'Authorization': f'Bearer {tokens[i % len(tokens)]}'})
+            request_time = (time.perf_counter() - start) / args.requests
+
+            print(f'{name:<10} {validate_time * 1e6:>14.1f} {request_time * 1e6:>14.1f}')
+
+        print()
+        print(f'{"rounds":>6} {"workers":>8} {"queue":>6} {"ok":>6} {"503":>6} {"logins/sec":>11} {"other p50 (ms)":>15} {"other max (ms)":>15}')
+        from passlib.context import CryptContext
+        for rounds in args.rounds:
+            auth.pwd_context = CryptContext(schemes=['bcrypt'], bcrypt__rounds=rounds)
+            auth.config['users']['user0@example.com']['hash'] = auth.hash_password('password')
+            for workers in args.workers:
+                api.password_verifier = auth.PasswordVerifier(workers, args.queue_size)
+                elapsed, ok, rejected, latencies = asyncio.run(login_burst(api.app, args.logins, tokens[0]))
+                print(f'{rounds:>6} {workers:>8} {args.queue_size:>6} {ok:>6} {rejected:>6} {ok / elapsed:>11.1f} '
+                      f'{statistics.median(latencies) * 1000:>15.1f} {max(latencies) * 1000:>15.1f}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark validating the access token of each request')
+    parser.add_argument('--users', type=int, default=4, help='The number of users, each with their own token')
+    parser.add_argument('--count', type=int, default=20000, help='The number of tokens to validate')
+    parser.add_argument('--requests', type=int, default=2000, help='The number of requests to make')
+    parser.add_argument('--logins', type=int, default=32, help='The number of logins in a burst')
+    parser.add_argument('--rounds', type=int, nargs='+', default=[10, 12], help='The bcrypt rounds to try')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='The password worker counts to try')
+    parser.add_argument('--queue-size', type=int, default=32, help='The number of logins that can wait for a worker')
+    sys.exit(main(parser.parse_args()))
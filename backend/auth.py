@@ -9,26 +9,132 @@
 # System imports
 import os
 import json
-from typing import Annotated
+import time
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
+from typing import Annotated, NamedTuple, Tuple
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer
 from calendar import timegm
 from datetime import datetime, timedelta
 from jose import jwt
 from passlib.context import CryptContext
-from typing import Optional
+from typing import Dict, Optional
 
 # Local imports
 from model import Token, CachedToken
-from database import Database
+from tokens import create_token_store
 
 
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='oauth2/token')
 with open(os.environ.get('CONFIG_PATH', 'budget.json')) as fp:
     config = json.load(fp)
 
 
+def create_password_context(options: Dict) -> CryptContext:
+    '''
+    Create the password hashing context. The first scheme hashes new
+    passwords, and hashes using the others are still verified, eg.
+    {"schemes": ["argon2", "bcrypt"], "argon2__memory_cost": 65536}
+
+    Args:
+        options: The CryptContext options from the config, which override the defaults
+
+    Returns:
+        The context
+    '''
+    return CryptContext(**{'schemes': ['bcrypt'], 'deprecated': 'auto', **options})
+
+
+pwd_context = create_password_context(config.get('password_hashing', {}))
+
+
+class VerifiedToken(NamedTuple):
+    username: str
+    api: str
+    expire: float
+    signer: Tuple[str, str]
+
+
+class TokenCache:
+    '''
+    A bounded LRU cache of access tokens that have already been verified, so
+    the signature of a token isn't checked again on every request. Tokens are
+    keyed by their SHA-256 hash, and are dropped when they expire, when the
+    signing key or algorithm changes, or when the permission of their user
+    changes.
+    '''
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.tokens: OrderedDict[bytes, VerifiedToken] = OrderedDict()
+
+    @staticmethod
+    def key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str, signer: Tuple[str, str]) -> Optional[VerifiedToken]:
+        '''
+        Get a verified token, if it's still valid
+
+        Args:
+            token: The encoded token
+            signer: The key and algorithm the token must have been signed with
+
+        Returns:
+            The verified token, or None if it needs to be verified
+        '''
+        key = TokenCache.key(token)
+        with self.lock:
+            verified = self.tokens.get(key)
+            if verified is None:
+                return None
+            user = config['users'].get(verified.username)
+            if verified.expire <= time.time() or verified.signer != signer or user is None or user['api'] != verified.api:
+                del self.tokens[key]
+                return None
+            self.tokens.move_to_end(key)
+            return verified
+
+    def put(self, token: str, verified: VerifiedToken) -> None:
+        '''
+        Add a verified token, evicting the least recently used if full
+
+        Args:
+            token: The encoded token
+            verified: The result of verifying it
+        '''
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.tokens[TokenCache.key(token)] = verified
+            self.tokens.move_to_end(TokenCache.key(token))
+            while len(self.tokens) > self.maxsize:
+                self.tokens.popitem(last=False)
+
+    def invalidate(self, username: Optional[str] = None) -> None:
+        '''
+        Drop the tokens of a user, or all tokens
+
+        Args:
+            username: The user, or None for every user
+        '''
+        with self.lock:
+            if username is None:
+                self.tokens.clear()
+            else:
+                for key in [key for key, verified in self.tokens.items() if verified.username == username]:
+                    del self.tokens[key]
+
+
+token_cache = TokenCache(config.get('token_cache_size', 1024))
+token_store = create_token_store(config)
+
+
 def verify_user(username: str, password: str) -> None:
     '''
     Verify a user. Will raise an error if the user is not valid
@@ -45,6 +151,57 @@ def verify_user(username: str, password: str) -> None:
         )
 
 
+class PasswordVerifier:
+    '''
+    Verifies passwords in a small pool of threads of its own, so a burst of
+    logins can't use up the threads shared by the rest of the API. Once as many
+    verifications are waiting as the pool can queue, more are turned away
+    straight away rather than left to time out.
+    '''
+
+    def __init__(self, workers: int = 2, queue_size: int = 8):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password')
+        self.limit = workers + queue_size
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def release(self, future: Future) -> None:
+        with self.lock:
+            self.pending -= 1
+
+    async def verify(self, username: str, password: str) -> None:
+        '''
+        Verify a user. Will raise an error if the user is not valid, or if too
+        many logins are already waiting
+
+        Args:
+            username: The name of the user
+            password: The password of the user
+        '''
+        with self.lock:
+            if self.pending >= self.limit:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail='Too many login attempts, try again shortly',
+                    headers={'Retry-After': '1'},
+                )
+            self.pending += 1
+
+        # The slot is only freed once the check is done, even if the client has
+        # gone, or straight away if the check can't be started
+        try:
+            future = self.executor.submit(verify_user, username, password)
+        except BaseException:
+            with self.lock:
+                self.pending -= 1
+            raise
+        future.add_done_callback(self.release)
+        await asyncio.wrap_future(future)
+
+
+password_verifier = PasswordVerifier(config.get('password_workers', 2), config.get('password_queue_size', 8))
+
+
 def hash_password(password: str) -> str:
     '''
     Hash a password for storage in a database
@@ -83,20 +240,27 @@ def create_token(user: str, refresh_token: Optional[str] = None) -> Token:
         token_type='bearer'
     )
 
-    with Database() as db:
-        db.add_cached_token(CachedToken(value=token.refresh_token, expire=timegm(utc_refresh_expire.utctimetuple())))
-        if refresh_token is not None:
-            db.clear_cached_token(refresh_token)
+    token_store.add(CachedToken(value=token.refresh_token, expire=timegm(utc_refresh_expire.utctimetuple())))
+    if refresh_token is not None:
+        token_store.remove(refresh_token)
 
     return token
 
 
-def validate_token(key: str, token: Annotated[str, Depends(oauth2_scheme)]) -> str:
+def validate_token(key: str, token: Annotated[str, Depends(oauth2_scheme)], cache: Optional[TokenCache] = None) -> str:
+    signer = (config[key], config['algorithm'])
+    if cache is not None:
+        verified = cache.get(token, signer)
+        if verified is not None:
+            return verified.username
+
     try:
         payload = jwt.decode(token, config[key], algorithms=config['algorithm'])
         username: str = payload.get('sub')
         if username not in config['users']:
             raise ValueError('Invalid username')
+        if cache is not None and 'exp' in payload:
+            cache.put(token, VerifiedToken(username, config['users'][username]['api'], payload['exp'], signer))
         return username
     except:
         raise HTTPException(
@@ -107,7 +271,7 @@ def validate_token(key: str, token: Annotated[str, Depends(oauth2_scheme)]) -> s
 
 
 def validate_access_token(token: Annotated[str, Depends(oauth2_scheme)], request: Request) -> str:
-    username = validate_token('access_token_key', token)
+    username = validate_token('access_token_key', token, token_cache)
     if request.method.upper() in ['PUT', 'POST', 'DELETE', 'PATCH']:
         # read/write access is required
         if config['users'][username]['api'] != 'rw':
@@ -131,17 +295,21 @@ def validate_refresh_token(token: Annotated[str, Depends(oauth2_scheme)]) -> str
 
 
 def get_cached_token(value: Annotated[str, Depends(oauth2_scheme)]) -> CachedToken:
-    with Database() as db:
-        token = db.get_cached_token(value)
-        if not token:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail='Incorrect token',
-                headers={'WWW-Authenticate': 'Bearer'},
-            )
-        return token
+    token = token_store.get(value)
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail='Incorrect token',
+            headers={'WWW-Authenticate': 'Bearer'},
+        )
+    return token
 
 
 def clear_cached_token(value: Annotated[str, Depends(oauth2_scheme)]) -> None:
-    with Database() as db:
-        db.clear_cached_token(value)
+    token_store.remove(value)
+
+    # Verified access tokens of the user have to be checked again
+    try:
+        token_cache.invalidate(jwt.get_unverified_claims(value).get('sub'))
+    except Exception:
+        pass
@@ -0,0 +1,109 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# categorise.bench.py: This file benchmarks the accuracy and speed of the
+# categorisation engines against a synthetic transaction history
+#
+
+# System imports
+import sys
+import time
+import random
+import argparse
+from typing import Dict, List, Tuple
+
+# Local imports
+from categorise import ENGINES, categorise_batch
+
+
+CATEGORIES = ['Groceries', 'General Spending', 'Dining/Take out', 'Transport', 'Medical', 'Utilities', 'Insurance', 'Entertainment']
+LOCATIONS = ['Sometown', 'Fooville', 'Barton', 'Qwerty', 'Online']
+WORDS = ['foo', 'bar', 'baz', 'qwerty', 'express', 'market', 'pty', 'ltd', 'corp', 'enterprises', 'fresh', 'city', 'north',
+         'south', 'plaza', 'store', 'services', 'direct', 'global', 'local', 'best', 'mart', 'fuel', 'cafe', 'kitchen']
+
+
+def random_description(rng: random.Random, merchant: str, location: str) -> str:
+    '''
+    Generate a bank-like description for a merchant, with the volatile card,
+    terminal and reference numbers that the scrapers see
+    '''
+    parts = [merchant.upper()]
+    if rng.random() < 0.5:
+        parts.append(str(rng.randint(1000, 9999)))
+    parts.append(location.upper())
+    parts.append('AU')
+    if rng.random() < 0.3:
+        parts.append(f'XXXX-XXXX-XXXX-{rng.randint(1000, 9999)}')
+    return ' '.join(parts)
+
+
+def generate(merchants: int, descriptions: int, queries: int, seed: int) -> Tuple[Dict, List[Tuple[str, str]]]:
+    '''
+    Generate a description map and a list of (query, expected category) pairs
+
+    Args:
+        merchants:    The number of distinct merchants
+        descriptions: The number of historical transactions
+        queries:      The number of queries to generate
+        seed:         The random seed
+
+    Returns:
+        The description map and the list of queries
+    '''
+    rng = random.Random(seed)
+    merchant_list = []
+    for _ in range(merchants):
+        name = ' '.join(rng.sample(WORDS, rng.randint(2, 3)))
+        merchant_list.append((name, rng.choice(CATEGORIES), rng.choice(LOCATIONS)))
+
+    descr_map: Dict[str, Dict] = {}
+    for _ in range(descriptions):
+        name, category, location = rng.choice(merchant_list)
+        descr = random_description(rng, name, location).lower()
+        data = descr_map.setdefault(descr, {'categories': {}, 'locations': {}})
+        data['categories'][category] = data['categories'].get(category, 0) + 1
+        data['locations'][location] = data['locations'].get(location, 0) + 1
+
+    query_list = []
+    for _ in range(queries):
+        name, category, location = rng.choice(merchant_list)
+        query_list.append((random_description(rng, name, location), category))
+
+    return descr_map, query_list
+
+
+def main(args) -> int:
+    descr_map, queries = generate(args.merchants, args.descriptions, args.queries, args.seed)
+    print(f'{len(descr_map)} distinct descriptions, {len(queries)} queries')
+    print(f'{"engine":<15} {"build (s)":>10} {"per query (ms)":>15} {"batched (ms)":>13} {"accuracy":>10}')
+    for name, engine in ENGINES.items():
+        start = time.perf_counter()
+        categoriser = engine(descr_map, ['Unknown', *CATEGORIES], ['Unknown', *LOCATIONS])
+        build_time = time.perf_counter() - start
+
+        correct = 0
+        start = time.perf_counter()
+        for query, expected in queries:
+            if categoriser.categorise(query).categories[0].name == expected:
+                correct += 1
+        query_time = (time.perf_counter() - start) / len(queries)
+
+        start = time.perf_counter()
+        categorise_batch(categoriser, [query for query, _ in queries], args.workers, 1)
+        batch_time = (time.perf_counter() - start) / len(queries)
+
+        print(f'{name:<15} {build_time:>10.3f} {query_time * 1000:>15.3f} {batch_time * 1000:>13.3f} {correct / len(queries):>10.1%}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the categorisation engines')
+    parser.add_argument('--merchants', type=int, default=500, help='The number of distinct merchants')
+    parser.add_argument('--descriptions', type=int, default=5000, help='The number of historical transactions')
+    parser.add_argument('--queries', type=int, default=100, help='The number of descriptions to categorise')
+    parser.add_argument('--workers', type=int, default=1, help='The number of processes to use for the batched run')
+    parser.add_argument('--seed', type=int, default=1, help='The random seed')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,727 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# categorise.py: This file implements the engines that suggest a category and
+# location for a transaction description
+#
+
+# System imports
+import os
+import json
+import math
+import mmap
+import struct
+import difflib
+import hashlib
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Type, Optional, Tuple
+import numpy as np
+
+# Local imports
+from model import Categorisation, Score
+from database import Database
+from merchant import MerchantNormaliser
+
+
+def candidate_score(ratio: float, count: int) -> float:
+    '''
+    Get the score a single historical description contributes to a category/location
+
+    Args:
+        ratio: The similarity of the description to the candidate (0 to 1)
+        count: The number of times the candidate was assigned the category/location
+
+    Returns:
+        The score contribution
+    '''
+    score = ratio * ratio * math.sqrt(count)
+    if ratio == 1:
+        score *= 10
+    return score
+
+
+def rank_scores(names: List[str], scores: List[float], ratios: List[float]) -> List[Score]:
+    '''
+    Rank a list of names by score, normalised so the best name has a score
+    equal to the best ratio that contributed to it
+
+    Args:
+        names:  The category/location names
+        scores: The accumulated score of each name
+        ratios: The best ratio that contributed to each name
+
+    Returns:
+        The list of scores, sorted from best to worst
+    '''
+    order = sorted(range(len(names)), key=lambda i: scores[i], reverse=True)
+    if not order:
+        return []
+    best_score = scores[order[0]]
+    best_ratio = ratios[order[0]]
+    return [Score(name=names[i], score=0.0 if best_score == 0 else float(scores[i] / best_score * best_ratio)) for i in order]
+
+
+def description_hash(description: bytes) -> int:
+    '''
+    Get a stable 64-bit hash of an encoded description
+
+    Args:
+        description: The UTF-8 encoded description
+
+    Returns:
+        The hash value
+    '''
+    return int.from_bytes(hashlib.blake2b(description, digest_size=8).digest(), 'little')
+
+
+def ngrams(text: str, n: int = 3) -> List[str]:
+    '''
+    Split some text into overlapping character n-grams
+
+    Args:
+        text: The text to split
+        n:    The size of each n-gram
+
+    Returns:
+        The list of n-grams
+    '''
+    text = f' {text} '
+    if len(text) <= n:
+        return [text]
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+
+class Categoriser(ABC):
+    '''
+    The base class for a categorisation engine. An engine is built once from a
+    description map, and can then score any number of descriptions against it.
+    '''
+
+    def __init__(self, descr_map: Dict, categories: List[str], locations: List[str]):
+        self.categories = sorted(set(categories) - {'Unknown'})
+        self.locations = sorted(set(locations) - {'Unknown'})
+        self.category_index = {name: i for i, name in enumerate(self.categories)}
+        self.location_index = {name: i for i, name in enumerate(self.locations)}
+        self.normaliser: Optional[MerchantNormaliser] = None
+
+    @classmethod
+    def from_database(cls, db) -> 'Categoriser':
+        '''
+        Build a categoriser from the merchants in the database
+
+        Args:
+            db: The database object
+
+        Returns:
+            The categoriser
+        '''
+        res = cls(db.get_merchant_map(), db.get_category_list(), db.get_location_list())
+        res.normaliser = Database.normaliser
+        return res
+
+    def key(self, description: str) -> str:
+        '''
+        Get the key a description is looked up by. This is the merchant name for
+        categorisers built from the database, otherwise just the lower case description
+
+        Args:
+            description: The transaction description
+
+        Returns:
+            The key
+        '''
+        return self.normaliser.normalise(description) if self.normaliser else description.lower()
+
+    @abstractmethod
+    def categorise(self, description: str) -> Categorisation:
+        '''
+        Score all the categories and locations for a description
+
+        Args:
+            description: The transaction description
+
+        Returns:
+            The categories and locations sorted from best to worst
+        '''
+
+    def categorise_batch(self, descriptions: List[str]) -> List[Categorisation]:
+        '''
+        Score all the categories and locations for a list of descriptions
+
+        Args:
+            descriptions: The transaction descriptions
+
+        Returns:
+            The categorisation of each description, in the same order
+        '''
+        return [self.categorise(description) for description in descriptions]
+
+
+class DifflibCategoriser(Categoriser):
+    '''
+    A categoriser that compares a description to every historical description
+    using difflib.SequenceMatcher
+    '''
+
+    def __init__(self, descr_map: Dict, categories: List[str], locations: List[str]):
+        super().__init__(descr_map, categories, locations)
+        self.descr_map = descr_map
+
+    def categorise(self, description: str) -> Categorisation:
+        description = self.key(description)
+        category_scores = [0.0] * len(self.categories)
+        category_ratios = [0.0] * len(self.categories)
+        location_scores = [0.0] * len(self.locations)
+        location_ratios = [0.0] * len(self.locations)
+        for candidate_description, candidate_data in self.descr_map.items():
+            ratio = difflib.SequenceMatcher(a=description, b=candidate_description).ratio()
+            for category, count in candidate_data['categories'].items():
+                if category in self.category_index:
+                    i = self.category_index[category]
+                    category_scores[i] += candidate_score(ratio, count)
+                    category_ratios[i] = max(ratio, category_ratios[i])
+
+            for location, count in candidate_data['locations'].items():
+                if location in self.location_index:
+                    i = self.location_index[location]
+                    location_scores[i] += candidate_score(ratio, count)
+                    location_ratios[i] = max(ratio, location_ratios[i])
+
+        return Categorisation(categories=rank_scores(self.categories, category_scores, category_ratios),
+                              locations=rank_scores(self.locations, location_scores, location_ratios))
+
+    def categorise_batch(self, descriptions: List[str]) -> List[Categorisation]:
+        # SequenceMatcher caches its analysis of the second sequence, so make
+        # each candidate the second sequence and compare every query against it
+        descriptions = [self.key(description) for description in descriptions]
+        category_scores = [[0.0] * len(self.categories) for _ in descriptions]
+        category_ratios = [[0.0] * len(self.categories) for _ in descriptions]
+        location_scores = [[0.0] * len(self.locations) for _ in descriptions]
+        location_ratios = [[0.0] * len(self.locations) for _ in descriptions]
+        matcher = difflib.SequenceMatcher()
+        for candidate_description, candidate_data in self.descr_map.items():
+            matcher.set_seq2(candidate_description)
+            categories = [(self.category_index[k], v) for k, v in candidate_data['categories'].items() if k in self.category_index]
+            locations = [(self.location_index[k], v) for k, v in candidate_data['locations'].items() if k in self.location_index]
+            for q, description in enumerate(descriptions):
+                matcher.set_seq1(description)
+                ratio = matcher.ratio()
+                for i, count in categories:
+                    category_scores[q][i] += candidate_score(ratio, count)
+                    category_ratios[q][i] = max(ratio, category_ratios[q][i])
+                for i, count in locations:
+                    location_scores[q][i] += candidate_score(ratio, count)
+                    location_ratios[q][i] = max(ratio, location_ratios[q][i])
+
+        return [Categorisation(categories=rank_scores(self.categories, category_scores[q], category_ratios[q]),
+                               locations=rank_scores(self.locations, location_scores[q], location_ratios[q]))
+                for q in range(len(descriptions))]
+
+
+class PrunedDifflibCategoriser(DifflibCategoriser):
+    '''
+    A difflib categoriser that visits candidates in order of a cheap upper bound
+    on their ratio, and skips the full ratio computation for candidates while
+    all of the skipped ones together can't move a normalised category/location
+    score by more than TOLERANCE
+    '''
+    TOLERANCE = 0.01
+
+    def __init__(self, descr_map: Dict, categories: List[str], locations: List[str]):
+        super().__init__(descr_map, categories, locations)
+        self.candidates = []
+        for candidate_description, candidate_data in descr_map.items():
+            categories_list = [(self.category_index[k], v) for k, v in candidate_data['categories'].items() if k in self.category_index]
+            locations_list = [(self.location_index[k], v) for k, v in candidate_data['locations'].items() if k in self.location_index]
+            if categories_list or locations_list:
+                self.candidates.append((candidate_description, categories_list, locations_list,
+                                        math.sqrt(max((c for _, c in categories_list), default=0)),
+                                        math.sqrt(max((c for _, c in locations_list), default=0))))
+        self.category_max = max((c[3] for c in self.candidates), default=0.0)
+        self.location_max = max((c[4] for c in self.candidates), default=0.0)
+        self.stats: Dict[str, int] = {}
+
+    def categorise(self, description: str) -> Categorisation:
+        description = self.key(description)
+        category_scores = [0.0] * len(self.categories)
+        category_ratios = [0.0] * len(self.categories)
+        location_scores = [0.0] * len(self.locations)
+        location_ratios = [0.0] * len(self.locations)
+        stats = {'computed': 0, 'skipped_quick_ratio': 0, 'skipped_bound': 0}
+
+        # The length bound is the same as real_quick_ratio, but doesn't need a matcher
+        la = len(description)
+        bounds = [0.0 if la + len(c[0]) == 0 else 2.0 * min(la, len(c[0])) / (la + len(c[0])) for c in self.candidates]
+        order = sorted(range(len(self.candidates)), key=lambda i: bounds[i], reverse=True)
+
+        # The most that all the candidates from each position on could add to
+        # any one category/location
+        category_remaining = [0.0] * (len(order) + 1)
+        location_remaining = [0.0] * (len(order) + 1)
+        for k in range(len(order) - 1, -1, -1):
+            i = order[k]
+            category_remaining[k] = category_remaining[k + 1] + bounds[i] * bounds[i] * self.candidates[i][3]
+            location_remaining[k] = location_remaining[k + 1] + bounds[i] * bounds[i] * self.candidates[i][4]
+
+        # The most that the candidates skipped so far could have added
+        category_skipped = 0.0
+        location_skipped = 0.0
+        category_best = 0.0
+        location_best = 0.0
+        matcher = difflib.SequenceMatcher(a=description)
+        for k, i in enumerate(order):
+            candidate_description, candidate_categories, candidate_locations, category_max, location_max = self.candidates[i]
+            bound = bounds[i]
+            if bound < 1 and category_skipped + category_remaining[k] <= self.TOLERANCE * category_best and \
+                    location_skipped + location_remaining[k] <= self.TOLERANCE * location_best:
+                # None of the remaining candidates can make a difference, even all together
+                stats['skipped_bound'] = len(order) - k
+                break
+
+            matcher.set_seq2(candidate_description)
+            if category_skipped < self.TOLERANCE * category_best and location_skipped < self.TOLERANCE * location_best:
+                # Only worth a closer bound while there is room left to skip candidates
+                bound = matcher.quick_ratio()
+            if bound < 1 and category_skipped + bound * bound * category_max <= self.TOLERANCE * category_best and \
+                    location_skipped + bound * bound * location_max <= self.TOLERANCE * location_best:
+                category_skipped += bound * bound * category_max
+                location_skipped += bound * bound * location_max
+                stats['skipped_quick_ratio'] += 1
+                continue
+
+            ratio = matcher.ratio()
+            stats['computed'] += 1
+            for j, count in candidate_categories:
+                category_scores[j] += candidate_score(ratio, count)
+                category_ratios[j] = max(ratio, category_ratios[j])
+                category_best = max(category_best, category_scores[j])
+            for j, count in candidate_locations:
+                location_scores[j] += candidate_score(ratio, count)
+                location_ratios[j] = max(ratio, location_ratios[j])
+                location_best = max(location_best, location_scores[j])
+
+        self.stats = stats
+        logging.debug('Categorised "%s" against %d candidates: %d full ratios, %d skipped by quick_ratio, %d skipped by length bound',
+                      description, len(order), stats['computed'], stats['skipped_quick_ratio'], stats['skipped_bound'])
+        return Categorisation(categories=rank_scores(self.categories, category_scores, category_ratios),
+                              locations=rank_scores(self.locations, location_scores, location_ratios))
+
+    def categorise_batch(self, descriptions: List[str]) -> List[Categorisation]:
+        # Pruning depends on the query, so there is no work to share between them
+        return [self.categorise(description) for description in descriptions]
+
+
+class TfidfCategoriser(Categoriser):
+    '''
+    A categoriser that represents the historical descriptions as a sparse matrix
+    of character n-gram TF-IDF weights, and scores a description against all of
+    them with a single matrix-vector product.
+
+    All of the state is kept in flat arrays, so it can be saved to an index file
+    and memory mapped back in by any number of processes.
+    '''
+    NGRAM_SIZE = 3
+    BATCH_ELEMENTS = 1 << 22
+    INDEX_MAGIC = b'BUDGETIX'
+    INDEX_ARRAYS = ['terms', 'idf', 'rows', 'cols', 'tf', 'weights', 'row_ptr', 'term_ptr', 'term_docs', 'term_weights',
+                    'descr_blob', 'descr_ptr', 'descr_hashes', 'descr_order',
+                    'category_cand', 'category_ids', 'category_counts', 'location_cand', 'location_ids', 'location_counts']
+
+    def __init__(self, descr_map: Dict, categories: List[str], locations: List[str], previous: Optional['TfidfCategoriser'] = None):
+        '''
+        Args:
+            descr_map:  The map of descriptions to the categories/locations assigned to them
+            categories: The list of all category names
+            locations:  The list of all location names
+            previous:   An older categoriser, whose n-gram counts are reused for
+                        descriptions that haven't changed
+        '''
+        super().__init__(descr_map, categories, locations)
+        self.version = 0
+        descriptions = list(descr_map.keys())
+        self.ndocs = len(descriptions)
+
+        # Intern the descriptions into a single blob, with a sorted hash table for exact lookups
+        encoded = [descr.encode() for descr in descriptions]
+        self.descr_blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        self.descr_ptr = np.concatenate(([0], np.cumsum([len(e) for e in encoded], dtype=np.int64))).astype(np.int64)
+        hashes = np.array([description_hash(e) for e in encoded], dtype=np.uint64)
+        self.descr_order = np.argsort(hashes, kind='stable').astype(np.int64)
+        self.descr_hashes = hashes[self.descr_order]
+
+        # Count the n-grams of each description
+        all_terms: List[bytes] = []
+        rows: List[int] = []
+        tf: List[int] = []
+        for row, descr in enumerate(descriptions):
+            prev_row = previous.find(descr) if previous is not None else -1
+            if prev_row >= 0:
+                assert previous is not None
+                start, end = previous.row_ptr[prev_row], previous.row_ptr[prev_row + 1]
+                terms = previous.terms[previous.cols[start:end]].tolist()
+                counts = previous.tf[start:end].tolist()
+            else:
+                counter = Counter(ngrams(descr, self.NGRAM_SIZE))
+                terms = [term.encode() for term in counter.keys()]
+                counts = list(counter.values())
+            all_terms.extend(terms)
+            tf.extend(counts)
+            rows.extend([row] * len(terms))
+
+        # Build the term frequency matrix in coordinate format, with a sorted vocabulary
+        terms_array, cols = np.unique(np.array(all_terms, dtype=np.bytes_), return_inverse=True)
+        self.terms: np.ndarray = terms_array
+        self.cols: np.ndarray = cols.reshape(-1).astype(np.int32)
+        self.rows = np.array(rows, dtype=np.int32)
+        self.tf: np.ndarray = np.array(tf, dtype=np.int32)
+        self.row_ptr: np.ndarray = np.searchsorted(self.rows, np.arange(self.ndocs + 1)).astype(np.int64)
+
+        # Weight by the smoothed inverse document frequency and normalise each row
+        doc_freq = np.bincount(self.cols, minlength=len(self.terms))
+        self.idf = np.log((1 + self.ndocs) / (1 + doc_freq)) + 1
+        self.unknown_idf = math.log(1 + self.ndocs) + 1
+        weights = self.tf * self.idf[self.cols]
+        norms = np.sqrt(np.bincount(self.rows, weights=weights * weights, minlength=self.ndocs))
+        self.weights = weights / np.where(norms > 0, norms, 1)[self.rows]
+
+        # Build the postings for each term, so a batch only touches the
+        # historical descriptions that share at least one term with a query
+        order = np.argsort(self.cols, kind='stable')
+        self.term_docs = self.rows[order]
+        self.term_weights = self.weights[order]
+        self.term_ptr = np.concatenate(([0], np.cumsum(doc_freq))).astype(np.int64)
+
+        # Build the candidate to category/location counts in coordinate format
+        self.category_cand, self.category_ids, self.category_counts = self._build_counts(descr_map, descriptions, 'categories', self.category_index)
+        self.location_cand, self.location_ids, self.location_counts = self._build_counts(descr_map, descriptions, 'locations', self.location_index)
+
+    def _build_counts(self, descr_map: Dict, descriptions: List[str], key: str, index: Dict[str, int]):
+        cand: List[int] = []
+        ids: List[int] = []
+        counts: List[int] = []
+        for row, descr in enumerate(descriptions):
+            for name, count in descr_map[descr][key].items():
+                if name in index:
+                    cand.append(row)
+                    ids.append(index[name])
+                    counts.append(count)
+        return np.array(cand, dtype=np.int32), np.array(ids, dtype=np.int32), np.sqrt(np.array(counts, dtype=np.float64))
+
+    def description(self, row: int) -> str:
+        '''
+        Get one of the historical descriptions
+
+        Args:
+            row: The index of the description
+
+        Returns:
+            The description
+        '''
+        return self.descr_blob[self.descr_ptr[row]:self.descr_ptr[row + 1]].tobytes().decode()
+
+    def find(self, description: str) -> int:
+        '''
+        Find the index of a historical description
+
+        Args:
+            description: The description to find
+
+        Returns:
+            The index of the description, or -1 if it doesn't exist
+        '''
+        encoded = description.encode()
+        value = description_hash(encoded)
+        pos = int(np.searchsorted(self.descr_hashes, np.uint64(value)))
+        while pos < self.ndocs and self.descr_hashes[pos] == value:
+            row = int(self.descr_order[pos])
+            if self.descr_blob[self.descr_ptr[row]:self.descr_ptr[row + 1]].tobytes() == encoded:
+                return row
+            pos += 1
+        return -1
+
+    def query_terms(self, description: str) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Get the normalised TF-IDF weights of a description
+
+        Args:
+            description: The transaction description
+
+        Returns:
+            A tuple of the vocabulary ids and the weights of the known terms
+        '''
+        counter = Counter(ngrams(description, self.NGRAM_SIZE))
+        terms = [term.encode() for term in counter.keys()]
+        tf = np.array(list(counter.values()), dtype=np.float64)
+        query = np.array(terms, dtype=np.bytes_)
+        ids = np.zeros(len(terms), dtype=np.int64)
+        known = np.zeros(len(terms), dtype=bool)
+        if len(self.terms):
+            ids = np.minimum(np.searchsorted(self.terms, query), len(self.terms) - 1)
+            fits = np.array([len(term) <= self.terms.dtype.itemsize for term in terms])
+            known = (self.terms[ids] == query) & fits
+
+        weights = tf[known] * self.idf[ids[known]]
+        unknown = tf[~known] * self.unknown_idf
+        norm = math.sqrt(float(np.dot(weights, weights)) + float(np.dot(unknown, unknown)))
+        if norm > 0:
+            weights /= norm
+        return ids[known], weights
+
+    def similarity(self, description: str) -> np.ndarray:
+        '''
+        Get the cosine similarity of a description to every historical description
+
+        Args:
+            description: The transaction description
+
+        Returns:
+            An array of similarities, indexed the same as the historical descriptions
+        '''
+        query = np.zeros(len(self.terms))
+        ids, weights = self.query_terms(description)
+        query[ids] = weights
+        return np.minimum(np.bincount(self.rows, weights=self.weights * query[self.cols], minlength=self.ndocs), 1.0)
+
+    def similarity_batch(self, descriptions: List[str]) -> np.ndarray:
+        '''
+        Get the cosine similarity of many descriptions to every historical description
+
+        Args:
+            descriptions: The transaction descriptions
+
+        Returns:
+            A matrix of similarities, with a row per description
+        '''
+        res = np.zeros((len(descriptions), self.ndocs))
+        if self.ndocs == 0:
+            return res
+
+        chunk = max(1, self.BATCH_ELEMENTS // self.ndocs)
+        for start in range(0, len(descriptions), chunk):
+            query_rows: List[np.ndarray] = []
+            query_ids: List[np.ndarray] = []
+            query_weights: List[np.ndarray] = []
+            for i, description in enumerate(descriptions[start:start + chunk]):
+                ids, weights = self.query_terms(description)
+                query_rows.append(np.full(len(ids), i, dtype=np.int64))
+                query_ids.append(ids)
+                query_weights.append(weights)
+            rows = np.concatenate(query_rows)
+            ids = np.concatenate(query_ids)
+
+            # Gather the postings of every query term in one go
+            starts = self.term_ptr[ids]
+            lengths = self.term_ptr[ids + 1] - starts
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            weights = self.term_weights[offsets] * np.repeat(np.concatenate(query_weights), lengths)
+            nqueries = len(query_rows)
+            products = np.bincount(np.repeat(rows, lengths) * self.ndocs + self.term_docs[offsets], weights=weights, minlength=nqueries * self.ndocs)
+            res[start:start + nqueries] = products.reshape(nqueries, self.ndocs)
+        return np.minimum(res, 1.0)
+
+    def save(self, path: str, version: int) -> None:
+        '''
+        Save the categoriser to an index file. The file is written to a temporary
+        path first and then renamed, so readers never see a partial index.
+
+        Args:
+            path:    The path of the index file
+            version: The version of the description map the index was built from
+        '''
+        header: Dict = {
+            'version': version,
+            'ngram_size': self.NGRAM_SIZE,
+            'ndocs': self.ndocs,
+            'unknown_idf': self.unknown_idf,
+            'normalised': self.normaliser is not None,
+            'categories': self.categories,
+            'locations': self.locations,
+            'arrays': {},
+        }
+        arrays = [(name, np.ascontiguousarray(getattr(self, name))) for name in self.INDEX_ARRAYS]
+        offset = 0
+        for name, array in arrays:
+            header['arrays'][name] = [offset, array.dtype.str, list(array.shape)]
+            offset += -(-array.nbytes // 8) * 8
+
+        header_bytes = json.dumps(header).encode()
+        header_bytes += b' ' * (-len(header_bytes) % 8)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(self.INDEX_MAGIC)
+            fp.write(struct.pack('<Q', len(header_bytes)))
+            fp.write(header_bytes)
+            for _, array in arrays:
+                fp.write(array.tobytes())
+                fp.write(b'\0' * (-array.nbytes % 8))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'TfidfCategoriser':
+        '''
+        Load a categoriser from an index file. The arrays are memory mapped, so
+        processes that load the same file share its pages.
+
+        Args:
+            path: The path of the index file
+
+        Returns:
+            The categoriser
+        '''
+        with open(path, 'rb') as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if buf[:len(cls.INDEX_MAGIC)] != cls.INDEX_MAGIC:
+            raise ValueError(f'Invalid categorisation index: {path}')
+        header_len = struct.unpack_from('<Q', buf, len(cls.INDEX_MAGIC))[0]
+        data_start = len(cls.INDEX_MAGIC) + 8 + header_len
+        header = json.loads(buf[len(cls.INDEX_MAGIC) + 8:data_start])
+        if header['ngram_size'] != cls.NGRAM_SIZE:
+            raise ValueError(f'Incompatible categorisation index: {path}')
+
+        res = cls.__new__(cls)
+        Categoriser.__init__(res, {}, header['categories'], header['locations'])
+        res.version = header['version']
+        res.ndocs = header['ndocs']
+        res.unknown_idf = header['unknown_idf']
+        if header['normalised']:
+            res.normaliser = Database.normaliser
+        for name, (offset, dtype, shape) in header['arrays'].items():
+            count = int(np.prod(shape))
+            array = np.frombuffer(buf, dtype=dtype, count=count, offset=data_start + offset) if count else np.zeros(shape, dtype=dtype)
+            setattr(res, name, array.reshape(shape))
+        return res
+
+    def _aggregate(self, ratio: np.ndarray, boost: np.ndarray, cand: np.ndarray, ids: np.ndarray, counts: np.ndarray, nnames: int):
+        scores = np.bincount(ids, weights=ratio[cand] * ratio[cand] * counts * boost[cand], minlength=nnames)
+        ratios = np.zeros(nnames)
+        np.maximum.at(ratios, ids, ratio[cand])
+        return scores.tolist(), ratios.tolist()
+
+    def categorise(self, description: str) -> Categorisation:
+        description = self.key(description)
+        return self._categorise_ratio(description, self.similarity(description))
+
+    def categorise_batch(self, descriptions: List[str]) -> List[Categorisation]:
+        descriptions = [self.key(description) for description in descriptions]
+        ratios = self.similarity_batch(descriptions)
+        return [self._categorise_ratio(description, ratio) for description, ratio in zip(descriptions, ratios)]
+
+    def _categorise_ratio(self, description: str, ratio: np.ndarray) -> Categorisation:
+        boost = np.ones(self.ndocs)
+        row = self.find(description)
+        if row >= 0:
+            # Exact matches count 10 times as much, as they do for difflib
+            ratio[row] = 1.0
+            boost[row] = 10.0
+
+        category_scores, category_ratios = self._aggregate(ratio, boost, self.category_cand, self.category_ids, self.category_counts, len(self.categories))
+        location_scores, location_ratios = self._aggregate(ratio, boost, self.location_cand, self.location_ids, self.location_counts, len(self.locations))
+        return Categorisation(categories=rank_scores(self.categories, category_scores, category_ratios),
+                              locations=rank_scores(self.locations, location_scores, location_ratios))
+
+
+class CategoriserIndex:
+    '''
+    Keeps a TF-IDF categoriser in sync with the database through a shared index
+    file. The index is only rebuilt when the merchant map version in the
+    database changes, and a rebuild reuses the n-gram counts of the old index.
+    '''
+    PATH = os.environ.get('INDEX_PATH') or Database.DB_PATH + '.idx'
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or CategoriserIndex.PATH
+        self.categoriser: Optional[TfidfCategoriser] = None
+        self.file_id: Optional[Tuple] = None
+        self.lock = threading.Lock()
+
+    def _load(self) -> None:
+        try:
+            stat = os.stat(self.path)
+            file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if file_id != self.file_id:
+                self.categoriser = TfidfCategoriser.load(self.path)
+                self.file_id = file_id
+        except FileNotFoundError:
+            # The index hasn't been built yet
+            pass
+        except (OSError, ValueError, KeyError) as exc:
+            logging.warning('Failed to load the categoriser index %s, rebuilding it: %s', self.path, exc)
+
+    def get(self, db) -> TfidfCategoriser:
+        '''
+        Get a categoriser that is up to date with the database
+
+        Args:
+            db: The database object
+
+        Returns:
+            The categoriser
+        '''
+        version = db.get_description_map_version()
+        with self.lock:
+            if self.categoriser is None or self.categoriser.version != version:
+                # Another process may have already rebuilt the index
+                self._load()
+            if self.categoriser is None or self.categoriser.version != version:
+                self._rebuild(db, version)
+            assert self.categoriser is not None
+            return self.categoriser
+
+    def _rebuild(self, db, version: int) -> None:
+        categoriser = TfidfCategoriser(db.get_merchant_map(), db.get_category_list(), db.get_location_list(), self.categoriser)
+        categoriser.normaliser = Database.normaliser
+        categoriser.save(self.path, version)
+        self.file_id = None
+        self._load()
+
+
+ENGINES: Dict[str, Type[Categoriser]] = {
+    'difflib': DifflibCategoriser,
+    'difflib_pruned': PrunedDifflibCategoriser,
+    'tfidf': TfidfCategoriser,
+}
+
+
+_worker_categoriser: Optional[Categoriser] = None
+
+
+def _init_worker(categoriser: Categoriser) -> None:
+    global _worker_categoriser
+    _worker_categoriser = categoriser
+
+
+def _categorise_chunk(descriptions: List[str]) -> List[Categorisation]:
+    assert _worker_categoriser is not None
+    return _worker_categoriser.categorise_batch(descriptions)
+
+
+def categorise_batch(categoriser: Categoriser, descriptions: List[str], workers: int = 1, parallel_min: int = 1000) -> List[Categorisation]:
+    '''
+    Categorise a batch of descriptions, fanning out across a process pool when
+    the batch is large enough to be worth the cost of starting the workers
+
+    Args:
+        categoriser:  The categoriser to use
+        descriptions: The transaction descriptions
+        workers:      The maximum number of worker processes
+        parallel_min: The smallest batch that will use the process pool
+
+    Returns:
+        The categorisation of each description, in the same order
+    '''
+    if workers <= 1 or len(descriptions) < parallel_min:
+        return categoriser.categorise_batch(descriptions)
+
+    size = math.ceil(len(descriptions) / workers)
+    chunks = [descriptions[i:i + size] for i in range(0, len(descriptions), size)]
+    res: List[Categorisation] = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(categoriser,)) as pool:
+        for chunk_res in pool.map(_categorise_chunk, chunks):
+            res.extend(chunk_res)
+    return res
@@ -0,0 +1,178 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# categorise.test.py: This file contains the unit tests for the categorisation
+# engines
+#
+
+# System imports
+import os
+import tempfile
+import unittest
+from typing import Dict
+
+# Local imports
+from categorise import ENGINES, CategoriserIndex, DifflibCategoriser, PrunedDifflibCategoriser, TfidfCategoriser, categorise_batch
+
+
+class TestCategorise(unittest.TestCase):
+    def setUp(self) -> None:
+        self.descr_map: Dict[str, Dict] = {
+            'woolworths 1234 sometown au': {'categories': {'Groceries': 3}, 'locations': {'Sometown': 3}},
+            'woolworths 5678 fooville au': {'categories': {'Groceries': 2}, 'locations': {'Fooville': 2}},
+            'petrol express 1830 sometown au': {'categories': {'Transport': 4}, 'locations': {'Sometown': 4}},
+            'menulog pty ltd sydney au': {'categories': {'Dining/Take out': 2, 'Unknown': 1}, 'locations': {'Online': 2, 'Unknown': 1}},
+        }
+        self.categories = ['Unknown', 'Groceries', 'Transport', 'Dining/Take out', 'Medical']
+        self.locations = ['Unknown', 'Sometown', 'Fooville', 'Online']
+        return super().setUp()
+
+    def test_best_category_and_location(self) -> None:
+        for name, engine in ENGINES.items():
+            with self.subTest(engine=name):
+                categoriser = engine(self.descr_map, self.categories, self.locations)
+                res = categoriser.categorise('WOOLWORTHS 9999 FOOVILLE AU')
+                self.assertEqual(res.categories[0].name, 'Groceries')
+                self.assertEqual(res.locations[0].name, 'Fooville')
+                res = categoriser.categorise('PETROL EXPRESS 2000 SOMETOWN AU')
+                self.assertEqual(res.categories[0].name, 'Transport')
+                self.assertEqual(res.locations[0].name, 'Sometown')
+
+    def test_unknown_is_never_suggested(self) -> None:
+        for name, engine in ENGINES.items():
+            with self.subTest(engine=name):
+                res = engine(self.descr_map, self.categories, self.locations).categorise('menulog pty ltd sydney au')
+                self.assertNotIn('Unknown', [score.name for score in res.categories])
+                self.assertNotIn('Unknown', [score.name for score in res.locations])
+                self.assertEqual(len(res.categories), len(self.categories) - 1)
+                self.assertEqual(len(res.locations), len(self.locations) - 1)
+
+    def test_exact_match_scores_one(self) -> None:
+        for name, engine in ENGINES.items():
+            with self.subTest(engine=name):
+                res = engine(self.descr_map, self.categories, self.locations).categorise('Petrol Express 1830 Sometown AU')
+                self.assertEqual(res.categories[0].name, 'Transport')
+                self.assertAlmostEqual(res.categories[0].score, 1.0)
+
+    def test_empty_description_map(self) -> None:
+        for name, engine in ENGINES.items():
+            with self.subTest(engine=name):
+                res = engine({}, self.categories, self.locations).categorise('anything')
+                self.assertEqual(len(res.categories), len(self.categories) - 1)
+                self.assertTrue(all(score.score == 0 for score in res.categories))
+                self.assertTrue(all(score.score == 0 for score in res.locations))
+
+    def test_engines_agree_on_ranking(self) -> None:
+        difflib_res = DifflibCategoriser(self.descr_map, self.categories, self.locations).categorise('woolworths 1234 sometown')
+        tfidf_res = TfidfCategoriser(self.descr_map, self.categories, self.locations).categorise('woolworths 1234 sometown')
+        self.assertEqual(difflib_res.categories[0].name, tfidf_res.categories[0].name)
+        self.assertEqual(difflib_res.locations[0].name, tfidf_res.locations[0].name)
+
+    def test_batch_matches_single(self) -> None:
+        descriptions = ['WOOLWORTHS 9999 FOOVILLE AU', 'petrol express 1830 sometown au', 'menulog', '']
+        for name, engine in ENGINES.items():
+            with self.subTest(engine=name):
+                categoriser = engine(self.descr_map, self.categories, self.locations)
+                for batch_res, descr in zip(categoriser.categorise_batch(descriptions), descriptions):
+                    single_res = categoriser.categorise(descr)
+                    self.assertEqual([s.name for s in batch_res.categories], [s.name for s in single_res.categories])
+                    self.assertEqual([s.name for s in batch_res.locations], [s.name for s in single_res.locations])
+                    for a, b in zip(batch_res.categories + batch_res.locations, single_res.categories + single_res.locations):
+                        self.assertAlmostEqual(a.score, b.score)
+
+    def test_batch_process_pool(self) -> None:
+        categoriser = TfidfCategoriser(self.descr_map, self.categories, self.locations)
+        descriptions = ['WOOLWORTHS 9999 FOOVILLE AU', 'PETROL EXPRESS 2000 SOMETOWN AU'] * 5
+        res = categorise_batch(categoriser, descriptions, workers=2, parallel_min=2)
+        self.assertEqual([r.categories[0].name for r in res], ['Groceries', 'Transport'] * 5)
+
+    def assertSameCategorisation(self, a, b) -> None:
+        self.assertEqual([s.name for s in a.categories], [s.name for s in b.categories])
+        self.assertEqual([s.name for s in a.locations], [s.name for s in b.locations])
+        for x, y in zip(a.categories + a.locations, b.categories + b.locations):
+            self.assertAlmostEqual(x.score, y.score)
+
+    def test_index_save_and_load(self) -> None:
+        descriptions = ['WOOLWORTHS 9999 FOOVILLE AU', 'petrol express 1830 sometown au', 'ünïcödé café', '']
+        with tempfile.TemporaryDirectory() as tmp:
+            for descr_map in [self.descr_map, {}]:
+                path = os.path.join(tmp, 'test.idx')
+                categoriser = TfidfCategoriser(descr_map, self.categories, self.locations)
+                categoriser.save(path, 42)
+                loaded = TfidfCategoriser.load(path)
+                self.assertEqual(loaded.version, 42)
+                for descr in descriptions:
+                    self.assertSameCategorisation(loaded.categorise(descr), categoriser.categorise(descr))
+
+    def test_index_load_invalid_file(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'test.idx')
+            with open(path, 'wb') as fp:
+                fp.write(b'not an index')
+            with self.assertRaises(ValueError):
+                TfidfCategoriser.load(path)
+
+            # The index logs why it couldn't use the file
+            index = CategoriserIndex(path)
+            with self.assertLogs(level='WARNING') as logs:
+                index._load()
+            self.assertIsNone(index.categoriser)
+            self.assertIn('Invalid categorisation index', logs.output[0])
+
+            # A missing file just hasn't been built yet
+            index = CategoriserIndex(os.path.join(tmp, 'missing.idx'))
+            with self.assertNoLogs(level='WARNING'):
+                index._load()
+
+    def test_incremental_rebuild(self) -> None:
+        previous = TfidfCategoriser(self.descr_map, self.categories, self.locations)
+        self.descr_map['woolworths 1234 sometown au']['categories']['Groceries'] = 10
+        self.descr_map['chemist warehouse sometown au'] = {'categories': {'Medical': 1}, 'locations': {'Sometown': 1}}
+        del self.descr_map['woolworths 5678 fooville au']
+        rebuilt = TfidfCategoriser(self.descr_map, self.categories, self.locations, previous)
+        fresh = TfidfCategoriser(self.descr_map, self.categories, self.locations)
+        for descr in ['WOOLWORTHS 9999 FOOVILLE AU', 'chemist warehouse', 'menulog pty ltd sydney au']:
+            self.assertSameCategorisation(rebuilt.categorise(descr), fresh.categorise(descr))
+
+    def test_pruned_matches_difflib(self) -> None:
+        for i in range(200):
+            self.descr_map[f'zz{i}'] = {'categories': {'Medical': 1}, 'locations': {'Online': 1}}
+        difflib_categoriser = DifflibCategoriser(self.descr_map, self.categories, self.locations)
+        pruned_categoriser = PrunedDifflibCategoriser(self.descr_map, self.categories, self.locations)
+        res = pruned_categoriser.categorise('Petrol Express 1830 Sometown AU')
+        self.assertEqual(res.categories[0].name, difflib_categoriser.categorise('Petrol Express 1830 Sometown AU').categories[0].name)
+        self.assertEqual(sum(pruned_categoriser.stats.values()), len(self.descr_map))
+        self.assertGreater(pruned_categoriser.stats['skipped_quick_ratio'] + pruned_categoriser.stats['skipped_bound'], 0)
+
+    def test_pruned_many_weak_candidates(self) -> None:
+        # Each of these is too dissimilar to matter alone, but together they
+        # outweigh the one close match
+        for i in range(300):
+            self.descr_map[f'petrol sometown {i:04d} ' + 'x' * 480] = {'categories': {'Medical': 1}, 'locations': {'Online': 1}}
+        difflib_categoriser = DifflibCategoriser(self.descr_map, self.categories, self.locations)
+        pruned_categoriser = PrunedDifflibCategoriser(self.descr_map, self.categories, self.locations)
+        expected = difflib_categoriser.categorise('petrol sometown')
+        res = pruned_categoriser.categorise('petrol sometown')
+        self.assertEqual(expected.categories[0].name, 'Medical')
+        self.assertEqual([x.name for x in res.categories], [x.name for x in expected.categories])
+        self.assertEqual([x.name for x in res.locations], [x.name for x in expected.locations])
+        for x, y in zip(res.categories + res.locations, expected.categories + expected.locations):
+            self.assertAlmostEqual(x.score, y.score, delta=pruned_categoriser.TOLERANCE)
+
+    def test_pruned_without_tolerance_is_exact(self) -> None:
+        pruned_categoriser = PrunedDifflibCategoriser(self.descr_map, self.categories, self.locations)
+        pruned_categoriser.TOLERANCE = 0
+        for descr in ['WOOLWORTHS 9999 FOOVILLE AU', 'petrol express']:
+            self.assertSameCategorisation(pruned_categoriser.categorise(descr), DifflibCategoriser(self.descr_map, self.categories, self.locations).categorise(descr))
+            self.assertEqual(pruned_categoriser.stats['computed'], len(self.descr_map))
+
+    def test_find_description(self) -> None:
+        categoriser = TfidfCategoriser(self.descr_map, self.categories, self.locations)
+        for descr in self.descr_map:
+            self.assertEqual(categoriser.description(categoriser.find(descr)), descr)
+        self.assertEqual(categoriser.find('not a description'), -1)
+
+
+unittest.main()
@@ -0,0 +1,114 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# compress_assets.py: This file writes a compressed copy of each file of the
+# built frontend next to it, so they can be served without compressing them
+# on every request
+#
+
+# System imports
+import os
+import sys
+import gzip
+import argparse
+from typing import Callable, Dict, List, Tuple
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None  # type: ignore
+
+# Files that are worth compressing. Images and fonts are compressed already.
+COMPRESSIBLE = {'.html', '.js', '.mjs', '.css', '.json', '.map', '.svg', '.txt', '.xml', '.ico', '.webmanifest', '.wasm'}
+
+# Below this size the saving doesn't make up for the extra header
+MIN_SIZE = 256
+
+
+def get_compressors() -> Dict[str, Callable[[bytes], bytes]]:
+    '''
+    Get the available compressors
+
+    Returns:
+        The compressor for the suffix of each compressed copy
+    '''
+    compressors: Dict[str, Callable[[bytes], bytes]] = {'.gz': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressors['.br'] = lambda data: brotli.compress(data, quality=11)
+    return compressors
+
+
+def compress_file(path: str, compressors: Dict[str, Callable[[bytes], bytes]]) -> List[Tuple[str, int]]:
+    '''
+    Write the compressed copies of a file, keeping only those that are smaller
+
+    Args:
+        path: The path to the file
+        compressors: The compressor for the suffix of each copy
+
+    Returns:
+        The path and size of each copy written
+    '''
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    stat = os.stat(path)
+
+    written = []
+    for suffix, compress in compressors.items():
+        compressed = compress(data)
+        if len(compressed) >= len(data):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+            continue
+        with open(path + suffix, 'wb') as fp:
+            fp.write(compressed)
+        os.utime(path + suffix, (stat.st_atime, stat.st_mtime))
+        written.append((path + suffix, len(compressed)))
+    return written
+
+
+def compress_assets(directory: str, min_size: int = MIN_SIZE) -> List[Tuple[str, int, List[Tuple[str, int]]]]:
+    '''
+    Compress each file of the built frontend
+
+    Args:
+        directory: The directory of the built frontend
+        min_size: The size of the smallest file to compress
+
+    Returns:
+        The path and size of each file compressed, with its copies
+    '''
+    compressors = get_compressors()
+    results = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE:
+                continue
+            size = os.path.getsize(path)
+            if size < min_size:
+                continue
+            results.append((path, size, compress_file(path, compressors)))
+    return results
+
+
+def main(args) -> int:
+    if not os.path.isdir(args.directory):
+        print(f'No such directory: {args.directory}', file=sys.stderr)
+        return 1
+    if brotli is None:
+        print('brotli is not installed, so only gzip copies are written (pip install brotli)', file=sys.stderr)
+
+    for path, size, copies in compress_assets(args.directory, args.min_size):
+        sizes = ', '.join(f'{os.path.splitext(copy)[1]} {copy_size}' for copy, copy_size in copies)
+        print(f'{os.path.relpath(path, args.directory)}: {size} -> {sizes or "not compressible"}')
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    parser = argparse.ArgumentParser(description='Write compressed copies of the files of the built frontend')
+    parser.add_argument('directory', help='The directory of the built frontend')
+    parser.add_argument('--min-size', type=int, default=MIN_SIZE, help='The size of the smallest file to compress')
+    sys.exit(main(parser.parse_args()))
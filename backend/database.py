@@ -13,9 +13,11 @@ import json
 import sqlite3
 from typing import List, Optional, Tuple, Dict
 import time
+from contextlib import contextmanager
 
 # Local imports
-from model import Transaction, TransactionList, Allocation, AllocationList, CachedToken, PushSubscription
+from merchant import MerchantNormaliser
+from model import Transaction, TransactionList, Allocation, AllocationList, CachedToken, PushSubscription, Suggestion, Job, Watermark, MetricRun
 
 
 class Database:
@@ -23,6 +25,15 @@ class Database:
     A class that abstracts the interaction with the SQLite database
     '''
     DB_PATH = os.environ.get('DB_PATH') or './budget.db'
+    normaliser = MerchantNormaliser()
+
+    def __init__(self, shared: bool = False):
+        '''
+        Args:
+            shared: Allow the connection to be used from other threads, one at a
+                    time
+        '''
+        self.shared = shared
 
     def __enter__(self):
         self.open()
@@ -32,12 +43,24 @@ class Database:
         self.close()
 
     def open(self):
-        self.con = sqlite3.connect(Database.DB_PATH)
+        self.con = sqlite3.connect(Database.DB_PATH, check_same_thread=not self.shared)
         self.con.create_function('REGEXP', 2, lambda x, y: 1 if re.search(x, y or '', re.IGNORECASE) else 0)
         self.db = self.con.cursor()
+        self.merchant_ids: Dict[str, int] = {}
+        self.transaction_depth = 0
+
+        # Databases created before merchants were added need the column, and the
+        # merchants of existing transactions
+        migrate_merchants = 'txn' in self.get_tables() and 'merchant_id' not in self.get_fields('txn')
+        if migrate_merchants:
+            self.db.execute('ALTER TABLE txn ADD COLUMN merchant_id INTEGER REFERENCES merchant(id)')
+
         with open('schema.sql') as fp:
             schema = fp.read()
             self.db.executescript(schema)
+
+        if migrate_merchants:
+            self.update_merchants()
         return self
 
     def close(self):
@@ -45,6 +68,58 @@ class Database:
         self.con.commit()
         self.con.close()
 
+    @contextmanager
+    def transaction(self):
+        '''
+        Run a block of changes in a single transaction, which is committed at the
+        end of the block or rolled back if it raises. The write lock is taken up
+        front, so the changes are made in one burst. Nested blocks become
+        savepoints of the outer transaction.
+        '''
+        if self.transaction_depth:
+            with self.savepoint(f'nested_{self.transaction_depth}'):
+                yield self
+            return
+
+        # Commit anything outstanding, so it isn't swept into this transaction
+        self.con.commit()
+        self.db.execute('BEGIN IMMEDIATE')
+        self.transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.con.rollback()
+            # Merchants created in the transaction no longer exist
+            self.merchant_ids = {}
+            raise
+        else:
+            self.con.commit()
+        finally:
+            self.transaction_depth -= 1
+
+    @contextmanager
+    def savepoint(self, name: str):
+        '''
+        Run a block of changes in a savepoint, which is rolled back if the block
+        raises, leaving the rest of the transaction intact
+
+        Args:
+            name: The name of the savepoint
+        '''
+        self.db.execute(f'SAVEPOINT {name}')
+        self.transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.db.execute(f'ROLLBACK TO {name}')
+            self.db.execute(f'RELEASE {name}')
+            self.merchant_ids = {}
+            raise
+        else:
+            self.db.execute(f'RELEASE {name}')
+        finally:
+            self.transaction_depth -= 1
+
     def get_tables(self) -> List[str]:
         '''
         Get a list of all the sql tables in the database
@@ -92,6 +167,16 @@ class Database:
         '''
         self.db.execute('DELETE FROM setting WHERE key = ?', (key, ))
 
+    def get_description_map_version(self) -> int:
+        '''
+        Get the version of the description map, which changes whenever a
+        description or its allocations change
+
+        Returns:
+            The version number
+        '''
+        return int(self.get_setting('description_map_version') or 0)
+
     def clear_expired_tokens(self) -> None:
         self.db.execute('DELETE FROM token WHERE expire <= ?', (int(time.time()),))
 
@@ -117,6 +202,27 @@ class Database:
         self.clear_expired_tokens()
         self.db.execute('DELETE FROM token WHERE value = ?', (value,))
 
+    def get_cached_tokens(self) -> List[CachedToken]:
+        '''
+        Get all the cached tokens that haven't expired
+        '''
+        self.clear_expired_tokens()
+        self.db.execute('SELECT value, expire FROM token')
+        return [CachedToken(value=row[0], expire=row[1]) for row in self.db.fetchall()]
+
+    def update_cached_tokens(self, added: List[CachedToken], removed: List[str]) -> None:
+        '''
+        Add and remove a batch of cached tokens in a single transaction
+
+        Args:
+            added: The tokens to add
+            removed: The values of the tokens to remove
+        '''
+        with self.transaction():
+            self.clear_expired_tokens()
+            self.db.executemany('INSERT OR IGNORE INTO token VALUES (?, ?)', [(token.value, token.expire) for token in added])
+            self.db.executemany('DELETE FROM token WHERE value = ?', [(value, ) for value in removed])
+
     def add_transaction(self, txn: Transaction) -> Transaction:
         '''
         Add a new transaction
@@ -127,7 +233,8 @@ class Database:
         Returns:
             The transaction with the ID filled in
         '''
-        self.db.execute('INSERT INTO txn VALUES (NULL, ?, ?, ?, ?, 0, ?)', (txn.date, txn.amount, txn.description, txn.source, txn.pending))
+        merchant_id = self.get_merchant_id(Database.normaliser.normalise(txn.description))
+        self.db.execute('INSERT INTO txn VALUES (NULL, ?, ?, ?, ?, 0, ?, ?)', (txn.date, txn.amount, txn.description, txn.source, txn.pending, merchant_id))
         txn.id = self.db.lastrowid
         self.db.execute('INSERT INTO allocation VALUES (NULL, ?, ?, 1, 1, NULL)', (txn.amount, txn.id))
         return txn
@@ -140,12 +247,14 @@ class Database:
             id:  The id to update
             txn: The new details
         '''
-        self.db.execute('UPDATE txn set date = ?, amount = ?, description = ?, source = ?, balance = ?, pending = ? WHERE id = ?',
-                        (txn.date, txn.amount, txn.description, txn.source, txn.balance, txn.pending, txn_id))
+        merchant_id = self.get_merchant_id(Database.normaliser.normalise(txn.description))
+        self.db.execute('UPDATE txn set date = ?, amount = ?, description = ?, source = ?, balance = ?, pending = ?, merchant_id = ? WHERE id = ?',
+                        (txn.date, txn.amount, txn.description, txn.source, txn.balance, txn.pending, merchant_id, txn_id))
 
-    def get_transaction_list(self, expr: Optional[str] = None, params: Tuple = tuple(), limit: Optional[int] = None, offset: int = 0) -> TransactionList:
+    def get_transaction_rows(self, expr: Optional[str] = None, params: Tuple = tuple(), limit: Optional[int] = None, offset: int = 0) -> Dict:
         '''
-        Get list of transaction based on a filter expression
+        Get a page of transactions based on a filter expression, as plain
+        dictionaries in the shape of a TransactionList
 
         Args:
             expr:   An SQL expression
@@ -154,33 +263,42 @@ class Database:
             offset: The amount of rows to skip
 
         Returns:
-            A list of transactions that match the filter
+            The total number of transactions that match the filter, and the
+            transactions in the page
         '''
         if expr:
             self.db.execute(f'SELECT id, date, amount, description, source, balance, pending FROM txn WHERE {expr}', params)
         else:
             self.db.execute(f'SELECT id, date, amount, description, source, balance, pending FROM txn')
-        res = TransactionList(total=0, transactions=[])
-        for row in self.db:
-            res.total += 1
-            if offset > 0:
-                offset -= 1
-                continue
-            if limit is not None:
-                if limit <= 0:
-                    continue
-                limit -= 1
-
-            res.transactions.append(Transaction(
-                id=row[0],
-                date=row[1],
-                amount=row[2],
-                description=row[3],
-                source=row[4],
-                balance=row[5],
-                pending=row[6] == 1,
-            ))
-        return res
+        rows = self.db.fetchall()
+        page = rows[offset:] if limit is None else rows[offset:offset + max(limit, 0)]
+        return {
+            'total': len(rows),
+            'transactions': [{
+                'id': row[0],
+                'date': row[1],
+                'amount': row[2],
+                'description': row[3],
+                'source': row[4],
+                'balance': row[5],
+                'pending': row[6] == 1,
+            } for row in page],
+        }
+
+    def get_transaction_list(self, expr: Optional[str] = None, params: Tuple = tuple(), limit: Optional[int] = None, offset: int = 0) -> TransactionList:
+        '''
+        Get list of transaction based on a filter expression
+
+        Args:
+            expr:   An SQL expression
+            params: Optional parameters to the expression
+            limit:  The amount of rows to return
+            offset: The amount of rows to skip
+
+        Returns:
+            A list of transactions that match the filter
+        '''
+        return TransactionList(**self.get_transaction_rows(expr, params, limit, offset))
 
     def get_transaction(self, txn_id: int) -> Optional[Transaction]:
         '''
@@ -239,6 +357,68 @@ class Database:
 
         return res
 
+    def get_merchant_map(self) -> Dict:
+        '''
+        Get a map of merchant names to categories and locations. This is the same
+        as the description map, but with the descriptions normalised.
+
+        Returns:
+            A map of merchant names to the categories/locations that have need assigned
+        '''
+        query = '''SELECT merchant.name as merchant,
+                          category.name as category,
+                          location.name as location,
+                          COUNT(*)
+                   FROM allocation
+                   LEFT JOIN category ON category_id = category.id
+                   LEFT JOIN location ON location_id = location.id
+                   LEFT JOIN txn ON txn_id = txn.id
+                   LEFT JOIN merchant ON txn.merchant_id = merchant.id
+                   GROUP BY merchant.name, category.name, location.name'''
+
+        self.db.execute(query)
+        res: Dict[str, Dict] = {}
+        for row in self.db:
+            merchant, category, location, count = row
+            if merchant not in res:
+                res[merchant] = {
+                    'categories': {},
+                    'locations': {}
+                }
+            res[merchant]['categories'][category] = res[merchant]['categories'].get(category, 0) + count
+            res[merchant]['locations'][location] = res[merchant]['locations'].get(location, 0) + count
+
+        return res
+
+    def get_merchant_id(self, name: str) -> int:
+        '''
+        Get a merchant id (creating one if necessary)
+
+        Args:
+            name: The normalised merchant name
+
+        Returns:
+            The ID of the merchant
+        '''
+        if name not in self.merchant_ids:
+            self.db.execute('INSERT OR IGNORE INTO merchant VALUES (NULL, ?)', (name, ))
+            self.db.execute('SELECT id FROM merchant WHERE name = ?', (name, ))
+            self.merchant_ids[name] = self.db.fetchone()[0]
+        return self.merchant_ids[name]
+
+    def update_merchants(self) -> None:
+        '''
+        Normalise the description of every transaction and set its merchant. This
+        needs to be run if the normalisation rules change.
+        '''
+        self.db.execute('SELECT id, description FROM txn')
+        rows = self.db.fetchall()
+        updates = [(self.get_merchant_id(Database.normaliser.normalise(description)), txn_id) for txn_id, description in rows]
+        self.db.executemany('UPDATE txn SET merchant_id = ? WHERE id = ?', updates)
+        self.db.execute('INSERT INTO setting VALUES (\'description_map_version\', 1) ON CONFLICT DO UPDATE SET value = value + 1')
+        self.db.execute('DELETE FROM merchant WHERE id NOT IN (SELECT merchant_id FROM txn WHERE merchant_id IS NOT NULL)')
+        self.merchant_ids = {}
+
     def get_category_list(self) -> List[str]:
         '''
         Get a list of all categories
@@ -289,9 +469,10 @@ class Database:
         row = self.db.fetchone()
         return row[0]
 
-    def get_allocation_list(self, expr: Optional[str] = None, params: Tuple = tuple(), limit: Optional[int] = None, offset: int = 0) -> AllocationList:
+    def get_allocation_rows(self, expr: Optional[str] = None, params: Tuple = tuple(), limit: Optional[int] = None, offset: int = 0) -> Dict:
         '''
-        Get list of allocations based on a filter expression
+        Get a page of allocations based on a filter expression, as plain
+        dictionaries in the shape of an AllocationList
 
         Args:
             expr:   An SQL expression
@@ -300,7 +481,8 @@ class Database:
             offset: The amount of rows to skip
 
         Returns:
-            A list of allocations that match the filter
+            The total number of allocations that match the filter, and the
+            allocations in the page
         '''
         query = '''SELECT allocation.id as id,
                           allocation.txn_id as txn_id,
@@ -320,32 +502,109 @@ class Database:
             query += f' WHERE {expr}'
 
         self.db.execute(query, params)
+        rows = self.db.fetchall()
+        page = rows[offset:] if limit is None else rows[offset:offset + max(limit, 0)]
+        return {
+            'total': len(rows),
+            'allocations': [{
+                'id': row[0],
+                'txn_id': row[1],
+                'date': row[2],
+                'amount': row[3],
+                'description': row[4],
+                'source': row[5],
+                'category': row[6],
+                'location': row[7],
+                'pending': row[8] == 1,
+                'note': row[9],
+            } for row in page],
+        }
 
-        res = AllocationList(total=0, allocations=[])
-        for row in self.db:
-            res.total += 1
-            if offset > 0:
-                offset -= 1
-                continue
-            if limit is not None:
-                if limit <= 0:
-                    continue
-                limit -= 1
-
-            res.allocations.append(Allocation(
-                id=row[0],
-                txn_id=row[1],
-                date=row[2],
-                amount=row[3],
-                description=row[4],
-                source=row[5],
-                category=row[6],
-                location=row[7],
-                pending=row[8] == 1,
-                note=row[9],
-            ))
+    def get_allocation_list(self, expr: Optional[str] = None, params: Tuple = tuple(), limit: Optional[int] = None, offset: int = 0) -> AllocationList:
+        '''
+        Get list of allocations based on a filter expression
 
-        return res
+        Args:
+            expr:   An SQL expression
+            params: Optional parameters to the expression
+            limit:  The amount of rows to return
+            offset: The amount of rows to skip
+
+        Returns:
+            A list of allocations that match the filter
+        '''
+        return AllocationList(**self.get_allocation_rows(expr, params, limit, offset))
+
+    def get_change_version(self) -> int:
+        '''
+        Get the version of the latest change to the transactions and
+        allocations
+
+        Returns:
+            The version, or 0 if nothing has changed
+        '''
+        self.db.execute('SELECT MAX(version) FROM change')
+        return self.db.fetchone()[0] or 0
+
+    def get_changes(self, since: int) -> Dict:
+        '''
+        Get the transactions and allocations that changed after a version, as
+        plain dictionaries in the shape of a ChangeList. Version 0, or a
+        version newer than the database's (eg. after a restore), gets all of
+        them with reset set, so the client replaces what it has. The rows are
+        read after the version, so they may include changes made since, which
+        will be sent again next time.
+
+        Args:
+            since: The version the client has
+
+        Returns:
+            The current version, the rows inserted or updated since, and the ids
+            of the rows deleted since
+        '''
+        version = self.get_change_version()
+        if since <= 0 or since > version:
+            return {
+                'version': version,
+                'reset': True,
+                'transactions': self.get_transaction_rows()['transactions'],
+                'allocations': self.get_allocation_rows()['allocations'],
+                'deleted_transactions': [],
+                'deleted_allocations': [],
+            }
+
+        self.db.execute('SELECT table_name, row_id FROM change WHERE version > ? AND deleted', (since, ))
+        deleted: Dict[str, List[int]] = {'txn': [], 'allocation': []}
+        for table_name, row_id in self.db.fetchall():
+            deleted[table_name].append(row_id)
+        changed = 'SELECT row_id FROM change WHERE table_name = ? AND version > ? AND NOT deleted'
+        return {
+            'version': version,
+            'reset': False,
+            'transactions': self.get_transaction_rows(f'id IN ({changed})', ('txn', since))['transactions'],
+            'allocations': self.get_allocation_rows(f'allocation.id IN ({changed})', ('allocation', since))['allocations'],
+            'deleted_transactions': deleted['txn'],
+            'deleted_allocations': deleted['allocation'],
+        }
+
+    def get_category_totals(self, start: str, end: str) -> Dict[str, int]:
+        '''
+        Get the total amount allocated to each category in a date range
+
+        Args:
+            start: The first date
+            end:   The last date
+
+        Returns:
+            The total of each category with allocations in the range
+        '''
+        self.db.execute('''SELECT category.name, SUM(allocation.amount)
+                           FROM allocation
+                           LEFT JOIN category ON category_id = category.id
+                           LEFT JOIN txn ON txn_id = txn.id
+                           WHERE txn.date BETWEEN ? AND ?
+                           GROUP BY category.name''', (start, end))
+        return {row[0]: row[1] for row in self.db}
 
     def get_txn_allocations(self, txn_id: int) -> AllocationList:
         '''
@@ -434,8 +693,9 @@ class Database:
             old_id: The transaction id whose data will be overwritten
             src: The transaction whose data you want
         '''
-        self.db.execute('UPDATE txn SET date = ?, amount = ?, description = ?, source = ?, balance = ?, pending = ? WHERE id = ?',
-                        (txn.date, txn.amount, txn.description, txn.source, txn.balance, txn.pending, old_id))
+        merchant_id = self.get_merchant_id(Database.normaliser.normalise(txn.description))
+        self.db.execute('UPDATE txn SET date = ?, amount = ?, description = ?, source = ?, balance = ?, pending = ?, merchant_id = ? WHERE id = ?',
+                        (txn.date, txn.amount, txn.description, txn.source, txn.balance, txn.pending, merchant_id, old_id))
         self.db.execute(f'DELETE FROM txn WHERE id = ?', (txn.id,))
 
     def update_balance(self, source: str, start_balance: int) -> Tuple[int, int]:
@@ -466,6 +726,66 @@ class Database:
 
         return posted_total, pending_total
 
+    def update_watermark(self, source: str) -> Watermark:
+        '''
+        Record the oldest pending and latest posted transaction of a source
+
+        Args:
+            source: The name of the source
+
+        Returns:
+            The updated watermark
+        '''
+        self.db.execute('''INSERT INTO watermark (source, oldest_pending, last_posted)
+                           SELECT ?, (SELECT MIN(date) FROM txn WHERE source = ? AND pending),
+                                     (SELECT MAX(date) FROM txn WHERE source = ? AND NOT pending)
+                           WHERE true
+                           ON CONFLICT DO UPDATE SET oldest_pending = excluded.oldest_pending, last_posted = excluded.last_posted''',
+                        (source, source, source))
+        watermark = self.get_watermark(source)
+        assert watermark is not None
+        return watermark
+
+    def get_watermark(self, source: str) -> Optional[Watermark]:
+        '''
+        Get the watermark of a source
+
+        Args:
+            source: The name of the source
+
+        Returns:
+            The watermark, or None if the source hasn't been processed
+        '''
+        self.db.execute('SELECT source, oldest_pending, last_posted FROM watermark WHERE source = ?', (source, ))
+        row = self.db.fetchone()
+        return Watermark(source=row[0], oldest_pending=row[1], last_posted=row[2]) if row else None
+
+    def set_suggestion(self, suggestion: Suggestion) -> None:
+        '''
+        Store the suggested category/location for a transaction
+
+        Args:
+            suggestion: The suggestion to store
+        '''
+        self.db.execute('INSERT OR REPLACE INTO suggestion VALUES (?, ?, ?, ?, ?)',
+                        (suggestion.txn_id, suggestion.category, suggestion.category_score, suggestion.location, suggestion.location_score))
+
+    def get_suggestion(self, txn_id: int) -> Optional[Suggestion]:
+        '''
+        Get the suggested category/location for a transaction
+
+        Args:
+            txn_id: The transaction ID
+
+        Returns:
+            The suggestion, or None if there isn't one
+        '''
+        self.db.execute('SELECT txn_id, category, category_score, location, location_score FROM suggestion WHERE txn_id = ?', (txn_id,))
+        row = self.db.fetchone()
+        if not row:
+            return None
+        return Suggestion(txn_id=row[0], category=row[1], category_score=row[2], location=row[3], location_score=row[4])
+
     def add_push_subscription(self, sub: PushSubscription) -> PushSubscription:
         '''
         Add a push subscription
@@ -495,3 +815,148 @@ class Database:
             id: The id to remove
         '''
         self.db.execute('DELETE FROM push_subscription WHERE id = ?', (id,))
+
+    def add_job(self, reason: str, schedule_key: Optional[str] = None, state: str = 'queued') -> Optional[Job]:
+        '''
+        Queue a scraper job, unless one is already queued or running
+
+        Args:
+            reason: What queued the job
+            schedule_key: Identifies a scheduled run, which is only queued once
+            state: Either queued, or running to start the job straight away so
+                   the scheduler can't claim it
+
+        Returns:
+            The new job, or None if it wasn't queued
+        '''
+        now = time.time()
+        with self.transaction():
+            self.db.execute('''INSERT OR IGNORE INTO job (reason, schedule_key, state, queued, started)
+                               SELECT ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM job WHERE state != 'done')''',
+                            (reason, schedule_key, state, now, now if state == 'running' else None))
+            if not self.db.rowcount:
+                return None
+            job_id = self.db.lastrowid
+        return self.get_job(job_id)
+
+    def claim_job(self) -> Optional[Job]:
+        '''
+        Mark the oldest queued job as running
+
+        Returns:
+            The claimed job, or None if there are no queued jobs
+        '''
+        with self.transaction():
+            self.db.execute('SELECT id FROM job WHERE state = \'queued\' ORDER BY id LIMIT 1')
+            row = self.db.fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE job SET state = \'running\', started = ? WHERE id = ?', (time.time(), row[0]))
+        return self.get_job(row[0])
+
+    def set_job_pid(self, job_id: int, pid: int) -> None:
+        '''
+        Set the process running a job
+
+        Args:
+            job_id: The ID of the job
+            pid: The process ID
+        '''
+        with self.transaction():
+            self.db.execute('UPDATE job SET pid = ? WHERE id = ?', (pid, job_id))
+
+    def finish_job(self, job_id: int, inserted: Optional[int] = None, failed: Optional[int] = None, error: Optional[str] = None) -> None:
+        '''
+        Mark a job as done, if it isn't already
+
+        Args:
+            job_id: The ID of the job
+            inserted: The number of new transactions found
+            failed: The number of scrapers that failed
+            error: Why the job failed
+        '''
+        with self.transaction():
+            self.db.execute('''UPDATE job SET state = 'done', finished = ?, inserted = ?, failed = ?, error = ?
+                               WHERE id = ? AND state != \'done\'''', (time.time(), inserted, failed, error, job_id))
+
+    def get_job(self, job_id: int) -> Optional[Job]:
+        '''
+        Get a job
+
+        Args:
+            job_id: The ID of the job
+
+        Returns:
+            The job, or None if it doesn't exist
+        '''
+        jobs = self.get_job_list('id = ?', (job_id, ))
+        return jobs[0] if jobs else None
+
+    def get_job_list(self, expr: Optional[str] = None, params: Tuple = tuple(), limit: Optional[int] = None) -> List[Job]:
+        '''
+        Get a list of jobs, newest first
+
+        Args:
+            expr: An optional WHERE expression to filter the jobs
+            params: The parameters of the expression
+            limit: The maximum number of jobs to get
+
+        Returns:
+            The list of jobs
+        '''
+        query = 'SELECT id, reason, state, pid, queued, started, finished, inserted, failed, error FROM job'
+        if expr:
+            query += f' WHERE {expr}'
+        query += ' ORDER BY id DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params = (*params, limit)
+        self.db.execute(query, params)
+        fields = ['id', 'reason', 'state', 'pid', 'queued', 'started', 'finished', 'inserted', 'failed', 'error']
+        return [Job(**dict(zip(fields, row))) for row in self.db.fetchall()]
+
+    def add_metric_run(self, run: MetricRun) -> MetricRun:
+        '''
+        Store the metrics of an ingest run
+
+        Args:
+            run: The metrics to store
+
+        Returns:
+            The stored metrics, with their ID
+        '''
+        self.db.execute('INSERT INTO metric_run VALUES (NULL, ?, ?, ?)', (run.job_id, run.started, run.finished))
+        run.id = self.db.lastrowid
+        rows = [(run.id, source, 'stage', name, value) for source, stages in run.stages.items() for name, value in stages.items()]
+        rows += [(run.id, source, 'count', name, value) for source, counts in run.counts.items() for name, value in counts.items()]
+        self.db.executemany('INSERT INTO metric VALUES (?, ?, ?, ?, ?)', rows)
+        return run
+
+    def get_metric_runs(self, limit: int = 20, source: Optional[str] = None) -> List[MetricRun]:
+        '''
+        Get the metrics of the latest ingest runs, newest first
+
+        Args:
+            limit: The maximum number of runs to get
+            source: Only include the metrics of this source
+
+        Returns:
+            The list of runs
+        '''
+        self.db.execute('SELECT id, job_id, started, finished FROM metric_run ORDER BY id DESC LIMIT ?', (limit, ))
+        runs = {row[0]: MetricRun(id=row[0], job_id=row[1], started=row[2], finished=row[3]) for row in self.db.fetchall()}
+        if not runs:
+            return []
+
+        query = f'SELECT run_id, source, kind, name, value FROM metric WHERE run_id IN ({", ".join("?" * len(runs))})'
+        params: Tuple = tuple(runs)
+        if source is not None:
+            query += ' AND source = ?'
+            params += (source, )
+        self.db.execute(query, params)
+        for run_id, metric_source, kind, name, value in self.db.fetchall():
+            if kind == 'stage':
+                runs[run_id].stages.setdefault(metric_source, {})[name] = value
+            else:
+                runs[run_id].counts.setdefault(metric_source, {})[name] = int(value)
+        return list(runs.values())
@@ -0,0 +1,209 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# events.py: This file implements an in-process publish/subscribe bus, and
+# streams its events to clients as Server-Sent Events
+#
+
+# System imports
+import json
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, List, Optional, Set
+
+# Local imports
+from model import Event
+
+
+# How many events a subscriber can fall behind before the oldest are dropped
+QUEUE_SIZE = 256
+
+# How often to send a comment to keep an idle stream open, in seconds
+HEARTBEAT = 15
+
+
+class Subscription:
+    '''
+    The events of some topics, queued for one subscriber. The queue belongs to
+    the subscriber's event loop, and a subscriber that falls too far behind
+    loses the oldest events rather than holding up the publisher.
+    '''
+
+    def __init__(self,
+                 bus: 'EventBus',
+                 topics: Set[str],
+                 predicate: Optional[Callable[[Event], bool]],
+                 loop: asyncio.AbstractEventLoop,
+                 maxsize: int):
+        self.bus = bus
+        self.topics = topics
+        self.predicate = predicate
+        self.loop = loop
+        self.queue: asyncio.Queue[Event] = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def wants(self, event: Event) -> bool:
+        '''
+        Check whether an event should be sent to the subscriber
+
+        Args:
+            event: The event
+
+        Returns:
+            True if the subscriber wants the event
+        '''
+        return event.topic in self.topics and (self.predicate is None or self.predicate(event))
+
+    def put(self, event: Event) -> None:
+        '''
+        Queue an event, dropping the oldest one if the queue is full. This must
+        be called from the subscriber's event loop.
+
+        Args:
+            event: The event
+        '''
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Event]:
+        '''
+        Wait for the next event
+
+        Args:
+            timeout: The most time to wait, or None to wait forever
+
+        Returns:
+            The event, or None if the time ran out
+        '''
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self) -> None:
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    '''
+    Publishes events to the subscribers of their topic. Events can be
+    published from any thread, and are handed to each subscriber on its own
+    event loop.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions: List[Subscription] = []
+        self.last_id = 0
+
+    def subscribe(self,
+                  topics: Iterable[str],
+                  predicate: Optional[Callable[[Event], bool]] = None,
+                  maxsize: int = QUEUE_SIZE) -> Subscription:
+        '''
+        Subscribe to some topics. This must be called from the event loop that
+        will receive the events.
+
+        Args:
+            topics: The topics to subscribe to
+            predicate: Only events this returns True for are queued
+            maxsize: How many events can be queued
+
+        Returns:
+            The subscription, which must be closed when it's no longer needed
+        '''
+        sub = Subscription(self, set(topics), predicate, asyncio.get_running_loop(), maxsize)
+        with self.lock:
+            self.subscriptions.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self.lock:
+            if sub in self.subscriptions:
+                self.subscriptions.remove(sub)
+
+    def subscribers(self, topic: str) -> int:
+        '''
+        Get the number of subscribers to a topic
+        '''
+        with self.lock:
+            return len([sub for sub in self.subscriptions if topic in sub.topics])
+
+    def publish(self, topic: str, data: Any) -> Event:
+        '''
+        Publish an event to the subscribers of a topic
+
+        Args:
+            topic: The topic
+            data: The JSON serialisable data of the event
+
+        Returns:
+            The event
+        '''
+        with self.lock:
+            self.last_id += 1
+            event = Event(id=self.last_id, topic=topic, data=data)
+            subscriptions = list(self.subscriptions)
+
+        for sub in subscriptions:
+            try:
+                if sub.wants(event):
+                    sub.loop.call_soon_threadsafe(sub.put, event)
+            except RuntimeError:
+                # The subscriber's event loop has gone
+                self.unsubscribe(sub)
+        return event
+
+
+def format_event(event: Event) -> str:
+    '''
+    Format an event as a Server-Sent Event
+
+    Args:
+        event: The event
+
+    Returns:
+        The text of the event
+    '''
+    return f'id: {event.id}\nevent: {event.topic}\ndata: {json.dumps(event.data)}\n\n'
+
+
+async def sse_stream(sub: Subscription,
+                     is_disconnected: Callable[[], Awaitable[bool]],
+                     initial: Iterable[Event] = (),
+                     heartbeat: float = HEARTBEAT) -> AsyncIterator[str]:
+    '''
+    Stream the events of a subscription as Server-Sent Events, until the client
+    disconnects. The subscription is closed at the end.
+
+    Args:
+        sub: The subscription
+        is_disconnected: Checks whether the client has gone
+        initial: Events to send before the subscribed ones, eg. the current state
+        heartbeat: How often to send a comment while there are no events
+
+    Returns:
+        An iterator over the text to send
+    '''
+    try:
+        for event in initial:
+            yield format_event(event)
+        while not await is_disconnected():
+            next_event = await sub.get(heartbeat)
+            yield ': keep-alive\n\n' if next_event is None else format_event(next_event)
+    finally:
+        sub.close()
+
+
+# The bus shared by everything in the process
+bus = EventBus()
@@ -0,0 +1,119 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# events.test.py: This file contains the unit tests for the event bus and the
+# Server-Sent Event streams
+#
+
+# System imports
+import json
+import asyncio
+import threading
+import unittest
+from typing import List
+
+# Local imports
+from events import EventBus, format_event, sse_stream
+from model import Event
+
+
+class TestEventBus(unittest.TestCase):
+    def test_topics(self) -> None:
+        async def run() -> None:
+            bus = EventBus()
+            with bus.subscribe(['job']) as jobs, bus.subscribe(['job', 'log'], lambda event: 'ERROR' in event.data) as errors:
+                self.assertEqual(bus.subscribers('job'), 2)
+                self.assertEqual(bus.subscribers('log'), 1)
+                bus.publish('job', 'started')
+                bus.publish('log', 'INFO foo')
+                bus.publish('log', 'ERROR bar')
+                bus.publish('other', None)
+                await asyncio.sleep(0)
+
+                event = await jobs.get(1)
+                assert event is not None
+                self.assertEqual((event.id, event.topic, event.data), (1, 'job', 'started'))
+                self.assertIsNone(await jobs.get(0.01))
+
+                # The predicate applies to every topic of a subscription
+                event = await errors.get(1)
+                assert event is not None
+                self.assertEqual(event.data, 'ERROR bar')
+                self.assertIsNone(await errors.get(0.01))
+            self.assertEqual(bus.subscribers('job'), 0)
+
+        asyncio.run(run())
+
+    def test_publish_from_thread(self) -> None:
+        async def run() -> List[int]:
+            bus = EventBus()
+            with bus.subscribe(['count'], maxsize=1000) as sub:
+                threads = [threading.Thread(target=lambda: [bus.publish('count', i) for i in range(100)]) for _ in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                events = []
+                while len(events) < 400:
+                    event = await sub.get(1)
+                    assert event is not None
+                    events.append(event.id)
+                return events
+
+        self.assertEqual(sorted(asyncio.run(run())), list(range(1, 401)))
+
+    def test_slow_subscriber(self) -> None:
+        async def run() -> None:
+            bus = EventBus()
+            with bus.subscribe(['log'], maxsize=3) as sub:
+                for i in range(10):
+                    bus.publish('log', i)
+                await asyncio.sleep(0)
+                self.assertEqual(sub.dropped, 7)
+                self.assertEqual([(await sub.get(1)).data for _ in range(3)], [7, 8, 9])  # type: ignore
+
+        asyncio.run(run())
+
+    def test_closed_loop(self) -> None:
+        bus = EventBus()
+
+        async def subscribe() -> None:
+            bus.subscribe(['log'])
+
+        asyncio.run(subscribe())
+        self.assertEqual(bus.subscribers('log'), 1)
+        bus.publish('log', 'foo')
+        self.assertEqual(bus.subscribers('log'), 0)
+
+
+class TestSSEStream(unittest.TestCase):
+    def test_format(self) -> None:
+        self.assertEqual(format_event(Event(id=3, topic='job', data={'id': 1, 'state': 'done'})),
+                         'id: 3\nevent: job\ndata: {"id": 1, "state": "done"}\n\n')
+
+    def test_stream(self) -> None:
+        async def run() -> List[str]:
+            bus = EventBus()
+            sub = bus.subscribe(['log'])
+            checks = 0
+
+            async def is_disconnected() -> bool:
+                nonlocal checks
+                checks += 1
+                if checks == 1:
+                    bus.publish('log', 'line 1')
+                return checks > 3
+
+            output = [text async for text in sse_stream(sub, is_disconnected, [Event(id=0, topic='log', data='line 0')], heartbeat=0.01)]
+            self.assertEqual(bus.subscribers('log'), 0)
+            return output
+
+        output = asyncio.run(run())
+        self.assertEqual(len(output), 4)
+        self.assertEqual([json.loads(text.split('data: ')[1]) for text in output[:2]], ['line 0', 'line 1'])
+        self.assertEqual(output[2:], [': keep-alive\n\n', ': keep-alive\n\n'])
+
+
+unittest.main()
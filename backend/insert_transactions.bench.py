@@ -0,0 +1,214 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# insert_transactions.bench.py: This file benchmarks matching newly scraped
+# transactions against the existing transactions in the database
+#
+
+# System imports
+import os
+import sys
+import time
+import random
+import argparse
+import datetime
+import json
+import logging
+import tempfile
+from typing import List, Optional, Tuple
+
+# Local imports
+from database import Database
+from model import Transaction
+from insert_transactions import prune_existing_transactions, replay_transactions
+from logs import OFF, LINE_FORMAT, DATE_FORMAT, TXN_LOGGER, setup_logging, stop_logging
+
+
+WORDS = ['foo', 'bar', 'baz', 'qwerty', 'express', 'market', 'pty', 'ltd', 'corp', 'enterprises', 'fresh', 'city', 'north',
+         'south', 'plaza', 'store', 'services', 'direct', 'global', 'local', 'best', 'mart', 'fuel', 'cafe', 'kitchen']
+
+
+def generate(rng: random.Random, source: str, count: int) -> Tuple[List[Transaction], List[Transaction]]:
+    '''
+    Generate a set of existing transactions and a newly scraped set. Most of the
+    scraped transactions match an existing one exactly, some are pending
+    transactions that have since posted, and the rest are new.
+
+    Args:
+        rng:    The random number generator
+        source: The source of the transactions
+        count:  The number of existing and new transactions to generate
+
+    Returns:
+        A tuple of the existing and new transactions
+    '''
+    existing = []
+    for i in range(count):
+        existing.append(Transaction(
+            date=f'2023-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}',
+            amount=-rng.randint(100, 100000),
+            description=f'{" ".join(rng.sample(WORDS, 3)).upper()} {rng.randint(1000, 9999)} SOMETOWN AU',
+            source=source,
+            pending=rng.random() < 0.1,
+        ))
+
+    new = []
+    for txn in existing[:count - count // 20]:
+        roll = rng.random()
+        if roll < 0.8 or not txn.pending:
+            new.append(Transaction(date=txn.date, amount=txn.amount, description=txn.description, source=source, pending=txn.pending))
+        elif roll < 0.9:
+            new.append(Transaction(date=txn.date, amount=txn.amount, description=txn.description, source=source))
+        elif roll < 0.95:
+            new.append(Transaction(date=txn.date, amount=txn.amount, description=txn.description + ' XXXX-XXXX-XXXX-1234', source=source))
+        else:
+            posted = datetime.date.fromisoformat(txn.date) + datetime.timedelta(days=rng.randint(1, 3))
+            new.append(Transaction(date=posted.isoformat(), amount=txn.amount, description=txn.description + ' XXXX-XXXX-XXXX-1234', source=source))
+    for _ in range(count - len(new)):
+        new.append(Transaction(date='2024-01-01', amount=-rng.randint(100, 100000), description=' '.join(rng.sample(WORDS, 3)).upper(), source=source))
+    rng.shuffle(new)
+    return existing, new
+
+
+def generate_replay(rng: random.Random, source: str, days: int, per_day: int, window: int = 10) -> List[str]:
+    '''
+    Generate a replay log, with one scrape per day. Each scrape sees the last
+    window days of transactions, and the most recent day is still pending.
+
+    Args:
+        rng:     The random number generator
+        source:  The source of the transactions
+        days:    The number of days (and scrapes) to generate
+        per_day: The number of transactions each day
+        window:  The number of days each scrape sees
+
+    Returns:
+        The lines of the replay log
+    '''
+    start = datetime.date(2023, 1, 1)
+    history = []
+    for day in range(days):
+        date = (start + datetime.timedelta(days=day)).isoformat()
+        history.append([{'date': date, 'amount': -rng.randint(100, 100000), 'source': source,
+                         'description': f'{" ".join(rng.sample(WORDS, 3)).upper()} {rng.randint(1000, 9999)} SOMETOWN AU'} for _ in range(per_day)])
+
+    lines = []
+    for day in range(days):
+        transactions = []
+        for seen in range(max(0, day - window), day + 1):
+            transactions += [{**txn, 'pending': seen == day} for txn in history[seen]]
+        lines.append(json.dumps({'transactions': transactions}))
+    return lines
+
+
+def main(args) -> int:
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        Database.DB_PATH = os.path.join(tmp, 'bench.db')
+        with Database() as db:
+            print(f'{"source":<10} {"existing":>10} {"new":>10} {"prune (s)":>10} {"to insert":>10} {"to delete":>10}')
+            for i in range(args.sources):
+                source = f'source {i}'
+                existing, new = generate(rng, source, args.count)
+                for txn in existing:
+                    db.add_transaction(txn)
+
+                start = time.perf_counter()
+                to_insert, to_delete = prune_existing_transactions(new, source, db)
+                elapsed = time.perf_counter() - start
+
+                print(f'{source:<10} {len(existing):>10} {len(new):>10} {elapsed:>10.3f} {len(to_insert):>10} {len(to_delete):>10}')
+
+            print()
+            print(f'{"source":<10} {"lines":>10} {"rows":>10} {"replay (s)":>10} {"rows/sec":>10}')
+            config = {'scrapers': {}}
+            for i in range(args.sources):
+                source = f'replay {i}'
+                config['scrapers'][source] = {'start_date': '2000-01-01', 'start_balance': 0}
+                lines = generate_replay(rng, source, args.replay_days, args.replay_per_day)
+                rows = sum(len(json.loads(line)['transactions']) for line in lines)
+
+                start = time.perf_counter()
+                replay_transactions(lines, config, db)
+                elapsed = time.perf_counter() - start
+
+                print(f'{source:<10} {len(lines):>10} {rows:>10} {elapsed:>10.3f} {rows / elapsed:>10.0f}')
+
+            print()
+            print(f'{"logging":<22} {"rows":>10} {"replay (s)":>10} {"total (s)":>10} {"rows/sec":>10} {"log (MB)":>10}')
+            rng = random.Random(args.seed)
+            lines = generate_replay(rng, 'logged', args.replay_days, args.replay_per_day)
+            rows = sum(len(json.loads(line)['transactions']) for line in lines)
+            for i, (name, queued, level, txn_level) in enumerate([
+                    ('none', False, logging.WARNING, logging.NOTSET),
+                    ('file DEBUG', False, logging.DEBUG, logging.NOTSET),
+                    ('queue DEBUG', True, logging.DEBUG, logging.INFO),
+                    ('queue INFO', True, logging.INFO, logging.INFO),
+                    ('queue INFO, txn OFF', True, logging.INFO, OFF)]):
+                # Each run replays the same scrapes into a source of its own
+                source = f'logged {i}'
+                config['scrapers'][source] = {'start_date': '2000-01-01', 'start_balance': 0}
+                source_lines = [line.replace('"logged"', json.dumps(source)) for line in lines]
+                elapsed, total, size = replay_logged(source_lines, config, db, os.path.join(tmp, f'{i}.log'), queued, level, txn_level)
+                print(f'{name:<22} {rows:>10} {elapsed:>10.3f} {total:>10.3f} {rows / total:>10.0f} {size / (1 << 20):>10.1f}')
+
+    return 0
+
+
+def replay_logged(lines: List[str], config: dict, db: Database, path: str, queued: bool, level: int, txn_level: int) -> Tuple[float, float, int]:
+    '''
+    Replay transactions with logging set up
+
+    Args:
+        lines: The lines of the replay log
+        config: The config with the source of the lines
+        db: The database
+        path: The path of the log file
+        queued: Whether to log from a background thread, or write to the file
+                directly
+        level: The level of the root logger
+        txn_level: The level of the per-transaction logger
+
+    Returns:
+        The time taken to replay, the time taken to also finish writing the
+        log, and the size of the log
+    '''
+    root = logging.getLogger()
+    handlers, root_level = list(root.handlers), root.level
+    listener = None
+    handler: Optional[logging.Handler] = None
+    start = time.perf_counter()
+    try:
+        # Without a handler, the logging functions add one that writes to stderr
+        root.handlers = [logging.NullHandler()]
+        if queued:
+            listener = setup_logging(path, level, txn_level, retention_days=None)
+        else:
+            handler = logging.FileHandler(path, 'a')
+            handler.setFormatter(logging.Formatter(LINE_FORMAT, DATE_FORMAT))
+            root.addHandler(handler)
+            root.setLevel(level)
+            logging.getLogger(TXN_LOGGER).setLevel(txn_level)
+        replay_transactions(lines, config, db)
+        elapsed = time.perf_counter() - start
+    finally:
+        if listener:
+            stop_logging()
+        elif handler:
+            handler.close()
+        root.handlers = handlers
+        root.setLevel(root_level)
+        logging.getLogger(TXN_LOGGER).setLevel(logging.NOTSET)
+    return elapsed, time.perf_counter() - start, os.path.getsize(path) if os.path.exists(path) else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark pruning scraped transactions that already exist')
+    parser.add_argument('--count', type=int, default=10000, help='The number of existing and new transactions per source')
+    parser.add_argument('--sources', type=int, default=2, help='The number of sources')
+    parser.add_argument('--replay-days', type=int, default=90, help='The number of daily scrapes to replay per source')
+    parser.add_argument('--replay-per-day', type=int, default=20, help='The number of transactions per day in the replay')
+    parser.add_argument('--seed', type=int, default=1, help='The random seed')
+    sys.exit(main(parser.parse_args()))
@@ -8,71 +8,228 @@
 #
 
 # System imports
+import os
 import sys
 import argparse
 import json
+import asyncio
 import subprocess
 import logging
 import datetime
-from typing import List, Dict, Tuple
-from difflib import get_close_matches
+import time
+import queue
+import threading
+from typing import List, Dict, Tuple, Deque, Callable, Optional, Iterable
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
 
 # Local imports
-from model import Transaction, TransactionList
+from model import Transaction, TransactionList, Suggestion
 from database import Database
+from merchant import MerchantNormaliser
+from push import PushWorker
+from metrics import IngestMetrics
+from logs import TXN_LOGGER, LOG_RETENTION_DAYS, parse_level, setup_logging
+from categorise import ENGINES, CategoriserIndex
 
 
 TxnMapType = Dict[str, Dict[str, Dict[float, Dict[str, List[int]]]]]
 
+# The most days a pending transaction can take to post with a modified description
+PENDING_MAX_DAYS = 31
+
+# How many days before a source's latest posted transaction new ones can still appear
+WATERMARK_MARGIN_DAYS = 3
+
+# The most parsed lines that can be waiting to be processed during a replay
+REPLAY_QUEUE_SIZE = 64
+
+# Messages about individual transactions, which can be turned down with txn_log_level
+txn_log = logging.getLogger(TXN_LOGGER)
+
+
+def txn_event(event: str, txn: Transaction) -> Dict:
+    '''
+    Get the structured fields of a log record about a transaction
+
+    Args:
+        event: The event type
+        txn: The transaction
+
+    Returns:
+        The fields, to pass as the extra argument of a logging call
+    '''
+    return {'event': event, 'source': txn.source, 'txn_id': txn.id}
+
 
 def send_push_notification(body: Dict, config, db) -> None:  # pragma: no cover
     '''
-    Send a push notification
+    Send a push notification to every subscription
 
     Args:
         body:    The body of the notification to send
     '''
+    subs = db.get_push_subscriptions()
+    if not subs:
+        return
 
-    content = json.dumps(body)
-    for sub in db.get_push_subscriptions():
-        try:
-            sub_value = json.dumps(sub.value)
-
-            # Create and call a node script to do the notification push
-            script = f'''const webpush = require('web-push');
-webpush.setGCMAPIKey(`{config['GCMAPIKey']}`);
-webpush.setVapidDetails(`{config['vapidSub']}`, `{config['vapidPublicKey']}`, `{config['vapidPrivateKey']}`);
-webpush.sendNotification({sub_value}, `{content}`);
-'''
-            subprocess.run([config['node_path'], '-e', script], stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', check=True)
-            logging.info(f'Sent push notification for {sub_value}')
-        except Exception as exc:
-            logging.info(f'Cannot send push notification for {sub_value}: {exc}')
-            db.delete_push_subscription(sub.id)
+    try:
+        with PushWorker(config) as worker:
+            results = worker.send(subs, body)
+    except Exception as exc:
+        logging.error('Cannot send push notifications: %s', exc)
+        return
+
+    for res in results:
+        if res.ok:
+            logging.info('Sent push notification for subscription %s', res.id)
+        else:
+            logging.info('Cannot send push notification for subscription %s: %s %s', res.id, res.status_code, res.error)
+            if res.id is not None:
+                db.delete_push_subscription(res.id)
 
 
-def run_scraper(args, config: Dict, scraper: Dict) -> List[Transaction]:  # pragma: no cover
+async def run_scraper(args, config: Dict, scraper: Dict, semaphore: asyncio.Semaphore, metrics: IngestMetrics, source: str = '') -> Dict:
     '''
-    Run a scraper file
+    Run a scraper file in a subprocess, once a slot is available
 
     Args:
-        args:    Command line arguments
-        config:  Configuration data
-        scraper: The scraper configuration
+        args:      Command line arguments
+        config:    Configuration data
+        scraper:   The scraper configuration
+        semaphore: Limits the number of scrapers running at once
+        metrics:   The metrics of the run
+        source:    The name of the source
 
     Returns:
         The scraped JSON data
     '''
-    result = subprocess.run([config['node_path'], './scrapers/' + scraper['path'], args.config],
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', check=True)
-    if result.stdout is None:
-        return []
+    async with semaphore:
+        with metrics.stage('scrape', source):
+            process = await asyncio.create_subprocess_exec(config['node_path'], os.path.join('scrapers', scraper['path']), args.config,
+                                                           stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            stdout, stderr = await process.communicate()
 
-    logging.debug(result.stdout)
-    return json.loads(result.stdout)
+    returncode = process.returncode if process.returncode is not None else -1
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, scraper['path'], stdout, stderr)
 
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('%s', stdout.decode())
+    with metrics.stage('parse', source):
+        return json.loads(stdout)
 
-def prune_existing_transactions(transactions: List[Transaction], source: str, db, min_date: str = None) -> Tuple[List[Transaction], List[Transaction]]:
+
+async def run_scrapers(args, config: Dict, handle: Callable[[str, Dict, Dict], None], metrics: Optional[IngestMetrics] = None) -> int:
+    '''
+    Run all the scrapers concurrently, up to the configured limit. The results
+    are handed to a single writer thread as each scraper completes, so the
+    database is only ever written from one place, and the event loop keeps
+    reading the other scrapers' output while it writes.
+
+    Args:
+        args:   Command line arguments
+        config: Configuration data
+        handle: Called with the name, configuration and scraped data of each
+                source, from the writer thread
+        metrics: The metrics of the run
+
+    Returns:
+        The number of scrapers that failed
+    '''
+    metrics = metrics or IngestMetrics()
+    semaphore = asyncio.Semaphore(config.get('scraper_concurrency', 1))
+
+    async def run(name: str, scraper: Dict) -> Tuple[str, Dict, Dict]:
+        return name, scraper, await run_scraper(args, config, scraper, semaphore, metrics, name)
+
+    loop = asyncio.get_running_loop()
+    tasks = [asyncio.create_task(run(name, scraper)) for name, scraper in config['scrapers'].items()]
+    failed = 0
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest-writer') as writer:
+        for task in asyncio.as_completed(tasks):
+            try:
+                name, scraper, data = await task
+                await loop.run_in_executor(writer, handle, name, scraper, data)
+            except Exception as exc:
+                logging.exception('Scraper failed: %s', exc, extra={'event': 'scraper_failed'})
+                failed += 1
+    return failed
+
+
+def index_transactions(transactions: List[Transaction], key: Callable[[Transaction], Tuple]) -> Dict[Tuple, Deque[Transaction]]:
+    '''
+    Build a multimap of transactions. The transactions for each key are kept in
+    their original order, so popping from the left gives the first match.
+
+    Args:
+        transactions: The transactions to index
+        key: A function that gets the key of a transaction
+
+    Returns:
+        The map of keys to transactions
+    '''
+    res: Dict[Tuple, Deque[Transaction]] = {}
+    for txn in transactions:
+        res.setdefault(key(txn), deque()).append(txn)
+    return res
+
+
+def match_partial(transactions: List[Transaction], existing_transactions: List[Transaction], key: Callable[[Transaction], Tuple],
+                  max_days: Optional[int] = None, cutoff: float = 0.75) -> List[Tuple[Transaction, Transaction]]:
+    '''
+    Match transactions to existing transactions whose merchant names are similar.
+    The existing transactions are bucketed once, so each transaction is only
+    scored against the bucket it falls in. Matches are then resolved globally,
+    best score first, so a transaction can't take an existing transaction that
+    is a better match for another.
+
+    Args:
+        transactions: The transactions to match
+        existing_transactions: The candidate existing transactions
+        key: A function that gets the bucket of a transaction (eg. its amount)
+        max_days: The maximum number of days between matching transactions
+        cutoff: The minimum similarity of a match
+
+    Returns:
+        A list of (transaction, existing transaction) pairs
+    '''
+    buckets = index_transactions(existing_transactions, key)
+    existing_names = {id(existing_txn): Database.normaliser.normalise(existing_txn.description) for existing_txn in existing_transactions}
+
+    candidates: List[Tuple[float, int, int, Transaction, Transaction]] = []
+    matcher = SequenceMatcher()
+    for i, txn in enumerate(transactions):
+        bucket = buckets.get(key(txn))
+        if not bucket:
+            continue
+        txn_date = datetime.date.fromisoformat(txn.date)
+        matcher.set_seq2(Database.normaliser.normalise(txn.description))
+        for j, existing_txn in enumerate(bucket):
+            if max_days is not None and abs((datetime.date.fromisoformat(existing_txn.date) - txn_date).days) > max_days:
+                continue
+            matcher.set_seq1(existing_names[id(existing_txn)])
+            if matcher.real_quick_ratio() >= cutoff and matcher.quick_ratio() >= cutoff:
+                score = matcher.ratio()
+                if score >= cutoff:
+                    candidates.append((score, i, j, txn, existing_txn))
+
+    # Take the best matches first, breaking ties by the original order
+    candidates.sort(key=lambda candidate: (-candidate[0], candidate[1], candidate[2]))
+    matched_txns = set()
+    matched_existing = set()
+    res = []
+    for _, _, _, txn, existing_txn in candidates:
+        if id(txn) not in matched_txns and id(existing_txn) not in matched_existing:
+            matched_txns.add(id(txn))
+            matched_existing.add(id(existing_txn))
+            res.append((txn, existing_txn))
+    return res
+
+
+def prune_existing_transactions(transactions: List[Transaction], source: str, db, min_date: Optional[str] = None,
+                                metrics: Optional[IngestMetrics] = None) -> Tuple[List[Transaction], List[Transaction]]:
     '''
     Prune existing transactions from the list of new transactions
 
@@ -80,33 +237,43 @@ def prune_existing_transactions(transactions: List[Transaction], source: str, db
         transactions:  New transaction list
         source: The source of the transactions
         db: The database object
+        min_date: Ignore all transactions before this date
+        metrics: Counts the transactions matched by each pass
 
     Returns:
         A tuple of the transactions to insert and delete
     '''
+    metrics = metrics or IngestMetrics()
     if min_date:
         # Only get transactions since min_date
         existing_transactions = db.get_transaction_list('date >= ? AND source = ?', (min_date, source)).transactions
-        transactions = [txn for txn in transactions if txn.date >= min_date]
-        logging.info(f'There are {len(transactions)} transactions to process from {min_date} to now')
-        logging.info(f'There are {len(existing_transactions)} existing transactions from {min_date} to now')
+        in_window = [txn for txn in transactions if txn.date >= min_date]
+        if len(in_window) < len(transactions):
+            logging.info('Ignoring %d transactions dated before %s', len(transactions) - len(in_window), min_date, extra={'source': source})
+            metrics.count('out_of_window', len(transactions) - len(in_window), source)
+        transactions = in_window
+        logging.info('There are %d transactions to process from %s to now', len(transactions), min_date)
+        logging.info('There are %d existing transactions from %s to now', len(existing_transactions), min_date)
     else:
         existing_transactions = db.get_transaction_list('source = ?', (source, )).transactions
 
     # Prune any exact matches
+    existing_map = index_transactions(existing_transactions, lambda txn: (txn.date, txn.amount, txn.description, txn.pending))
+    matched_ids = set()
     for txn in transactions:
-        for i, existing_txn in enumerate(existing_transactions):
-            if txn.date == existing_txn.date and txn.amount == existing_txn.amount and txn.description == existing_txn.description and txn.pending == existing_txn.pending:
-                # Found a match
-                txn.id = existing_txn.id
-                logging.info(f'Pruning existing transaction: {txn.id}, {txn.source}, {txn.date}, {txn.amount}, {txn.description}, {txn.pending}')
-                existing_transactions.pop(i)
-                break
-
-    logging.info(
-        f'There are {len([txn for txn in existing_transactions if txn.pending])} existing pending transactions which don\'t exactly match a new transaction')
-    logging.info(
-        f'There are {len([txn for txn in existing_transactions if not txn.pending])} existing posted transactions which don\'t exactly match a new transaction')
+        candidates = existing_map.get((txn.date, txn.amount, txn.description, txn.pending))
+        if candidates:
+            # Found a match
+            existing_txn = candidates.popleft()
+            txn.id = existing_txn.id
+            matched_ids.add(existing_txn.id)
+            txn_log.info('Pruning existing transaction: %s, %s, %s, %s, %s, %s', txn.id, txn.source, txn.date, txn.amount, txn.description, txn.pending, extra=txn_event('txn_pruned', txn))
+    existing_transactions = [txn for txn in existing_transactions if txn.id not in matched_ids]
+    metrics.count('pruned', len(matched_ids), source)
+
+    pending_count = sum(1 for txn in existing_transactions if txn.pending)
+    logging.info('There are %d existing pending transactions which don\'t exactly match a new transaction', pending_count)
+    logging.info('There are %d existing posted transactions which don\'t exactly match a new transaction', len(existing_transactions) - pending_count)
     if not existing_transactions:
         # All existing transactions accounted for, so any remaining new ones need to be inserted
         return [txn for txn in transactions if not txn.id], []
@@ -114,73 +281,74 @@ def prune_existing_transactions(transactions: List[Transaction], source: str, db
     # Assume pending transactions don't change, so any left over need to be inserted
     new_pending_transactions = [txn for txn in transactions if txn.pending and not txn.id]
     if new_pending_transactions:
-        logging.info(f'Found {len(new_pending_transactions)} new pending transactions')
+        logging.info('Found %d new pending transactions', len(new_pending_transactions))
 
     # Any existing posted transaction that are leftover are likely a problem, but
     # we don't want to remove them, so flag them
     for txn in existing_transactions:
         if not txn.pending:
-            logging.info(f'WARNING: Existing posted transaction is missing from new transactions: {txn.id}, {txn.source}, {txn.date}, {txn.amount}, {txn.description}')
+            txn_log.info('WARNING: Existing posted transaction is missing from new transactions: %s, %s, %s, %s, %s', txn.id, txn.source, txn.date, txn.amount, txn.description, extra=txn_event('txn_missing', txn))
 
     # Get the remaining posted transactions and pending existing transactions
     transactions = [txn for txn in transactions if not txn.pending and not txn.id]
     existing_transactions = [txn for txn in existing_transactions if txn.pending]
     if transactions:
-        logging.info(f'Found {len(transactions)} posted transactions that are either new or need to replace a pending transaction')
+        logging.info('Found %d posted transactions that are either new or need to replace a pending transaction', len(transactions))
 
     # Match up new posted transactions with existing pending transactions that match exactly
+    existing_map = index_transactions(existing_transactions, lambda txn: (txn.date, txn.amount, txn.description))
+    matched_ids = set()
     for txn in transactions:
-        for i, existing_txn in enumerate(existing_transactions):
-            if txn.date == existing_txn.date and txn.amount == existing_txn.amount and txn.description == existing_txn.description:
-                txn.id = existing_txn.id
-                db.update_transaction(txn.id, txn)
-                logging.info(f'Pending transaction posted with exact match: {txn.id}, {txn.source}, {txn.date}, {txn.amount}, {txn.description}')
-                existing_transactions.pop(i)
-                break
+        candidates = existing_map.get((txn.date, txn.amount, txn.description))
+        if candidates:
+            existing_txn = candidates.popleft()
+            txn.id = existing_txn.id
+            db.update_transaction(txn.id, txn)
+            matched_ids.add(existing_txn.id)
+            txn_log.info('Pending transaction posted with exact match: %s, %s, %s, %s, %s', txn.id, txn.source, txn.date, txn.amount, txn.description, extra=txn_event('txn_posted', txn))
+    existing_transactions = [txn for txn in existing_transactions if txn.id not in matched_ids]
+    metrics.count('posted_matched', len(matched_ids), source)
 
     # Clear any matched transactions
     transactions = [txn for txn in transactions if not txn.id]
 
     # Match up new posted transactions with existing pending transactions on the same day with modified description
-    for txn in transactions:
-        descr_map = {txn.description.lower(): (i, existing_txn) for i, existing_txn in enumerate(existing_transactions)
-                     if existing_txn.amount == txn.amount and existing_txn.date == txn.date}
-        matches = get_close_matches(txn.description.lower(), descr_map.keys(), cutoff=0.75)
-        if matches:
-            i, existing_txn = descr_map[matches[0]]
-            txn.id = existing_txn.id
-            db.update_transaction(txn.id, txn)
-            logging.info(f'Pending transaction posted with same day partial match: {txn.id}, {txn.source}, {txn.date}, {txn.amount}, {existing_txn.description} -> {txn.description}')
-            existing_transactions.pop(i)
+    for txn, existing_txn in match_partial(transactions, existing_transactions, lambda txn: (txn.amount, txn.date)):
+        txn.id = existing_txn.id
+        db.update_transaction(txn.id, txn)
+        txn_log.info('Pending transaction posted with same day partial match: %s, %s, %s, %s, %s -> %s', txn.id, txn.source, txn.date, txn.amount, existing_txn.description, txn.description, extra=txn_event('txn_posted', txn))
+    matched_ids = {txn.id for txn in transactions if txn.id}
+    existing_transactions = [existing_txn for existing_txn in existing_transactions if existing_txn.id not in matched_ids]
+    metrics.count('fuzzy_matched', len(matched_ids), source)
 
     # Clear any matched transactions
     transactions = [txn for txn in transactions if not txn.id]
 
     # Match up new posted transactions with existing pending transactions on a different day with same description
+    existing_map = index_transactions(existing_transactions, lambda txn: (txn.amount, txn.description))
+    matched_ids = set()
     for txn in transactions:
-        for i, existing_txn in enumerate(existing_transactions):
-            if txn.amount == existing_txn.amount and txn.description == existing_txn.description:
-                txn.id = existing_txn.id
-                db.update_transaction(txn.id, txn)
-                logging.info(f'Pending transaction posted with different day exact match: {txn.id}, {txn.source}, {existing_txn.date} -> {txn.date}, {txn.amount}, {txn.description}')
-                existing_transactions.pop(i)
-                break
+        candidates = existing_map.get((txn.amount, txn.description))
+        if candidates:
+            existing_txn = candidates.popleft()
+            txn.id = existing_txn.id
+            db.update_transaction(txn.id, txn)
+            matched_ids.add(existing_txn.id)
+            txn_log.info('Pending transaction posted with different day exact match: %s, %s, %s -> %s, %s, %s', txn.id, txn.source, existing_txn.date, txn.date, txn.amount, txn.description, extra=txn_event('txn_posted', txn))
+    existing_transactions = [txn for txn in existing_transactions if txn.id not in matched_ids]
+    metrics.count('posted_matched', len(matched_ids), source)
 
     # Clear any matched transactions
     transactions = [txn for txn in transactions if not txn.id]
 
     # Match up new posted transactions with existing pending transactions on a different day with modified description
-    for txn in transactions:
-        descr_map = {txn.description.lower(): existing_txn for existing_txn in existing_transactions
-                     if existing_txn.amount == txn.amount}
-        matches = get_close_matches(txn.description.lower(), descr_map.keys(), cutoff=0.75)
-        if matches:
-            existing_txn = descr_map[matches[0]]
-            txn.id = existing_txn.id
-            db.update_transaction(txn.id, txn)
-            logging.info(f'Pending transaction posted with different day partial match: {txn.id}, {txn.source}, {existing_txn.date} -> {txn.date}, {txn.amount}, {existing_txn.description} -> {txn.description}')
-            existing_transactions.pop(i)
-            break
+    for txn, existing_txn in match_partial(transactions, existing_transactions, lambda txn: (txn.amount,), PENDING_MAX_DAYS):
+        txn.id = existing_txn.id
+        db.update_transaction(txn.id, txn)
+        txn_log.info('Pending transaction posted with different day partial match: %s, %s, %s -> %s, %s, %s -> %s', txn.id, txn.source, existing_txn.date, txn.date, txn.amount, existing_txn.description, txn.description, extra=txn_event('txn_posted', txn))
+    matched_ids = {txn.id for txn in transactions if txn.id}
+    existing_transactions = [existing_txn for existing_txn in existing_transactions if existing_txn.id not in matched_ids]
+    metrics.count('fuzzy_matched', len(matched_ids), source)
 
     # Clear any matched transactions
     transactions = [txn for txn in transactions if not txn.id]
@@ -191,7 +359,45 @@ def prune_existing_transactions(transactions: List[Transaction], source: str, db
     return to_insert, to_delete
 
 
-def process_transactions(transactions: List[Transaction], source: str, db, min_date: str = None) -> int:
+def ingest_window(source: str, db, default_days: int, margin_days: int = WATERMARK_MARGIN_DAYS, today: Optional[datetime.date] = None) -> str:
+    '''
+    Get the earliest date that a source's transactions can still change. That
+    is a margin before the latest posted transaction, widened back to the oldest
+    pending transaction if it is earlier. Anything older has settled, so it
+    doesn't need to be read or reconciled again.
+
+    Transactions that are pending first are covered by the oldest pending one.
+    The margin covers those that are posted without being pending first, which
+    banks can date a few days before the latest posted one. Anything dated
+    earlier than that is ignored and counted as out_of_window, so the margin
+    should be raised for banks that post later than that.
+
+    The window is never wider than the default number of days, apart from an
+    older pending transaction, which is also all that sources without a
+    watermark use.
+
+    Args:
+        source: The source of the transactions
+        db: The database object
+        default_days: The most days to go back, apart from pending transactions
+        margin_days: The number of days before the latest posted transaction to include
+        today: The current date
+
+    Returns:
+        The earliest date in YYYY-MM-DD
+    '''
+    today = today or datetime.date.today()
+    watermark = db.get_watermark(source)
+    start = today - datetime.timedelta(days=default_days)
+    if watermark and watermark.last_posted:
+        start = max(start, datetime.date.fromisoformat(watermark.last_posted) - datetime.timedelta(days=margin_days))
+    if watermark and watermark.oldest_pending:
+        start = min(start, datetime.date.fromisoformat(watermark.oldest_pending))
+    return min(start, today).strftime('%Y-%m-%d')
+
+
+def process_transactions(transactions: List[Transaction], source: str, db, min_date: Optional[str] = None,
+                         metrics: Optional[IngestMetrics] = None) -> List[Transaction]:
     '''
     Inserts transactions into the database
 
@@ -200,21 +406,181 @@ def process_transactions(transactions: List[Transaction], source: str, db, min_d
         source: The source of the transactions
         db: The database object
         min_date: Ignore all transactions before this date
+        metrics: Records the time spent in each stage and the number of transactions
+
+    Returns:
+        The list of newly inserted transactions
     '''
-    logging.info(f'Processing {len(transactions)} transactions')
-    to_insert, to_delete = prune_existing_transactions(transactions, source, db, min_date)
+    metrics = metrics or IngestMetrics()
+    logging.info('Processing %d transactions', len(transactions))
+    with db.transaction():
+        with db.savepoint('reconcile_transactions'), metrics.stage('prune', source):
+            to_insert, to_delete = prune_existing_transactions(transactions, source, db, min_date, metrics)
+
+        with db.savepoint('insert_transactions'), metrics.stage('insert', source):
+            for txn in to_insert:
+                new_txn = db.add_transaction(txn)
+                txn_log.info('Inserted new transaction: %s, %s, %s, %s, %s, %s', new_txn.id, new_txn.source, new_txn.date, new_txn.amount, new_txn.description, new_txn.pending, extra=txn_event('txn_inserted', new_txn))
 
-    for txn in to_insert:
-        new_txn = db.add_transaction(txn)
-        logging.info(f'Inserted new transaction: {new_txn.id}, {new_txn.source}, {new_txn.date}, {new_txn.amount}, {new_txn.description}, {new_txn.pending}')
+        with db.savepoint('delete_transactions'), metrics.stage('delete', source):
+            db.delete_transactions([txn.id for txn in to_delete])
+            for txn in to_delete:
+                txn_log.info('Deleted pending transaction: %s, %s, %s, %s, %s', txn.id, txn.source, txn.date, txn.amount, txn.description, extra=txn_event('txn_deleted', txn))
 
-    db.delete_transactions([txn.id for txn in to_delete])
-    for txn in to_delete:
-        logging.info(f'Deleted pending transaction: {txn.id}, {txn.source}, {txn.date}, {txn.amount}, {txn.description}')
+    metrics.count('inserted', len(to_insert), source)
+    metrics.count('deleted', len(to_delete), source)
 
     logging.info('Completed processing transactions')
 
-    return len(to_insert)
+    return to_insert
+
+
+def parse_replay(lines: Iterable[str], config: Dict, out: queue.Queue, stop: threading.Event) -> None:
+    '''
+    Parse replay lines into transactions, and put them on a queue to be
+    processed. A None marks the end of the lines, and any exception is passed
+    through the queue instead.
+
+    Args:
+        lines: The raw lines to parse
+        config: Configuration data
+        out: The queue to put (source, transactions) pairs on
+        stop: Set by the consumer to stop parsing early
+    '''
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    try:
+        for line in lines:
+            if debug:
+                logging.debug('%s', line.strip())
+            data = json.loads(line)
+            if not data['transactions']:
+                continue
+            source = data['transactions'][0]['source']
+            scraper = config['scrapers'][source]
+            txn_list = [Transaction(**txn) for txn in data['transactions'] if txn['date'] >= scraper['start_date']]
+            if not put((source, txn_list)):
+                return
+        put(None)
+    except Exception as exc:
+        put(exc)
+
+
+def replay_transactions(lines: Iterable[str], config: Dict, db, min_date: Optional[str] = None, metrics: Optional[IngestMetrics] = None) -> List[Transaction]:
+    '''
+    Replay previously scraped transactions. The lines are parsed in a separate
+    thread while the previous ones are written to the database, and the
+    balances are only updated once per source at the end.
+
+    Args:
+        lines: The raw lines to replay, each with a set of scraped transactions
+        config: Configuration data
+        db: The database object
+        min_date: Ignore all transactions before this date
+        metrics: Records the time spent in each stage and the number of transactions
+
+    Returns:
+        The list of newly inserted transactions
+    '''
+    metrics = metrics or IngestMetrics()
+    parsed: queue.Queue = queue.Queue(maxsize=REPLAY_QUEUE_SIZE)
+    stop = threading.Event()
+    parser = threading.Thread(target=parse_replay, args=(lines, config, parsed, stop), daemon=True)
+
+    inserted: List[Transaction] = []
+    sources = []
+    line_count = 0
+    row_count = 0
+    start = time.perf_counter()
+    parser.start()
+    try:
+        while True:
+            # Time spent waiting here means the parser can't keep up
+            with metrics.stage('parse_wait'):
+                item = parsed.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            source, txn_list = item
+            metrics.count('fetched', len(txn_list), source)
+            inserted += process_transactions(txn_list, source, db, min_date, metrics)
+            if source not in sources:
+                sources.append(source)
+            line_count += 1
+            row_count += len(txn_list)
+
+        with db.transaction():
+            for source in sources:
+                with metrics.stage('balance', source):
+                    db.update_balance(source, config['scrapers'][source]['start_balance'])
+                    db.update_watermark(source)
+    finally:
+        stop.set()
+        parser.join()
+
+    elapsed = time.perf_counter() - start
+    logging.info('Replayed %d lines with %d transactions in %.2fs (%.0f rows/sec)', line_count, row_count, elapsed, row_count / elapsed if elapsed else 0)
+    return inserted
+
+
+def categorise_transactions(transactions: List[Transaction], db, engine: str = 'tfidf', threshold: float = 0.9) -> int:
+    '''
+    Categorise newly inserted transactions in a single batch. The best category
+    and location are applied if they score at least the threshold, otherwise
+    they are stored as a suggestion for manual triage.
+
+    Args:
+        transactions: The list of newly inserted transactions
+        db: The database object
+        engine: The name of the categorisation engine to use
+        threshold: The minimum score needed to apply a category/location
+
+    Returns:
+        The number of transactions that were fully categorised
+    '''
+    if not transactions:
+        return 0
+
+    categoriser = CategoriserIndex().get(db) if engine == 'tfidf' else ENGINES[engine].from_database(db)
+    results = categoriser.categorise_batch([txn.description for txn in transactions])
+    count = 0
+    for txn, res in zip(transactions, results):
+        assert txn.id is not None
+        if not res.categories or not res.locations:
+            continue
+        category = res.categories[0]
+        location = res.locations[0]
+        alloc = db.get_txn_allocations(txn.id).allocations[0]
+        changed = False
+        if category.score >= threshold and alloc.category != category.name:
+            alloc.category = category.name
+            changed = True
+        if location.score >= threshold and alloc.location != location.name:
+            alloc.location = location.name
+            changed = True
+        # Each update bumps the description map version and the change feed
+        if changed:
+            db.update_allocation(alloc)
+
+        if category.score >= threshold and location.score >= threshold:
+            txn_log.info('Auto-categorised transaction: %s, %s -> %s (%.2f), %s (%.2f)', txn.id, txn.description, category.name, category.score, location.name, location.score, extra=txn_event('txn_categorised', txn))
+            count += 1
+        else:
+            db.set_suggestion(Suggestion(txn_id=txn.id, category=category.name, category_score=category.score,
+                                         location=location.name, location_score=location.score))
+            txn_log.info('Suggested category for transaction: %s, %s -> %s (%.2f), %s (%.2f)', txn.id, txn.description, category.name, category.score, location.name, location.score, extra=txn_event('txn_suggested', txn))
+
+    logging.info('Auto-categorised %d of %d new transactions', count, len(transactions))
+    return count
 
 
 def parse_args():  # pragma: no cover
@@ -226,18 +592,12 @@ def parse_args():  # pragma: no cover
     parser.add_argument('--config', required=True, help='Path to the budget config file')
     parser.add_argument('--balance', action='store_true', help='Only update the balances, don\'t run the scrapers')
     parser.add_argument('--notification', help='Send a test push notification')
+    parser.add_argument('--update-merchants', action='store_true', help='Renormalise the merchant of every transaction, then exit')
     parser.add_argument('--replay-path', help='Path to file with raw transactions to replay, one set per line')
-    parser.add_argument('--lastx-days', type=int, default=10, help='Only process transactions from the lastx days')
-
-    args = parser.parse_args()
-
-    logging.basicConfig(filename=args.log,
-                        filemode='a',
-                        format='%(asctime)s | %(levelname)-8s | %(message)s',
-                        datefmt='%Y/%m/%d %H:%M:%S',
-                        level=logging.DEBUG)
+    parser.add_argument('--job-id', type=int, help='The scheduler job this run is for')
+    parser.add_argument('--lastx-days', type=int, default=10, help='Only process transactions from the lastx days, or fewer for sources with a watermark')
 
-    return args
+    return parser.parse_args()
 
 
 def main(args):  # pragma: no cover
@@ -249,55 +609,102 @@ def main(args):  # pragma: no cover
     '''
     with open(args.config) as fp:
         config = json.load(fp)
+    Database.normaliser = MerchantNormaliser(config.get('merchant_rules'))
 
-    with Database() as db:
+    setup_logging(args.log,
+                  parse_level(config.get('log_level', 'DEBUG')),
+                  parse_level(config.get('txn_log_level', 'INFO')),
+                  config.get('log_retention_days', LOG_RETENTION_DAYS))
+
+    # The scraped data is written from run_scrapers' writer thread
+    with Database(shared=True) as db:
         if args.notification:
             send_push_notification(json.loads(args.notification), config, db)
             return
 
-        count = 0
+        if args.update_merchants:
+            db.update_merchants()
+            return
+
+        inserted: List[Transaction] = []
+        failed = 0
 
         min_date = (datetime.date.today() - datetime.timedelta(days=args.lastx_days)).strftime('%Y-%m-%d')
 
-        if args.replay_path:
-            with open(args.replay_path) as fp:
-                lines = fp.readlines()
-                for line in lines:
-                    logging.debug(line.strip())
-                    transactions = json.loads(line)
-                    source = transactions['transactions'][0]['source']
-                    scraper = config['scrapers'][source]
-                    if transactions['transactions']:
-                        txn_list = [Transaction(**txn) for txn in transactions['transactions'] if txn['date'] >= scraper['start_date']]
-                        count += process_transactions(txn_list, source, db, min_date)
-                        db.update_balance(source, scraper['start_balance'])
-        else:
-            for name, scraper in config['scrapers'].items():
-                if args.balance:
+        job_id = args.job_id
+        if job_id is None and not args.replay_path and not args.balance:
+            # Scrapes started outside the scheduler are recorded as jobs too, so
+            # only one runs at a time. The job starts out running, so the
+            # scheduler can't claim it as well.
+            job = db.add_job('cli', state='running')
+            if job is None:
+                logging.warning('Not scraping, as another scrape is already queued or running')
+                return 1
+            job_id = job.id
+        if job_id is not None:
+            db.set_job_pid(job_id, os.getpid())
+
+        metrics = IngestMetrics(job_id)
+        error = None
+        try:
+            if args.replay_path:
+                with open(args.replay_path) as fp:
+                    inserted = replay_transactions(fp, config, db, min_date, metrics)
+            elif args.balance:
+                for name, scraper in config['scrapers'].items():
                     db.update_balance(name, scraper['start_balance'])
-                    continue
-
-                data = run_scraper(args, config, scraper)
-                transactions = [Transaction(**txn) for txn in data['transactions'] if txn['date'] >= scraper['start_date']]
-                count += process_transactions(transactions, name, db, min_date)
-                balance, pending = db.update_balance(name, scraper['start_balance'])
-                if balance == data['balance']:
-                    logging.info(f'Posted balance of {balance} is correct')
-                else:
-                    logging.error(f'Incorrect posted balance. Database has {balance} while scraper found {data["balance"]}')
-                if pending == data['pending']:
-                    logging.info(f'Pending balance of {pending} is correct')
-                else:
-                    logging.error(f'Incorrect pending balance. Database has {pending} while scraper found {data["pending"]}')
-
-        if count > 0:
-            # Send push notifications if new transactions were found
-            send_push_notification({
-                'type': 'new_transactions',
-                'count': count,
-            }, config, db)
-
-    return 0
+            else:
+                def handle(name: str, scraper: Dict, data: Dict) -> None:
+                    nonlocal inserted
+                    with metrics.stage('parse', name):
+                        transactions = [Transaction(**txn) for txn in data['transactions'] if txn['date'] >= scraper['start_date']]
+                    metrics.count('fetched', len(transactions), name)
+                    min_date = ingest_window(name, db, args.lastx_days, config.get('watermark_margin_days', WATERMARK_MARGIN_DAYS))
+                    # The source's changes and balances are committed together, or not at all
+                    with db.transaction():
+                        new_transactions = process_transactions(transactions, name, db, min_date, metrics)
+                        with metrics.stage('balance', name):
+                            balance, pending = db.update_balance(name, scraper['start_balance'])
+                            db.update_watermark(name)
+                    inserted += new_transactions
+                    if balance == data['balance']:
+                        logging.info('Posted balance of %s is correct', balance, extra={'event': 'balance', 'source': name})
+                    else:
+                        logging.error('Incorrect posted balance. Database has %s while scraper found %s', balance, data['balance'], extra={'event': 'balance', 'source': name})
+                    if pending == data['pending']:
+                        logging.info('Pending balance of %s is correct', pending, extra={'event': 'balance', 'source': name})
+                    else:
+                        logging.error('Incorrect pending balance. Database has %s while scraper found %s', pending, data['pending'], extra={'event': 'balance', 'source': name})
+
+                failed = asyncio.run(run_scrapers(args, config, handle, metrics))
+
+            if 'auto_categorise' in config:
+                with metrics.stage('categorise'):
+                    categorise_transactions(inserted, db, **config['auto_categorise'])
+
+            # Bring the categorisation index up to date, so the API doesn't have to
+            with metrics.stage('index'):
+                CategoriserIndex().get(db)
+
+            if inserted:
+                # Send push notifications if new transactions were found
+                with metrics.stage('push'):
+                    send_push_notification({
+                        'type': 'new_transactions',
+                        'count': len(inserted),
+                    }, config, db)
+        except Exception as exc:
+            error = str(exc)
+            raise
+        finally:
+            if job_id is not None:
+                db.finish_job(job_id, len(inserted), failed, error or (f'{failed} scrapers failed' if failed else None))
+            if not args.balance:
+                with db.transaction():
+                    run = db.add_metric_run(metrics.finish())
+                logging.info('Ingest run %s stages: %s counts: %s', run.id, json.dumps(run.stages), json.dumps(run.counts), extra={'event': 'ingest_run'})
+
+    return 1 if failed else 0
 
 
 if __name__ == '__main__':  # pragma: no cover
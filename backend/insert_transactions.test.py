@@ -8,15 +8,24 @@
 #
 
 # System imports
+import os
 import sys
 import copy
+import json
+import datetime
+import time
+import asyncio
+import argparse
+import tempfile
 import unittest
-from typing import List
+import threading
+from typing import Dict, List
 
 # Local imports
-from insert_transactions import process_transactions
+from insert_transactions import process_transactions, categorise_transactions, run_scrapers, replay_transactions, ingest_window
 from database import Database
 from model import Transaction
+from metrics import IngestMetrics
 
 
 class TestInsertTransactions(unittest.TestCase):
@@ -85,6 +94,7 @@ class TestInsertTransactions(unittest.TestCase):
         self.db.db.execute('DELETE FROM category WHERE id > 1')
         self.db.db.execute('DELETE FROM location WHERE id > 1')
         self.db.db.execute('DELETE FROM allocation')
+        self.db.db.execute('DELETE FROM watermark')
         return super().setUp()
 
     def tearDown(self) -> None:
@@ -210,6 +220,57 @@ class TestInsertTransactions(unittest.TestCase):
         txn_list = self.db.get_transaction_list()
         self.assertEqual(len(txn_list.transactions), len(self.dummy_data + self.bar_dummy_data) + 1)
 
+    def test_partial_match_best_first(self) -> None:
+        pending = Transaction(
+            date='2023-08-05',
+            description='FASTFOOD DT 0398 QWERTY FOO',
+            amount=-7745,
+            source='bank of foo',
+            pending=True
+        )
+        self.db.add_transaction(pending)
+        assert pending.id is not None
+
+        # The first posted transaction is a close enough match, but the second is a better one
+        posted = [
+            Transaction(date='2023-08-05', description='FASTFOOD DT 0398 QWERTY FOOVILLE AU XXXX-XXXX-XXXX-2837', amount=-7745, source='bank of foo'),
+            Transaction(date='2023-08-05', description='FASTFOOD DT 0398 QWERTY FOO AU', amount=-7745, source='bank of foo'),
+        ]
+        process_transactions(posted, 'bank of foo', self.db)
+
+        txn_list = self.db.get_transaction_list()
+        updated_pending = self.db.get_transaction(pending.id)
+        assert updated_pending is not None
+        self.assertEqual(len(txn_list.transactions), 2)
+        self.assertEqual(updated_pending.description, 'FASTFOOD DT 0398 QWERTY FOO AU')
+        self.assertFalse(updated_pending.pending)
+
+    def test_partial_match_different_day(self) -> None:
+        pending = [
+            Transaction(date='2023-08-03', description='ALLDAY PET INSURANCE', amount=-7745, source='bank of foo', pending=True),
+            Transaction(date='2023-08-03', description='PETROL EXPRESS SOMETOWN', amount=-28732, source='bank of foo', pending=True),
+            Transaction(date='2023-06-01', description='QWERTY FACES PTY', amount=-97420, source='bank of foo', pending=True),
+        ]
+        for txn in pending:
+            self.db.add_transaction(txn)
+
+        posted = [
+            Transaction(date='2023-08-05', description='ALLDAY PET INSURANC    FOOVILLE    AU', amount=-7745, source='bank of foo'),
+            Transaction(date='2023-08-04', description='PETROL EXPRESS 1830       SOMETOWN    AU', amount=-28732, source='bank of foo'),
+            Transaction(date='2023-08-03', description='QWERTY FACES PTY LT   FOOVILLE     AU', amount=-97420, source='bank of foo'),
+        ]
+        process_transactions(posted, 'bank of foo', self.db)
+
+        # Both recent pending transactions are matched, the one outside the window is replaced
+        txn_list = self.db.get_transaction_list()
+        self.assertEqual(len(txn_list.transactions), 3)
+        self.assertIsNone(self.db.get_transaction(pending[2].id))
+        for txn, expected in zip(pending[:2], posted[:2]):
+            updated = self.db.get_transaction(txn.id)
+            assert updated is not None
+            self.assertEqual(updated.description, expected.description)
+            self.assertEqual(updated.date, expected.date)
+
     def test_already_existing_multiple_identcal(self) -> None:
         process_transactions(self.dummy_data, 'bank of foo', self.db)
         process_transactions(self.bar_dummy_data, 'Bar Inc', self.db)
@@ -249,5 +310,210 @@ class TestInsertTransactions(unittest.TestCase):
             running_totals[txn.source] += txn.amount
             self.assertEqual(txn.balance, running_totals[txn.source])
 
+    def test_ingest_window(self) -> None:
+        today = datetime.date(2023, 8, 10)
+
+        # With no watermark, fall back to the default number of days
+        self.assertEqual(ingest_window('bank of foo', self.db, 10, 3, today), '2023-07-31')
+
+        # A recent posted transaction narrows the window to a margin before it
+        self.db.add_transaction(Transaction(date='2023-08-06', description='POSTED', amount=-100, source='bank of foo'))
+        self.db.update_watermark('bank of foo')
+        self.assertEqual(ingest_window('bank of foo', self.db, 10, 3, today), '2023-08-03')
+
+        # Back to the oldest pending transaction, even past the default
+        self.db.add_transaction(Transaction(date='2023-07-20', description='PENDING', amount=-100, source='bank of foo', pending=True))
+        self.db.update_watermark('bank of foo')
+        self.assertEqual(ingest_window('bank of foo', self.db, 10, 3, today), '2023-07-20')
+
+        # But an old posted transaction doesn't widen it past the default
+        self.db.db.execute('DELETE FROM txn')
+        self.db.add_transaction(Transaction(date='2023-07-25', description='POSTED', amount=-100, source='bank of foo'))
+        self.db.update_watermark('bank of foo')
+        self.assertEqual(ingest_window('bank of foo', self.db, 10, 3, today), '2023-07-31')
+
+        # Never in the future
+        self.assertEqual(ingest_window('bank of foo', self.db, -5, 3, today), '2023-08-10')
+        self.db.db.execute('DELETE FROM txn')
+        self.db.update_watermark('bank of foo')
+        self.assertEqual(ingest_window('bank of foo', self.db, -5, 3, today), '2023-08-10')
+
+    def test_ingest_window_prunes_history(self) -> None:
+        old = self.db.add_transaction(Transaction(date='2023-07-01', description='OLD POSTED', amount=-100, source='bank of foo'))
+        process_transactions(self.dummy_data, 'bank of foo', self.db)
+        self.db.update_watermark('bank of foo')
+        last_posted = max(txn.date for txn in self.dummy_data)
+
+        # Only transactions since a margin before the latest posted one are
+        # reconciled, which is fewer than the default number of days
+        min_date = ingest_window('bank of foo', self.db, 10, 3, datetime.date(2023, 8, 10))
+        self.assertEqual(min_date, (datetime.date.fromisoformat(last_posted) - datetime.timedelta(days=3)).strftime('%Y-%m-%d'))
+        self.assertGreater(min_date, '2023-07-31')
+        metrics = IngestMetrics()
+        late = Transaction(date='2023-07-30', description='TOO OLD', amount=-100, source='bank of foo')
+        process_transactions([late, *copy.deepcopy(self.dummy_data[5:])], 'bank of foo', self.db, min_date, metrics)
+        self.assertEqual(len(self.db.get_transaction_list().transactions), len(self.dummy_data) + 1)
+        self.assertIsNotNone(self.db.get_transaction(old.id))
+        self.assertEqual(metrics.counts['bank of foo']['out_of_window'], 1)
+
+    def test_late_posted_transaction(self) -> None:
+        process_transactions(copy.deepcopy(self.dummy_data), 'bank of foo', self.db)
+        self.db.update_watermark('bank of foo')
+        last_posted = max(txn.date for txn in self.dummy_data if not txn.pending)
+        today = datetime.date.fromisoformat(last_posted) + datetime.timedelta(days=1)
+
+        # A transaction posted today, but dated a week before the latest posted one
+        late_date = (datetime.date.fromisoformat(last_posted) - datetime.timedelta(days=7)).strftime('%Y-%m-%d')
+        late = Transaction(date=late_date, description='LATE POSTED', amount=-4321, source='bank of foo')
+
+        # Is outside the default margin, so it is ignored
+        metrics = IngestMetrics()
+        min_date = ingest_window('bank of foo', self.db, 30, 3, today)
+        self.assertEqual(process_transactions([*copy.deepcopy(self.dummy_data), copy.deepcopy(late)], 'bank of foo', self.db, min_date, metrics), [])
+        self.assertEqual(metrics.counts['bank of foo']['out_of_window'], 1)
+
+        # But is found with a margin wide enough for the bank
+        min_date = ingest_window('bank of foo', self.db, 30, 10, today)
+        self.assertLessEqual(min_date, late_date)
+        self.assertGreater(min_date, (today - datetime.timedelta(days=30)).strftime('%Y-%m-%d'))
+        inserted = process_transactions([*copy.deepcopy(self.dummy_data), late], 'bank of foo', self.db, min_date)
+        self.assertEqual([txn.description for txn in inserted], ['LATE POSTED'])
+
+    def test_metrics(self) -> None:
+        self.db.add_transaction(copy.deepcopy(self.dummy_data[0]))
+        self.db.add_transaction(Transaction(date='2023-08-03', description='PETROL EXPRESS 1830 SOMETOWN', amount=-28732, source='bank of foo', pending=True))
+        self.db.add_transaction(Transaction(date='2023-08-05', description='ALLDAY PET INSURANC    FOOVILLE    AU', amount=-7745, source='bank of foo', pending=True))
+        self.db.add_transaction(Transaction(date='2023-08-02', description='GONE', amount=-1, source='bank of foo', pending=True))
+
+        metrics = IngestMetrics()
+        process_transactions(self.dummy_data, 'bank of foo', self.db, metrics=metrics)
+        self.assertEqual(metrics.counts['bank of foo'], {'pruned': 1, 'posted_matched': 1, 'fuzzy_matched': 1, 'inserted': 4, 'deleted': 1})
+        self.assertEqual(set(metrics.stages['bank of foo']), {'prune', 'insert', 'delete'})
+
+    def test_replay(self) -> None:
+        config = {'scrapers': {
+            'bank of foo': {'start_date': '2023-08-04', 'start_balance': 2234},
+            'Bar Inc': {'start_date': '2023-01-01', 'start_balance': -48392},
+        }}
+        lines = [
+            json.dumps({'transactions': [txn.dict() for txn in self.dummy_data]}),
+            json.dumps({'transactions': []}),
+            json.dumps({'transactions': [txn.dict() for txn in self.bar_dummy_data]}),
+            json.dumps({'transactions': [txn.dict() for txn in self.dummy_data]}),
+        ]
+        inserted = replay_transactions(iter(lines), config, self.db)
+
+        # Only the bank of foo transactions after its start date are replayed, once
+        self.assertEqual(len(inserted), 2 + len(self.bar_dummy_data))
+        txn_list = self.db.get_transaction_list('1 ORDER BY date ASC, id ASC')
+        self.assertEqual(len(txn_list.transactions), len(inserted))
+        running_totals = {source: scraper['start_balance'] for source, scraper in config['scrapers'].items()}
+        for txn in txn_list.transactions:
+            running_totals[txn.source] += txn.amount
+            self.assertEqual(txn.balance, running_totals[txn.source])
+
+    def test_replay_invalid_line(self) -> None:
+        config = {'scrapers': {'bank of foo': {'start_date': '2023-01-01', 'start_balance': 0}}}
+        lines = [json.dumps({'transactions': [txn.dict() for txn in self.dummy_data]}), 'not json']
+        with self.assertRaises(json.JSONDecodeError):
+            replay_transactions(lines, config, self.db)
+        # Lines before the invalid one were still committed
+        self.assertEqual(len(self.db.get_transaction_list().transactions), len(self.dummy_data))
+
+    def test_failed_source_rolled_back(self) -> None:
+        pending = self.db.add_transaction(Transaction(date='2023-08-01', description='OLD PENDING', amount=-100, source='bank of foo', pending=True))
+        assert pending.id is not None
+
+        def fail(ids: List[int]) -> None:
+            raise RuntimeError('delete failed')
+        self.db.delete_transactions = fail  # type: ignore
+        with self.assertRaises(RuntimeError):
+            process_transactions(self.dummy_data, 'bank of foo', self.db)
+        del self.db.delete_transactions
+
+        # None of the source's changes were applied
+        txn_list = self.db.get_transaction_list()
+        self.assertEqual([txn.id for txn in txn_list.transactions], [pending.id])
+
+    def test_categorise_new_transactions(self) -> None:
+        for txn in process_transactions(self.dummy_data, 'bank of foo', self.db):
+            assert txn.id is not None
+            alloc = self.db.get_txn_allocations(txn.id).allocations[0]
+            alloc.category = 'Transport' if 'PETROL' in txn.description else 'Groceries'
+            alloc.location = 'Sometown'
+            self.db.update_allocation(alloc)
+
+        new_txns = process_transactions([
+            Transaction(date='2023-08-10', description='PETROL EXPRESS 1830       SOMETOWN    AU', amount=-5000, source='bank of foo'),
+            Transaction(date='2023-08-10', description='Something never seen before', amount=-100, source='bank of foo'),
+        ], 'bank of foo', self.db)
+        self.assertEqual(len(new_txns), 2)
+        for engine in ['difflib', 'tfidf']:
+            self.assertEqual(categorise_transactions(new_txns, self.db, engine, 0.9), 1)
+
+        # Allocations that are already right aren't written again, so the index
+        # and the change feed are left alone
+        version = self.db.get_description_map_version()
+        changes = self.db.db.execute('SELECT MAX(version) FROM change').fetchone()[0]
+        self.assertEqual(categorise_transactions(new_txns, self.db, 'difflib', 0.9), 1)
+        self.assertEqual(self.db.get_description_map_version(), version)
+        self.assertEqual(self.db.db.execute('SELECT MAX(version) FROM change').fetchone()[0], changes)
+
+        assert new_txns[0].id is not None and new_txns[1].id is not None
+        alloc = self.db.get_txn_allocations(new_txns[0].id).allocations[0]
+        self.assertEqual(alloc.category, 'Transport')
+        self.assertEqual(alloc.location, 'Sometown')
+        self.assertIsNone(self.db.get_suggestion(new_txns[0].id))
+
+        alloc = self.db.get_txn_allocations(new_txns[1].id).allocations[0]
+        self.assertEqual(alloc.category, 'Unknown')
+        self.assertEqual(alloc.location, 'Unknown')
+        suggestion = self.db.get_suggestion(new_txns[1].id)
+        assert suggestion is not None
+        self.assertLess(suggestion.category_score, 0.9)
+
+    def test_categorise_no_transactions(self) -> None:
+        self.assertEqual(categorise_transactions([], self.db), 0)
+
+    def test_run_scrapers_concurrently(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            script = os.path.join(tmp, 'scraper.py')
+            with open(script, 'w') as fp:
+                fp.write('import sys, time, json\n'
+                         'time.sleep(0.5)\n'
+                         'print(json.dumps({"transactions": [], "balance": 0, "pending": 0}))\n')
+            failing = os.path.join(tmp, 'failing.py')
+            with open(failing, 'w') as fp:
+                fp.write('import sys\nsys.exit(1)\n')
+
+            config = {
+                'node_path': sys.executable,
+                'scraper_concurrency': 3,
+                'scrapers': {
+                    'foo': {'path': script},
+                    'bar': {'path': script},
+                    'baz': {'path': script},
+                    'broken': {'path': failing},
+                },
+            }
+            handled = []
+            threads = set()
+
+            def handle(name: str, scraper: Dict, data: Dict) -> None:
+                handled.append(name)
+                threads.add(threading.current_thread().name)
+
+            start = time.perf_counter()
+            failed = asyncio.run(run_scrapers(argparse.Namespace(config='budget.json'), config, handle))
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual(failed, 1)
+        self.assertEqual(sorted(handled), ['bar', 'baz', 'foo'])
+
+        # Every result is written from the same thread, off the event loop
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads.pop().startswith('ingest-writer'))
+        self.assertLess(elapsed, 1.25)
+
 
 unittest.main()
@@ -0,0 +1,96 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# logs.bench.py: This file benchmarks reading the most recent lines of a large
+# log file
+#
+
+# System imports
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import tempfile
+from typing import List
+
+# Local imports
+from logs import tail
+
+
+def generate(path: str, size: int, seed: int) -> None:
+    '''
+    Write a log file of roughly the given size, in the format of budget.log.
+    Errors are rare, and mostly near the start of the file.
+
+    Args:
+        path: The path of the file to write
+        size: The size of the file in bytes
+        seed: The random seed
+    '''
+    rng = random.Random(seed)
+    lines = []
+    for i in range(10000):
+        level = 'DEBUG   ' if i % 3 else 'INFO    '
+        lines.append(f'2023/08/03 10:{i // 600 % 60:02}:{i // 10 % 60:02} | {level} | Pruning existing transaction: {rng.randint(1, 100000)}, '
+                     f'Bank of Foo, 2023-08-03, -{rng.randint(100, 100000)}, FOO BAR PTY LTD SOMETOWN AU, False\n')
+    chunk = ''.join(lines).encode()
+    error = b'2023/08/03 10:00:00 | ERROR    | Incorrect posted balance. Database has 100 while scraper found 200\n'
+
+    written = 0
+    with open(path, 'wb') as fp:
+        while written < size:
+            data = chunk if written > size // 10 else error + chunk
+            fp.write(data)
+            written += len(data)
+
+
+def full_scan(path: str, count: int, pattern: str) -> List[str]:
+    '''
+    The previous implementation, which scans the whole file from the start
+    '''
+    output = []
+    regex = re.compile(pattern)
+    with open(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if regex.search(line):
+                output.append(line)
+    return output[-count:]
+
+
+def main(args) -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'budget.log')
+        start = time.perf_counter()
+        generate(path, args.size * (1 << 20), args.seed)
+        print(f'Generated {os.path.getsize(path) / (1 << 20):.0f} MB log in {time.perf_counter() - start:.1f}s')
+
+        print(f'{"filter":<12} {"count":>6} {"tail (ms)":>10} {"full scan (ms)":>15}')
+        for pattern in ['', 'INFO', 'ERROR']:
+            start = time.perf_counter()
+            res = tail(path, args.count, pattern)
+            tail_time = time.perf_counter() - start
+
+            scan_time = float('nan')
+            if not args.skip_full_scan:
+                start = time.perf_counter()
+                expected = full_scan(path, args.count, pattern)
+                scan_time = time.perf_counter() - start
+                assert res == expected
+
+            print(f'{pattern or "(none)":<12} {args.count:>6} {tail_time * 1000:>10.1f} {scan_time * 1000:>15.1f}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark reading the end of the log file')
+    parser.add_argument('--size', type=int, default=1024, help='The size of the log file in MB')
+    parser.add_argument('--count', type=int, default=100, help='The number of lines to get')
+    parser.add_argument('--skip-full-scan', action='store_true', help='Don\'t time the previous implementation')
+    parser.add_argument('--seed', type=int, default=1, help='The random seed')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,531 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# logs.py: This file reads the most recent lines of the log file, and keeps a
+# structured copy of the log in a separate SQLite database
+#
+
+# System imports
+import os
+import re
+import time
+import logging
+import sqlite3
+import queue
+import atexit
+import datetime
+import threading
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, BinaryIO, Callable, Iterator, List, Optional, Pattern, Tuple
+
+# Local imports
+from database import Database
+from model import LogRecord
+
+
+LOG_PATH = 'budget.log'
+
+# Kept apart from the main database, so logging never waits on its write lock
+LOG_DB_PATH = os.environ.get('LOG_DB_PATH') or Database.DB_PATH + '.log'
+
+# How long structured records are kept by default
+LOG_RETENTION_DAYS = 90
+
+LOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    level INTEGER NOT NULL,
+    source TEXT,
+    txn_id INTEGER,
+    event TEXT,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS log_time_idx ON log(time);
+CREATE INDEX IF NOT EXISTS log_level_idx ON log(level, time);
+CREATE INDEX IF NOT EXISTS log_event_idx ON log(event, time);
+'''
+
+# The same format as the lines in the log file
+LINE_FORMAT = '%(asctime)s | %(levelname)-8s | %(message)s'
+DATE_FORMAT = '%Y/%m/%d %H:%M:%S'
+
+# The logger for messages about individual transactions, which has its own level
+TXN_LOGGER = 'budget.txn'
+
+# A level above every other, which turns a logger off
+OFF = logging.CRITICAL + 10
+
+# The size of each block read from the end of the file
+BLOCK_SIZE = 1 << 16
+
+
+@lru_cache(maxsize=32)
+def compile_filter(pattern: str) -> Tuple[Pattern, Optional[Pattern]]:
+    '''
+    Compile a filter, reusing it if the same filter was used recently. Unless
+    the filter depends on where a line starts or ends, a multiline version is
+    also compiled, so a whole block of lines can be skipped when it can't
+    contain a match.
+
+    Args:
+        pattern: The regular expression
+
+    Returns:
+        The compiled regular expression, and the one for blocks (or None)
+    '''
+    regex = re.compile(pattern)
+    if any(token in pattern for token in ['^', '$', '\\A', '\\Z', '\\B', '(?']):
+        return regex, None
+    return regex, re.compile(pattern, re.MULTILINE)
+
+
+def reverse_blocks(fp: BinaryIO, block_size: int = BLOCK_SIZE) -> Iterator[bytes]:
+    '''
+    Read a file from the end to the start, a block at a time. Each block is
+    extended to hold whole lines only.
+
+    Args:
+        fp: The file, opened in binary mode
+        block_size: The number of bytes to read at a time
+
+    Returns:
+        An iterator over the blocks, without the newline that ends the last line
+    '''
+    size = fp.seek(0, os.SEEK_END)
+    if size == 0:
+        return
+
+    # A trailing newline doesn't start another line
+    fp.seek(size - 1)
+    pos = size - 1 if fp.read(1) == b'\n' else size
+    if pos == 0:
+        yield b''
+        return
+
+    remainder = b''
+    while pos > 0:
+        read = min(block_size, pos)
+        pos -= read
+        fp.seek(pos)
+        data = fp.read(read) + remainder
+        if pos == 0:
+            yield data
+            break
+
+        # The first line may continue in the previous block
+        start = data.find(b'\n')
+        if start < 0:
+            remainder = data
+            continue
+        remainder = data[:start]
+        yield data[start + 1:]
+
+
+def reverse_lines(fp: BinaryIO, block_size: int = BLOCK_SIZE) -> Iterator[bytes]:
+    '''
+    Read the lines of a file from the last to the first
+
+    Args:
+        fp: The file, opened in binary mode
+        block_size: The number of bytes to read at a time
+
+    Returns:
+        An iterator over the lines, without their line endings
+    '''
+    for block in reverse_blocks(fp, block_size):
+        yield from reversed(block.split(b'\n'))
+
+
+def tail(path: str, count: int, pattern: Optional[str] = None, block_size: int = BLOCK_SIZE) -> List[str]:
+    '''
+    Get the last lines of a file that match a filter. Only as much of the end
+    of the file as is needed to find them is read.
+
+    Args:
+        path: The path to the file
+        count: The maximum number of lines to get
+        pattern: A regular expression that the lines must match
+        block_size: The number of bytes to read at a time
+
+    Returns:
+        The matching lines, oldest first
+    '''
+    regex, block_regex = compile_filter(pattern) if pattern else (None, None)
+    output: List[str] = []
+    if count <= 0:
+        return output
+
+    with open(path, 'rb') as fp:
+        for block in reverse_blocks(fp, block_size):
+            text = block.decode('utf-8', errors='replace')
+            if block_regex is not None and not block_regex.search(text):
+                continue
+            lines = text.split('\n')
+            for line in reversed(lines):
+                line = line.strip()
+                if regex is None or regex.search(line):
+                    output.append(line)
+                    if len(output) == count:
+                        output.reverse()
+                        return output
+
+    output.reverse()
+    return output
+
+
+def format_record(record: LogRecord) -> str:
+    '''
+    Format a structured record the same way as a line of the log file
+
+    Args:
+        record: The record
+
+    Returns:
+        The formatted line
+    '''
+    when = time.strftime(DATE_FORMAT, time.localtime(record.time))
+    return f'{when} | {record.level:<8} | {record.message}'
+
+
+def parse_time(value: str, end: bool = False) -> float:
+    '''
+    Parse the bound of a time range
+
+    Args:
+        value: An ISO date or date and time, in local time
+        end: Whether this is the end of the range, in which case a date on its
+             own includes the whole day
+
+    Returns:
+        The time in seconds since the epoch
+    '''
+    when = datetime.datetime.fromisoformat(value)
+    if end and len(value) == 10:
+        when += datetime.timedelta(days=1)
+    return when.timestamp()
+
+
+class LogStore:
+    '''
+    A structured log, stored in an indexed SQLite table. Records can be queried
+    by time range, level, event type and source without reading the rest of
+    the log.
+    '''
+
+    def __init__(self, path: Optional[str] = None):
+        self.con = sqlite3.connect(path or LOG_DB_PATH, check_same_thread=False)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.executescript(LOG_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        self.con.commit()
+        self.con.close()
+
+    def add(self, records: List[LogRecord]) -> None:
+        '''
+        Add a batch of records in a single transaction
+
+        Args:
+            records: The records to add
+        '''
+        with self.con:
+            self.con.executemany(
+                'INSERT INTO log (time, level, source, txn_id, event, message) VALUES (?, ?, ?, ?, ?, ?)',
+                [(rec.time, logging.getLevelName(rec.level), rec.source, rec.txn_id, rec.event, rec.message) for rec in records])
+
+    def prune(self, retention_days: float) -> int:
+        '''
+        Delete records older than the retention period
+
+        Args:
+            retention_days: The number of days of records to keep
+
+        Returns:
+            The number of records deleted
+        '''
+        with self.con:
+            cur = self.con.execute('DELETE FROM log WHERE time < ?', (time.time() - retention_days * 86400, ))
+        return cur.rowcount
+
+    def query(self,
+              count: int,
+              start: Optional[float] = None,
+              end: Optional[float] = None,
+              level: Optional[int] = None,
+              event: Optional[str] = None,
+              source: Optional[str] = None,
+              pattern: Optional[str] = None) -> List[LogRecord]:
+        '''
+        Get the most recent records that match a query
+
+        Args:
+            count: The maximum number of records to get
+            start: Only get records from this time
+            end: Only get records before this time
+            level: Only get records of at least this level
+            event: Only get records of this event type
+            source: Only get records for this source
+            pattern: A regular expression that the formatted records must match
+
+        Returns:
+            The matching records, oldest first
+        '''
+        conditions: List[str] = []
+        params: List[Any] = []
+        for expr, value in [('time >= ?', start), ('time < ?', end), ('level >= ?', level), ('event = ?', event), ('source = ?', source)]:
+            if value is not None:
+                conditions.append(expr)
+                params.append(value)
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        regex = compile_filter(pattern)[0] if pattern else None
+
+        output: List[LogRecord] = []
+        if count <= 0:
+            return output
+        cur = self.con.execute(f'''
+            SELECT id, time, level, source, txn_id, event, message
+            FROM log {where}
+            ORDER BY time DESC, id DESC
+            {'' if regex else 'LIMIT ?'}''', params if regex else params + [count])
+        for row in cur:
+            record = LogRecord(id=row[0], time=row[1], level=logging.getLevelName(row[2]), source=row[3], txn_id=row[4], event=row[5], message=row[6])
+            if regex is None or regex.search(format_record(record)):
+                output.append(record)
+                if len(output) == count:
+                    break
+        cur.close()
+
+        output.reverse()
+        return output
+
+
+class LogStoreHandler(logging.Handler):
+    '''
+    A logging handler that writes records to a LogStore. The structured fields
+    are taken from the extra arguments of a logging call, eg.
+    logging.info('...', extra={'event': 'txn_inserted', 'source': txn.source, 'txn_id': txn.id}).
+    Records are written in batches, and old records are pruned when the
+    handler is closed.
+    '''
+
+    def __init__(self, path: Optional[str] = None, retention_days: float = LOG_RETENTION_DAYS, capacity: int = 256):
+        super().__init__()
+        self.path = path
+        self.retention_days = retention_days
+        self.capacity = capacity
+        self.buffer: List[LogRecord] = []
+        self.store: Optional[LogStore] = None
+        self.setFormatter(logging.Formatter('%(message)s'))
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.buffer.append(LogRecord(
+                time=record.created,
+                level=record.levelname,
+                source=getattr(record, 'source', None),
+                txn_id=getattr(record, 'txn_id', None),
+                event=getattr(record, 'event', None),
+                message=self.format(record),
+            ))
+            if len(self.buffer) >= self.capacity or record.levelno >= logging.ERROR:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self) -> None:
+        self.acquire()
+        try:
+            if self.buffer:
+                if self.store is None:
+                    self.store = LogStore(self.path)
+                self.store.add(self.buffer)
+                self.buffer = []
+        finally:
+            self.release()
+
+    def close(self) -> None:
+        self.acquire()
+        try:
+            self.flush()
+            if self.store is not None:
+                self.store.prune(self.retention_days)
+                self.store.close()
+                self.store = None
+        finally:
+            self.release()
+            super().close()
+
+
+class LogFollower:
+    '''
+    Follows the end of a log file in a background thread, like tail -f, and
+    calls a function with each new line. A file that is truncated or replaced
+    is followed from its start.
+    '''
+
+    def __init__(self, path: str, callback: Callable[[str], None], interval: float = 0.5):
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        '''
+        Start following the file, from its current end. Does nothing if it's
+        already being followed.
+        '''
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name='log-follower', daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        with self.lock:
+            thread, self.thread = self.thread, None
+        self.stopped.set()
+        if thread:
+            thread.join(timeout)
+
+    def run(self) -> None:
+        fp: Optional[BinaryIO] = None
+        inode = None
+        partial = b''
+        first = True
+        try:
+            while not self.stopped.is_set():
+                try:
+                    stat = os.stat(self.path)
+                except FileNotFoundError:
+                    stat = None
+
+                if stat is not None and (fp is None or stat.st_ino != inode or stat.st_size < fp.tell()):
+                    # Lines already in the file when following starts are skipped
+                    if fp is not None:
+                        fp.close()
+                    fp = open(self.path, 'rb')
+                    inode = stat.st_ino
+                    partial = b''
+                    if first:
+                        fp.seek(0, os.SEEK_END)
+
+                if fp is not None:
+                    data = fp.read()
+                    if data:
+                        lines = (partial + data).split(b'\n')
+                        partial = lines.pop()
+                        for line in lines:
+                            self.callback(line.decode('utf-8', errors='replace').strip())
+                first = False
+                self.stopped.wait(self.interval)
+        finally:
+            if fp is not None:
+                fp.close()
+
+
+class DeferredQueueHandler(QueueHandler):
+    '''
+    A QueueHandler that leaves formatting to the listener thread, so a logging
+    call only costs building the record. The arguments of a message must not
+    change after it's logged.
+    '''
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def parse_level(name: str) -> int:
+    '''
+    Parse the name of a log level
+
+    Args:
+        name: The name, eg. DEBUG or INFO, or OFF to log nothing
+
+    Returns:
+        The level
+    '''
+    if name.upper() == 'OFF':
+        return OFF
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        raise ValueError(f'Invalid log level \'{name}\'')
+    return level
+
+
+# The handler and listener installed by setup_logging, if any
+_installed: Optional[Tuple[DeferredQueueHandler, QueueListener]] = None
+
+
+def setup_logging(path: str,
+                  level: int = logging.DEBUG,
+                  txn_level: int = logging.INFO,
+                  retention_days: Optional[float] = LOG_RETENTION_DAYS) -> QueueListener:
+    '''
+    Log to a file, and to the structured log, from a background thread. The
+    root logger only queues records, so logging never waits on the disk. The
+    queue is drained by stop_logging, or when the process exits. Any logging
+    set up by an earlier call is stopped first.
+
+    Args:
+        path: The path of the log file
+        level: The level of the root logger
+        txn_level: The level of the per-transaction logger
+        retention_days: How long to keep structured records, or None to not
+                        keep them
+
+    Returns:
+        The listener that writes the records
+    '''
+    global _installed
+    stop_logging()
+
+    file_handler = logging.FileHandler(path, 'a')
+    file_handler.setFormatter(logging.Formatter(LINE_FORMAT, DATE_FORMAT))
+    handlers: List[logging.Handler] = [file_handler]
+    if retention_days is not None:
+        handlers.append(LogStoreHandler(retention_days=retention_days))
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+
+    # Registered after the logging module's own exit handler, so this runs first
+    atexit.register(listener.stop)
+
+    handler = DeferredQueueHandler(records)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+    logging.getLogger(TXN_LOGGER).setLevel(txn_level)
+    _installed = (handler, listener)
+    return listener
+
+
+def stop_logging() -> None:
+    '''
+    Remove the logging set up by setup_logging, after writing the records that
+    are still queued. Does nothing if it isn't set up.
+    '''
+    global _installed
+    if _installed is None:
+        return
+    handler, listener = _installed
+    _installed = None
+    logging.getLogger().removeHandler(handler)
+    listener.stop()
+    atexit.unregister(listener.stop)
+    for target in listener.handlers:
+        target.close()
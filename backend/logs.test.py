@@ -0,0 +1,259 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# logs.test.py: This file contains the unit tests for reading the log file
+#
+
+# System imports
+import io
+import os
+import re
+import time
+import queue
+import logging
+import tempfile
+import unittest
+from typing import List
+
+# Local imports
+from logs import TXN_LOGGER, OFF, DeferredQueueHandler, LogFollower, LogStore, LogStoreHandler, reverse_lines, tail, format_record, parse_time, parse_level, setup_logging, stop_logging
+
+
+class TestReverseLines(unittest.TestCase):
+    def test_lines(self) -> None:
+        for content in [b'', b'a', b'a\n', b'\n', b'a\nb', b'a\nb\n', b'a\n\nb\n\n', b'foo\r\nbar\r\n']:
+            for block_size in [1, 2, 3, 1024]:
+                expected = content.decode().splitlines()
+                lines = [line.decode().rstrip('\r') for line in reverse_lines(io.BytesIO(content), block_size)]
+                self.assertEqual(lines, expected[::-1], msg=(content, block_size))
+
+    def test_long_lines(self) -> None:
+        content = b'\n'.join(bytes([ord('a') + i % 26]) * (i * 37) for i in range(100))
+        lines = list(reverse_lines(io.BytesIO(content), 64))
+        self.assertEqual(lines, content.split(b'\n')[::-1])
+
+
+class TestTail(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'budget.log')
+        with open(self.path, 'w') as fp:
+            for i in range(1000):
+                fp.write(f'2023/08/03 10:00:00 | {"ERROR   " if i % 100 == 0 else "INFO    "} | line {i}  \n')
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+        return super().tearDown()
+
+    def test_matches_full_scan(self) -> None:
+        with open(self.path) as fp:
+            lines = [line.strip() for line in fp]
+        for pattern in ['', 'ERROR', 'line 99', r'line \d$', r'^2023.*ERROR', r'\s{2}\|', 'nothing']:
+            regex = re.compile(pattern)
+            for count in [1, 5, 50, 2000]:
+                for block_size in [64, 4096]:
+                    self.assertEqual(tail(self.path, count, pattern, block_size), [line for line in lines if regex.search(line)][-count:],
+                                     msg=(pattern, count, block_size))
+
+    def test_no_filter(self) -> None:
+        self.assertEqual(tail(self.path, 2), ['2023/08/03 10:00:00 | INFO     | line 998', '2023/08/03 10:00:00 | INFO     | line 999'])
+
+    def test_no_count(self) -> None:
+        self.assertEqual(tail(self.path, 0, 'ERROR'), [])
+
+    def test_invalid_filter(self) -> None:
+        with self.assertRaises(re.error):
+            tail(self.path, 10, '(')
+
+
+class TestLogStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'budget.db.log')
+        self.logger = logging.getLogger('logs.test')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+        return super().tearDown()
+
+    def log(self, handler: LogStoreHandler) -> None:
+        self.logger.addHandler(handler)
+        try:
+            for i in range(100):
+                self.logger.debug(f'Debug {i}')
+                self.logger.info(f'Inserted new transaction: {i}', extra={'event': 'txn_inserted', 'source': f'Bank {i % 2}', 'txn_id': i})
+            self.logger.error('Incorrect posted balance', extra={'event': 'balance', 'source': 'Bank 0'})
+        finally:
+            self.logger.removeHandler(handler)
+            handler.close()
+
+    def test_query(self) -> None:
+        self.log(LogStoreHandler(self.path, capacity=16))
+        with LogStore(self.path) as store:
+            self.assertEqual(len(store.query(1000)), 201)
+
+            records = store.query(3, event='txn_inserted')
+            self.assertEqual([rec.txn_id for rec in records], [97, 98, 99])
+            self.assertEqual(records[-1].source, 'Bank 1')
+            self.assertEqual(records[-1].level, 'INFO')
+            self.assertEqual(records[-1].message, 'Inserted new transaction: 99')
+
+            self.assertEqual([rec.txn_id for rec in store.query(2, event='txn_inserted', source='Bank 0')], [96, 98])
+            self.assertEqual([rec.message for rec in store.query(10, level=logging.ERROR)], ['Incorrect posted balance'])
+            self.assertEqual([rec.message for rec in store.query(2, level=logging.INFO, pattern=r'transaction: 5\d$')], [
+                'Inserted new transaction: 58', 'Inserted new transaction: 59'])
+            self.assertEqual(store.query(0), [])
+            self.assertEqual(store.query(10, end=time.time() - 60), [])
+            self.assertEqual(len(store.query(1000, start=time.time() - 60, level=logging.DEBUG)), 201)
+
+            line = format_record(store.query(1)[0])
+            self.assertRegex(line, r'^\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2} \| ERROR    \| Incorrect posted balance$')
+
+    def test_batches(self) -> None:
+        handler = LogStoreHandler(self.path, capacity=50)
+        self.logger.addHandler(handler)
+        try:
+            for i in range(49):
+                self.logger.info(f'Line {i}')
+            self.assertIsNone(handler.store)
+            self.logger.info('Line 49')
+            with LogStore(self.path) as store:
+                self.assertEqual(len(store.query(100)), 50)
+
+            # Errors are written straight away
+            self.logger.info('Line 50')
+            self.logger.error('Line 51')
+            with LogStore(self.path) as store:
+                self.assertEqual(len(store.query(100)), 52)
+        finally:
+            self.logger.removeHandler(handler)
+            handler.close()
+
+    def test_retention(self) -> None:
+        with LogStore(self.path) as store:
+            store.con.execute('INSERT INTO log (time, level, message) VALUES (?, ?, ?)', (time.time() - 10 * 86400, logging.INFO, 'Old'))
+            store.con.commit()
+        self.log(LogStoreHandler(self.path, retention_days=5))
+        with LogStore(self.path) as store:
+            self.assertEqual(store.query(1000, pattern='Old'), [])
+            self.assertEqual(len(store.query(1000)), 201)
+
+    def test_parse_time(self) -> None:
+        self.assertEqual(parse_time('2023-08-03', end=True) - parse_time('2023-08-03'), 86400)
+        self.assertEqual(parse_time('2023-08-03T10:00:00', end=True) - parse_time('2023-08-03'), 36000)
+        with self.assertRaises(ValueError):
+            parse_time('yesterday')
+
+
+class TestLogFollower(unittest.TestCase):
+    def test_follow(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'budget.log')
+            with open(path, 'w') as fp:
+                fp.write('old\n')
+            lines: List[str] = []
+            follower = LogFollower(path, lines.append, interval=0.01)
+            follower.start()
+            follower.start()
+            try:
+                def wait_for(count: int) -> None:
+                    for _ in range(200):
+                        if len(lines) >= count:
+                            break
+                        time.sleep(0.01)
+
+                # Lines that were already there are skipped, and partial lines wait to be finished
+                time.sleep(0.05)
+                with open(path, 'a') as fp:
+                    fp.write('one\ntw')
+                    fp.flush()
+                    wait_for(1)
+                    fp.write('o\n')
+                wait_for(2)
+                self.assertEqual(lines, ['one', 'two'])
+
+                # A truncated file is followed from the start
+                with open(path, 'w') as fp:
+                    fp.write('three\n')
+                wait_for(3)
+
+                # So is a file that is replaced
+                os.rename(path, path + '.1')
+                with open(path, 'w') as fp:
+                    fp.write('four\n')
+                wait_for(4)
+                self.assertEqual(lines, ['one', 'two', 'three', 'four'])
+            finally:
+                follower.stop()
+            self.assertIsNone(follower.thread)
+
+
+class TestSetupLogging(unittest.TestCase):
+    def test_parse_level(self) -> None:
+        self.assertEqual(parse_level('debug'), logging.DEBUG)
+        self.assertEqual(parse_level('INFO'), logging.INFO)
+        self.assertEqual(parse_level('off'), OFF)
+        with self.assertRaises(ValueError):
+            parse_level('LOUD')
+
+    def test_deferred_formatting(self) -> None:
+        records: queue.SimpleQueue = queue.SimpleQueue()
+        handler = DeferredQueueHandler(records)
+        record = logging.LogRecord('test', logging.INFO, __file__, 1, 'Inserted %s', ('foo', ), None)
+        handler.handle(record)
+        queued = records.get_nowait()
+        self.assertEqual((queued.msg, queued.args), ('Inserted %s', ('foo', )))
+
+    def test_setup(self) -> None:
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+        txn_logger = logging.getLogger(TXN_LOGGER)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'budget.log')
+            listener = setup_logging(path, logging.INFO, OFF, retention_days=None)
+            try:
+                logging.debug('Hidden %s', 'debug')
+                logging.info('Processing %d transactions', 3)
+                txn_logger.info('Inserted new transaction: %s', 1)
+                logging.error('Incorrect posted balance')
+            finally:
+                stop_logging()
+                root.setLevel(level)
+                txn_logger.setLevel(logging.NOTSET)
+            self.assertEqual(root.handlers, handlers)
+
+            with open(path) as fp:
+                lines = [line.strip() for line in fp]
+        self.assertEqual(len(lines), 2)
+        self.assertRegex(lines[0], r'^\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2} \| INFO     \| Processing 3 transactions$')
+        self.assertRegex(lines[1], r'\| ERROR    \| Incorrect posted balance$')
+
+    def test_setup_again(self) -> None:
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'budget.log')
+            try:
+                # Setting up again replaces the earlier handler, so each record is written once
+                setup_logging(path, logging.INFO, retention_days=None)
+                setup_logging(path, logging.INFO, retention_days=None)
+                self.assertEqual(len([handler for handler in root.handlers if isinstance(handler, DeferredQueueHandler)]), 1)
+                logging.info('Logged once')
+            finally:
+                stop_logging()
+                stop_logging()
+                root.setLevel(level)
+                logging.getLogger(TXN_LOGGER).setLevel(logging.NOTSET)
+            self.assertEqual(root.handlers, handlers)
+
+            with open(path) as fp:
+                self.assertEqual(len(fp.readlines()), 1)
+
+
+unittest.main()
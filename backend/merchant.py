@@ -0,0 +1,50 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# merchant.py: This file normalises scraped transaction descriptions into a
+# canonical merchant name
+#
+
+# System imports
+import re
+from typing import List, Optional
+
+
+# The default rules strip the volatile parts of a description that the banks
+# add to each transaction, leaving only the parts that identify the merchant
+DEFAULT_RULES = [
+    r'\bx{4}-x{4}-x{4}-\d{4}\b',           # Masked card numbers
+    r'\b\d{1,2}[a-z]{3}\d{2}:\d{2}:?',      # Osko timestamps, eg. 04Aug09:05:
+    r'\b\d{1,2}/\d{1,2}(/\d{2,4})?\b',      # Dates
+    r'\b(ref|receipt|reference|value date)\b[:#]?\s*\S+',
+    r'\b(?=[a-z\d]*\d\d)[a-z\d]+\b',        # Terminal ids, store numbers and other tokens with digits
+]
+
+
+class MerchantNormaliser:
+    '''
+    Normalises descriptions with a list of regular expressions. Anything that
+    matches a rule is removed.
+    '''
+
+    def __init__(self, rules: Optional[List[str]] = None):
+        self.rules = [re.compile(rule, re.IGNORECASE) for rule in (DEFAULT_RULES if rules is None else rules)]
+
+    def normalise(self, description: str) -> str:
+        '''
+        Get the canonical merchant name of a description
+
+        Args:
+            description: The scraped description
+
+        Returns:
+            The merchant name
+        '''
+        name = description.lower()
+        for rule in self.rules:
+            name = rule.sub(' ', name)
+        name = ' '.join(name.split())
+        # Don't let the rules strip a description down to nothing
+        return name or ' '.join(description.lower().split())
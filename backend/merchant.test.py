@@ -0,0 +1,39 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# merchant.test.py: This file contains the unit tests for the merchant
+# description normalisation
+#
+
+# System imports
+import unittest
+
+# Local imports
+from merchant import MerchantNormaliser
+
+
+class TestMerchantNormaliser(unittest.TestCase):
+    def test_strips_volatile_tokens(self) -> None:
+        normaliser = MerchantNormaliser()
+        self.assertEqual(normaliser.normalise('FASTFOOD DT 0398        QWERTY FOOAU XXXX-XXXX-XXXX-2837'), 'fastfood dt qwerty fooau')
+        self.assertEqual(normaliser.normalise('PAYPAL *MENULOGPTYL      2938473727   AU'), 'paypal *menulogptyl au')
+        self.assertEqual(normaliser.normalise('Osko Withdrawal 04Aug09:05: Inv 1234 Fooville Community Collage'), 'osko withdrawal inv fooville community collage')
+        self.assertEqual(normaliser.normalise('Transfer 12/08/2023 Ref: ABC123XYZ Rent'), 'transfer rent')
+
+    def test_keeps_merchant_names(self) -> None:
+        normaliser = MerchantNormaliser()
+        self.assertEqual(normaliser.normalise('7-ELEVEN 2211 SOMETOWN'), '7-eleven sometown')
+        self.assertEqual(normaliser.normalise('PETROL EXPRESS 1830       SOMETOWN    AU'), normaliser.normalise('Petrol Express 2044 Sometown AU'))
+
+    def test_never_empty(self) -> None:
+        self.assertEqual(MerchantNormaliser().normalise('123456  7890'), '123456 7890')
+
+    def test_custom_rules(self) -> None:
+        normaliser = MerchantNormaliser([r'\bau$', r'\s+pty ltd\b'])
+        self.assertEqual(normaliser.normalise('FOO BAR PTY LTD 1234 AU'), 'foo bar 1234')
+        self.assertEqual(MerchantNormaliser([]).normalise('FOO  BAR 1234'), 'foo bar 1234')
+
+
+unittest.main()
@@ -0,0 +1,80 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# metrics.py: This file collects stage timings and counters for each run of the
+# ingest pipeline
+#
+
+# System imports
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+# Local imports
+from model import MetricRun
+
+
+class IngestMetrics:
+    '''
+    Accumulates the time spent in each stage and the counters of each source
+    during an ingest run. Stages and counters that aren't specific to a source
+    are recorded against the empty source.
+    '''
+
+    def __init__(self, job_id: Optional[int] = None):
+        self.job_id = job_id
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.counts: Dict[str, Dict[str, int]] = {}
+
+    @contextmanager
+    def stage(self, name: str, source: str = ''):
+        '''
+        Time a block, adding it to the total time of a stage
+
+        Args:
+            name: The name of the stage
+            source: The source the stage is for
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, source)
+
+    def add_time(self, name: str, seconds: float, source: str = '') -> None:
+        '''
+        Add to the total time of a stage
+
+        Args:
+            name: The name of the stage
+            seconds: The time to add
+            source: The source the stage is for
+        '''
+        stages = self.stages.setdefault(source, {})
+        stages[name] = stages.get(name, 0.0) + seconds
+
+    def count(self, name: str, value: int = 1, source: str = '') -> None:
+        '''
+        Add to a counter
+
+        Args:
+            name: The name of the counter
+            value: The amount to add
+            source: The source the counter is for
+        '''
+        counts = self.counts.setdefault(source, {})
+        counts[name] = counts.get(name, 0) + value
+
+    def finish(self) -> MetricRun:
+        '''
+        Mark the run as finished
+
+        Returns:
+            The metrics of the run
+        '''
+        self.finished = time.time()
+        return MetricRun(job_id=self.job_id, started=self.started, finished=self.finished, stages=self.stages, counts=self.counts)
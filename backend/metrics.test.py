@@ -0,0 +1,51 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# metrics.test.py: This file contains the unit tests for the ingest metrics
+#
+
+# System imports
+import time
+import unittest
+
+# Local imports
+from metrics import IngestMetrics
+
+
+class TestIngestMetrics(unittest.TestCase):
+    def test_stages(self) -> None:
+        metrics = IngestMetrics()
+        with metrics.stage('prune', 'bank of foo'):
+            time.sleep(0.01)
+        with metrics.stage('prune', 'bank of foo'):
+            time.sleep(0.01)
+        metrics.add_time('index', 1.5)
+        self.assertGreaterEqual(metrics.stages['bank of foo']['prune'], 0.02)
+        self.assertEqual(metrics.stages[''], {'index': 1.5})
+
+    def test_stage_raises(self) -> None:
+        metrics = IngestMetrics()
+        with self.assertRaises(ValueError):
+            with metrics.stage('scrape', 'bank of foo'):
+                raise ValueError()
+        self.assertIn('scrape', metrics.stages['bank of foo'])
+
+    def test_counts(self) -> None:
+        metrics = IngestMetrics()
+        metrics.count('inserted', 3, 'bank of foo')
+        metrics.count('inserted', 2, 'bank of foo')
+        metrics.count('inserted', source='Bar Inc')
+        self.assertEqual(metrics.counts, {'bank of foo': {'inserted': 5}, 'Bar Inc': {'inserted': 1}})
+
+    def test_finish(self) -> None:
+        metrics = IngestMetrics(job_id=4)
+        metrics.count('fetched', 10, 'bank of foo')
+        run = metrics.finish()
+        self.assertEqual(run.job_id, 4)
+        self.assertGreaterEqual(run.finished, run.started)
+        self.assertEqual(run.counts, {'bank of foo': {'fetched': 10}})
+
+
+unittest.main()
@@ -7,7 +7,7 @@
 #
 
 # System imports
-from typing import Optional, List, Dict
+from typing import Any, Optional, List, Dict
 from pydantic import BaseModel
 from fastapi.param_functions import Form
 
@@ -45,6 +45,15 @@ class AllocationList(BaseModel):
     allocations: List[Allocation]
 
 
+class ChangeList(BaseModel):
+    version: int
+    reset: bool
+    transactions: List[Transaction]
+    allocations: List[Allocation]
+    deleted_transactions: List[int]
+    deleted_allocations: List[int]
+
+
 class DashboardPanel(BaseModel):
     category: str
     amount: int
@@ -62,6 +71,14 @@ class Categorisation(BaseModel):
     locations: List[Score]
 
 
+class Suggestion(BaseModel):
+    txn_id: int
+    category: str
+    category_score: float
+    location: str
+    location_score: float
+
+
 class SplitAmount(BaseModel):
     amount: int
 
@@ -82,8 +99,60 @@ class PushSubscription(BaseModel):
     value: Dict
 
 
+class PushResult(BaseModel):
+    id: int | None = None
+    ok: bool
+    status_code: int | None = None
+    error: str | None = None
+
+
+class Watermark(BaseModel):
+    source: str
+    oldest_pending: str | None = None
+    last_posted: str | None = None
+
+
+class LogRecord(BaseModel):
+    id: int | None = None
+    time: float
+    level: str
+    source: str | None = None
+    txn_id: int | None = None
+    event: str | None = None
+    message: str
+
+
+class Event(BaseModel):
+    id: int
+    topic: str
+    data: Any = None
+
+
+class MetricRun(BaseModel):
+    id: int | None = None
+    job_id: int | None = None
+    started: float
+    finished: float
+    stages: Dict[str, Dict[str, float]] = {}
+    counts: Dict[str, Dict[str, int]] = {}
+
+
+class Job(BaseModel):
+    id: int | None = None
+    reason: str
+    state: str = 'queued'
+    pid: int | None = None
+    queued: float
+    started: float | None = None
+    finished: float | None = None
+    inserted: int | None = None
+    failed: int | None = None
+    error: str | None = None
+
+
 class ScraperState(BaseModel):
     state: str
+    job: Optional[Job] = None
 
 
 class OAuth2RequestForm:
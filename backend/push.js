@@ -0,0 +1,67 @@
+/**
+ * MIT License
+ *
+ * Copyright (c) 2023 Josef Barnes
+ *
+ * push.js: This file implements a long-lived worker that sends push
+ * notifications. The first line on stdin is a JSON object with the GCMAPIKey,
+ * vapidSub, vapidPublicKey and vapidPrivateKey from the budget config. Each
+ * line after that is a JSON request of the form
+ * {"id": 1, "subscription": {...}, "payload": "..."}, and a JSON result of the
+ * form {"id": 1, "ok": true, "status_code": 201, "error": null} is written to
+ * stdout for each one as it completes.
+ */
+
+import webpush from 'web-push';
+import readline from 'readline';
+
+// How long to wait for a push service to respond, in milliseconds
+const TIMEOUT = 30000;
+
+let configured = false;
+const configure = (line) => {
+   const config = JSON.parse(line);
+   if (config.GCMAPIKey) {
+      webpush.setGCMAPIKey(config.GCMAPIKey);
+   }
+   webpush.setVapidDetails(config.vapidSub, config.vapidPublicKey, config.vapidPrivateKey);
+   configured = true;
+};
+
+const respond = (result) => {
+   process.stdout.write(JSON.stringify(result) + '\n');
+};
+
+const send = async (line) => {
+   let request;
+   try {
+      request = JSON.parse(line);
+   } catch (err) {
+      respond({ id: null, ok: false, status_code: null, error: `Invalid request: ${err.message}` });
+      return;
+   }
+
+   try {
+      const res = await webpush.sendNotification(request.subscription, request.payload, { timeout: TIMEOUT });
+      respond({ id: request.id, ok: true, status_code: res.statusCode, error: null });
+   } catch (err) {
+      respond({ id: request.id, ok: false, status_code: err.statusCode ?? null, error: err.body || err.message });
+   }
+};
+
+// Send every request as soon as it arrives, so they all go out concurrently
+const pending = [];
+const rl = readline.createInterface({ input: process.stdin });
+rl.on('line', (line) => {
+   if (!line.trim()) {
+      return;
+   }
+   if (!configured) {
+      configure(line);
+   } else {
+      pending.push(send(line));
+   }
+});
+rl.on('close', async () => {
+   await Promise.all(pending);
+});
@@ -0,0 +1,105 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# push.py: This file manages the worker process that sends push notifications
+#
+
+# System imports
+import os
+import json
+import threading
+import subprocess
+from typing import List, Dict, Optional
+
+# Local imports
+from model import PushSubscription, PushResult
+
+
+class PushWorker:
+    '''
+    A long-lived node process that sends push notifications. Every subscription
+    is handed to it at once, so they are sent concurrently, and one result is
+    read back for each.
+    '''
+    SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'push.js')
+    SETTINGS = ['GCMAPIKey', 'vapidSub', 'vapidPublicKey', 'vapidPrivateKey']
+
+    def __init__(self, config: Dict, command: Optional[List[str]] = None):
+        self.command = command or [config['node_path'], PushWorker.SCRIPT]
+        self.settings = {key: config.get(key) for key in PushWorker.SETTINGS}
+        self.process: Optional[subprocess.Popen] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self) -> None:
+        '''
+        Start the worker process
+        '''
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, encoding='utf-8', bufsize=1)
+        self.write([json.dumps(self.settings)])
+
+    def stop(self) -> None:
+        '''
+        Stop the worker process, once it has finished any outstanding requests
+        '''
+        process = self.process
+        if process:
+            assert process.stdin is not None and process.stdout is not None
+            process.stdin.close()
+            process.wait()
+            process.stdout.close()
+            self.process = None
+
+    def write(self, lines: List[str]) -> None:
+        '''
+        Write request lines to the worker
+
+        Args:
+            lines: The lines to write
+        '''
+        process = self.process
+        assert process is not None and process.stdin is not None
+        for line in lines:
+            process.stdin.write(line + '\n')
+        process.stdin.flush()
+
+    def send(self, subscriptions: List[PushSubscription], body: Dict) -> List[PushResult]:
+        '''
+        Send a notification to a list of subscriptions
+
+        Args:
+            subscriptions: The subscriptions to notify
+            body: The body of the notification to send
+
+        Returns:
+            The result for each subscription, in the order they completed
+        '''
+        process = self.process
+        if process is None:
+            raise RuntimeError('Push worker is not running')
+        assert process.stdout is not None
+
+        payload = json.dumps(body)
+        requests = [json.dumps({'id': sub.id, 'subscription': sub.value, 'payload': payload}) for sub in subscriptions]
+
+        # Write from another thread, so a full pipe in either direction can't deadlock
+        writer = threading.Thread(target=self.write, args=(requests, ))
+        writer.start()
+        results: List[PushResult] = []
+        try:
+            for _ in requests:
+                line = process.stdout.readline()
+                if not line:
+                    raise RuntimeError(f'Push worker exited with {len(requests) - len(results)} notifications unsent')
+                results.append(PushResult(**json.loads(line)))
+        finally:
+            writer.join()
+
+        return results
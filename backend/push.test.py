@@ -0,0 +1,132 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# push.test.py: This file contains the unit tests for the push notification
+# worker
+#
+
+# System imports
+import os
+import sys
+import ssl
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import subprocess
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# Local imports
+from push import PushWorker
+from model import PushSubscription
+
+
+# A worker that speaks the same protocol as push.js, failing odd subscriptions
+STUB_WORKER = '''
+import sys, json
+settings = json.loads(sys.stdin.readline())
+for line in sys.stdin:
+    req = json.loads(line)
+    ok = req['id'] % 2 == 0
+    print(json.dumps({'id': req['id'], 'ok': ok, 'status_code': 201 if ok else 410, 'error': None if ok else settings['vapidSub']}), flush=True)
+'''
+
+CONFIG = {
+    'node_path': 'node',
+    'GCMAPIKey': 'key',
+    'vapidSub': 'mailto:foo@example.com',
+    'vapidPublicKey': '',
+    'vapidPrivateKey': '',
+}
+
+NODE_MODULES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'node_modules')
+
+
+class TestPushWorker(unittest.TestCase):
+    def test_send(self) -> None:
+        subs = [PushSubscription(id=i, value={'endpoint': f'https://example.com/{i}'}) for i in range(1, 101)]
+        with PushWorker(CONFIG, [sys.executable, '-c', STUB_WORKER]) as worker:
+            results = worker.send(subs, {'type': 'new_transactions', 'count': 3})
+            self.assertEqual(sorted(res.id for res in results), list(range(1, 101)))
+            for res in results:
+                self.assertEqual(res.ok, res.id % 2 == 0)
+                if not res.ok:
+                    self.assertEqual(res.status_code, 410)
+                    self.assertEqual(res.error, 'mailto:foo@example.com')
+
+            # The same worker handles later notifications
+            results = worker.send(subs[:2], {'type': 'test'})
+            self.assertEqual(len(results), 2)
+
+    def test_send_no_subscriptions(self) -> None:
+        with PushWorker(CONFIG, [sys.executable, '-c', STUB_WORKER]) as worker:
+            self.assertEqual(worker.send([], {'type': 'test'}), [])
+
+    def test_worker_exits(self) -> None:
+        subs = [PushSubscription(id=1, value={})]
+        with PushWorker(CONFIG, [sys.executable, '-c', 'import sys; sys.stdin.readline()']) as worker:
+            with self.assertRaises(RuntimeError):
+                worker.send(subs, {'type': 'test'})
+
+    def test_not_started(self) -> None:
+        with self.assertRaises(RuntimeError):
+            PushWorker(CONFIG).send([], {'type': 'test'})
+
+    @unittest.skipUnless(shutil.which('node') and shutil.which('openssl') and os.path.isdir(os.path.join(NODE_MODULES, 'web-push')),
+                         'node, openssl and web-push are required')
+    def test_node_worker(self) -> None:  # pragma: no cover
+        received = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                self.rfile.read(int(self.headers['Content-Length']))
+                received.append(self.path)
+                self.send_response(201 if self.path.endswith('ok') else 410)
+                self.end_headers()
+
+            def log_message(self, *args) -> None:
+                pass
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # Run a local push service over https with a self-signed certificate
+            key, cert = os.path.join(tmp, 'key.pem'), os.path.join(tmp, 'cert.pem')
+            subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=localhost', '-days', '1',
+                            '-keyout', key, '-out', cert], check=True, capture_output=True)
+            server = HTTPServer(('127.0.0.1', 0), Handler)
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert, key)
+            server.socket = context.wrap_socket(server.socket, server_side=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+            # Generate VAPID keys, and the keys a browser would have for each subscription
+            script = '''const webpush = require('web-push');
+const crypto = require('crypto');
+const ecdh = crypto.createECDH('prime256v1');
+ecdh.generateKeys();
+console.log(JSON.stringify({vapid: webpush.generateVAPIDKeys(), p256dh: ecdh.getPublicKey('base64url'), auth: crypto.randomBytes(16).toString('base64url')}));
+'''
+            keys = json.loads(subprocess.run(['node', '-e', script], cwd=os.path.dirname(NODE_MODULES), check=True, capture_output=True, encoding='utf-8').stdout)
+            config = {**CONFIG, 'GCMAPIKey': '', 'vapidPublicKey': keys['vapid']['publicKey'], 'vapidPrivateKey': keys['vapid']['privateKey']}
+            port = server.server_address[1]
+            subs = [PushSubscription(id=i, value={'endpoint': f'https://127.0.0.1:{port}/{i}/{"ok" if i % 2 else "gone"}',
+                                                  'keys': {'p256dh': keys['p256dh'], 'auth': keys['auth']}}) for i in range(1, 11)]
+
+            os.environ['NODE_TLS_REJECT_UNAUTHORIZED'] = '0'
+            try:
+                with PushWorker(config, ['node', PushWorker.SCRIPT]) as worker:
+                    results = worker.send(subs, {'type': 'test'})
+            finally:
+                del os.environ['NODE_TLS_REJECT_UNAUTHORIZED']
+                server.shutdown()
+
+        self.assertEqual(len(received), 10)
+        self.assertEqual(sorted(res.id for res in results), list(range(1, 11)))
+        for res in results:
+            self.assertEqual(res.ok, bool(res.id % 2))
+            self.assertEqual(res.status_code, 201 if res.id % 2 else 410)
+
+
+unittest.main()
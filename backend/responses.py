@@ -0,0 +1,59 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# responses.py: This file contains the JSON responses for data that has
+# already been validated, so it can be encoded without going through pydantic
+#
+
+# System imports
+import json
+from typing import Any, Dict, Optional, Type
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+
+class StdJSONResponse(JSONResponse):
+    '''
+    Encodes the content with the standard library
+    '''
+
+    def render(self, content: Any) -> bytes:
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode('utf-8')
+
+
+class OrjsonResponse(JSONResponse):
+    '''
+    Encodes the content with orjson, which is several times faster than the
+    standard library on large lists
+    '''
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
+RESPONSE_CLASSES: Dict[str, Type[JSONResponse]] = {'json': StdJSONResponse}
+if orjson is not None:
+    RESPONSE_CLASSES['orjson'] = OrjsonResponse
+
+
+def get_response_class(encoder: Optional[str] = None) -> Type[JSONResponse]:
+    '''
+    Get the response class for a JSON encoder
+
+    Args:
+        encoder: The name of the encoder, or None for the fastest available
+
+    Returns:
+        The response class
+    '''
+    if encoder is None:
+        encoder = 'orjson' if 'orjson' in RESPONSE_CLASSES else 'json'
+    if encoder not in RESPONSE_CLASSES:
+        raise ValueError(f'Invalid JSON encoder \'{encoder}\'')
+    return RESPONSE_CLASSES[encoder]
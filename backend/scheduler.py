@@ -0,0 +1,267 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# scheduler.py: This file queues scraper jobs on a schedule, and runs them one
+# at a time in the background
+#
+
+# System imports
+import os
+import time
+import logging
+import datetime
+import threading
+import subprocess
+from typing import List, Optional, Set
+
+# Local imports
+from database import Database
+from events import bus
+from model import Job
+
+
+class CronSchedule:
+    '''
+    A cron-like schedule with five fields: minute, hour, day of month, month and
+    day of week (0 or 7 is Sunday). Each field can be *, a number, a range
+    (eg. 1-5), a step (eg. */15 or 8-18/2) or a comma separated list of these.
+    '''
+    FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expr: str):
+        fields = expr.split()
+        if len(fields) != len(CronSchedule.FIELDS):
+            raise ValueError(f'Invalid schedule \'{expr}\': expected {len(CronSchedule.FIELDS)} fields')
+
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            CronSchedule.parse_field(field, low, high) for field, (low, high) in zip(fields, CronSchedule.FIELDS)]
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+
+        # Like cron, if both days are restricted then either can match
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def parse_field(field: str, low: int, high: int) -> Set[int]:
+        '''
+        Parse one field of a schedule
+
+        Args:
+            field: The field to parse
+            low: The lowest allowed value
+            high: The highest allowed value
+
+        Returns:
+            The set of values the field matches
+        '''
+        values: Set[int] = set()
+        for part in field.split(','):
+            value_range, _, step = part.partition('/')
+            if value_range == '*':
+                start, end = low, high
+            elif '-' in value_range:
+                start, end = (int(v) for v in value_range.split('-', 1))
+            else:
+                start = end = int(value_range)
+                if step:
+                    end = high
+            if start < low or end > high or start > end or (step and int(step) < 1):
+                raise ValueError(f'Invalid schedule field \'{field}\'')
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def matches(self, when: datetime.datetime) -> bool:
+        '''
+        Check whether the schedule is due at a time
+
+        Args:
+            when: The time to check (only the minute is considered)
+
+        Returns:
+            True if the schedule is due
+        '''
+        if when.minute not in self.minutes or when.hour not in self.hours or when.month not in self.months:
+            return False
+        day = when.day in self.days
+        weekday = (when.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+def process_alive(pid: int) -> bool:
+    '''
+    Check whether a process is still running
+
+    Args:
+        pid: The process ID
+
+    Returns:
+        True if the process exists
+    '''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Scheduler:
+    '''
+    Queues scraper jobs from a list of schedules or on demand, and runs them in
+    a background thread. The job table is the only shared state, so triggers
+    from several API workers are deduplicated by the database. Each change to
+    a job is published as a 'job' event, and the number of transactions a job
+    inserted as a 'transactions' event.
+    '''
+    COMMAND = ['/bin/sh', './scrapers/run.sh']
+
+    # How long a claimed job can go without a process before it's assumed lost
+    START_TIMEOUT = 60
+
+    def __init__(self, schedules: Optional[List[str]] = None, command: Optional[List[str]] = None):
+        self.schedules = [CronSchedule(expr) for expr in schedules or []]
+        self.command = command or Scheduler.COMMAND
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.last_minute: Optional[datetime.datetime] = None
+
+    def start(self) -> None:
+        '''
+        Start running jobs in the background
+        '''
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        '''
+        Stop the background thread. A job that is already running is left to
+        finish in its own process, and is picked up by recover() if needed.
+
+        Args:
+            timeout: The most time to wait for the thread, or None to wait for it
+        '''
+        self.stopped.set()
+        self.wake.set()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def trigger(self, reason: str = 'manual') -> Optional[Job]:
+        '''
+        Queue a job to run as soon as possible
+
+        Args:
+            reason: What queued the job
+
+        Returns:
+            The new job, or None if a job is already queued or running
+        '''
+        # A lost job would otherwise block every new one
+        self.recover()
+        with Database() as db:
+            job = db.add_job(reason)
+        if job:
+            logging.info('Queued scraper job %s (%s)', job.id, reason)
+            bus.publish('job', job.dict())
+            self.wake.set()
+        return job
+
+    def recover(self) -> None:
+        '''
+        Finish any running jobs whose process has gone, eg. a scraper that was
+        killed, or one that was left running by an API that has restarted
+        '''
+        with Database() as db:
+            for job in db.get_job_list('state = \'running\''):
+                assert job.id is not None
+                if job.pid is not None and process_alive(job.pid):
+                    continue
+                if job.pid is None and job.started and time.time() - job.started < Scheduler.START_TIMEOUT:
+                    continue
+                logging.warning('Scraper job %s was interrupted', job.id)
+                db.finish_job(job.id, error='Interrupted')
+                bus.publish('job', job.copy(update={'state': 'done', 'error': 'Interrupted'}).dict())
+
+    def check_schedules(self, now: datetime.datetime) -> None:
+        '''
+        Queue a job if any schedule is due. Each minute is only checked once.
+
+        Args:
+            now: The current time
+        '''
+        minute = now.replace(second=0, microsecond=0)
+        if minute == self.last_minute:
+            return
+        self.last_minute = minute
+        for schedule in self.schedules:
+            if schedule.matches(minute):
+                with Database() as db:
+                    job = db.add_job('schedule', f'{schedule.expr}@{minute.isoformat()}')
+                if job:
+                    logging.info('Queued scraper job %s for schedule \'%s\'', job.id, schedule.expr)
+                    bus.publish('job', job.dict())
+                break
+
+    def run_pending(self) -> int:
+        '''
+        Run queued jobs until there are none left
+
+        Returns:
+            The number of jobs that were run
+        '''
+        count = 0
+        while not self.stopped.is_set():
+            with Database() as db:
+                job = db.claim_job()
+            if job is None:
+                break
+            assert job.id is not None
+
+            logging.info('Running scraper job %s', job.id)
+            error = None
+            try:
+                process = subprocess.Popen([*self.command, '--job-id', str(job.id)])
+                with Database() as db:
+                    db.set_job_pid(job.id, process.pid)
+                bus.publish('job', job.copy(update={'pid': process.pid}).dict())
+                returncode = process.wait()
+                if returncode:
+                    error = f'Exited with status {returncode}'
+            except Exception as exc:
+                error = str(exc)
+
+            # The scraper normally finishes the job itself, with its counts
+            with Database() as db:
+                db.finish_job(job.id, error=error)
+                finished = db.get_job(job.id)
+            logging.info('Finished scraper job %s', job.id)
+            if finished:
+                bus.publish('job', finished.dict())
+                if finished.inserted:
+                    bus.publish('transactions', {'job_id': finished.id, 'count': finished.inserted})
+            count += 1
+        return count
+
+    def run(self) -> None:
+        '''
+        The background thread, which wakes each minute to check the schedules
+        or when a job is triggered
+        '''
+        while not self.stopped.is_set():
+            try:
+                self.recover()
+                self.check_schedules(datetime.datetime.now())
+                self.run_pending()
+            except Exception as exc:
+                logging.exception('Scheduler failed: %s', exc)
+            self.wake.wait(60 - datetime.datetime.now().second)
+            self.wake.clear()
@@ -0,0 +1,191 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# scheduler.test.py: This file contains the unit tests for the scraper job
+# scheduler
+#
+
+# System imports
+import sys
+import time
+import asyncio
+import datetime
+import unittest
+from typing import List
+
+# Local imports
+from database import Database
+from scheduler import CronSchedule, Scheduler
+from events import bus
+from model import Event
+
+
+class TestCronSchedule(unittest.TestCase):
+    def test_every_minute(self) -> None:
+        schedule = CronSchedule('* * * * *')
+        self.assertTrue(schedule.matches(datetime.datetime(2023, 8, 3, 0, 0)))
+        self.assertTrue(schedule.matches(datetime.datetime(2023, 12, 31, 23, 59)))
+
+    def test_fields(self) -> None:
+        schedule = CronSchedule('*/15 6,18 * * 1-5')
+        self.assertEqual(schedule.minutes, {0, 15, 30, 45})
+        self.assertEqual(schedule.hours, {6, 18})
+        self.assertEqual(schedule.weekdays, {1, 2, 3, 4, 5})
+        self.assertEqual(CronSchedule('5/20 8-18/5 * * 7').minutes, {5, 25, 45})
+        self.assertEqual(CronSchedule('5/20 8-18/5 * * 7').hours, {8, 13, 18})
+        self.assertEqual(CronSchedule('0 0 * * 7').weekdays, {0, 7})
+
+    def test_matches(self) -> None:
+        # 2023-08-03 is a Thursday, 2023-08-05 is a Saturday
+        schedule = CronSchedule('30 6 * * 1-5')
+        self.assertTrue(schedule.matches(datetime.datetime(2023, 8, 3, 6, 30, 45)))
+        self.assertFalse(schedule.matches(datetime.datetime(2023, 8, 3, 6, 31)))
+        self.assertFalse(schedule.matches(datetime.datetime(2023, 8, 5, 6, 30)))
+
+        # If both days are restricted, either can match
+        schedule = CronSchedule('0 0 1 * 6')
+        self.assertTrue(schedule.matches(datetime.datetime(2023, 8, 1, 0, 0)))
+        self.assertTrue(schedule.matches(datetime.datetime(2023, 8, 5, 0, 0)))
+        self.assertFalse(schedule.matches(datetime.datetime(2023, 8, 3, 0, 0)))
+
+    def test_invalid(self) -> None:
+        for expr in ['* * * *', '60 * * * *', '* 24 * * *', '* * 0 * *', '5-1 * * * *', '*/0 * * * *', 'a * * * *']:
+            with self.assertRaises(ValueError, msg=expr):
+                CronSchedule(expr)
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self) -> None:
+        with Database() as db:
+            db.db.execute('DELETE FROM job')
+        return super().setUp()
+
+    def test_run_pending(self) -> None:
+        scheduler = Scheduler(command=[sys.executable, '-c', 'import sys; assert sys.argv[1:] == ["--job-id", sys.argv[2]]'])
+        self.assertEqual(scheduler.run_pending(), 0)
+        job = scheduler.trigger()
+        assert job is not None
+        self.assertIsNone(scheduler.trigger())
+        self.assertEqual(scheduler.run_pending(), 1)
+
+        with Database() as db:
+            finished = db.get_job(job.id)
+        assert finished is not None
+        self.assertEqual(finished.state, 'done')
+        self.assertIsNone(finished.error)
+        self.assertIsNotNone(finished.pid)
+
+    def test_events(self) -> None:
+        script = 'import sys; from database import Database; db = Database().open(); db.finish_job(int(sys.argv[2]), 5, 0); db.close()'
+        scheduler = Scheduler(command=[sys.executable, '-c', script])
+
+        async def run() -> List[Event]:
+            with bus.subscribe(['job', 'transactions']) as sub:
+                await asyncio.get_running_loop().run_in_executor(None, lambda: (scheduler.trigger(), scheduler.run_pending()))
+                events = []
+                while (event := await sub.get(0.1)) is not None:
+                    events.append(event)
+                return events
+
+        events = asyncio.run(run())
+        self.assertEqual([(event.topic, event.data.get('state')) for event in events], [
+            ('job', 'queued'), ('job', 'running'), ('job', 'done'), ('transactions', None)])
+        self.assertEqual(events[-1].data['count'], 5)
+
+    def test_run_failed(self) -> None:
+        scheduler = Scheduler(command=[sys.executable, '-c', 'import sys; sys.exit(3)'])
+        job = scheduler.trigger()
+        assert job is not None
+        scheduler.run_pending()
+        with Database() as db:
+            finished = db.get_job(job.id)
+        assert finished is not None
+        self.assertEqual(finished.error, 'Exited with status 3')
+
+    def test_job_finished_by_scraper(self) -> None:
+        script = 'import sys; from database import Database; db = Database().open(); db.finish_job(int(sys.argv[2]), 5, 0); db.close()'
+        scheduler = Scheduler(command=[sys.executable, '-c', script])
+        job = scheduler.trigger()
+        assert job is not None
+        scheduler.run_pending()
+        with Database() as db:
+            finished = db.get_job(job.id)
+        assert finished is not None
+        self.assertEqual(finished.inserted, 5)
+        self.assertIsNone(finished.error)
+
+    def test_check_schedules(self) -> None:
+        scheduler = Scheduler(['0 6 * * *', '0 * * * *'])
+        scheduler.check_schedules(datetime.datetime(2023, 8, 3, 5, 59))
+        scheduler.check_schedules(datetime.datetime(2023, 8, 3, 6, 0, 10))
+        scheduler.check_schedules(datetime.datetime(2023, 8, 3, 6, 0, 50))
+        with Database() as db:
+            jobs = db.get_job_list()
+            self.assertEqual(len(jobs), 1)
+            self.assertEqual(jobs[0].reason, 'schedule')
+            assert jobs[0].id is not None
+            db.claim_job()
+            db.finish_job(jobs[0].id)
+
+        # Another worker checking the same minute doesn't queue it again
+        Scheduler(['0 6 * * *']).check_schedules(datetime.datetime(2023, 8, 3, 6, 0, 30))
+        with Database() as db:
+            self.assertEqual(len(db.get_job_list()), 1)
+
+    def test_recover(self) -> None:
+        with Database() as db:
+            lost = db.add_job('manual')
+            assert lost is not None and lost.id is not None
+            db.claim_job()
+            db.set_job_pid(lost.id, 2 ** 22 + 1)
+        Scheduler().recover()
+        with Database() as db:
+            job = db.get_job(lost.id)
+            assert job is not None
+            self.assertEqual((job.state, job.error), ('done', 'Interrupted'))
+
+            # A job whose process is still running is left alone
+            running = db.add_job('manual')
+            assert running is not None and running.id is not None
+            db.claim_job()
+            db.set_job_pid(running.id, 1)
+        Scheduler().recover()
+        with Database() as db:
+            job = db.get_job(running.id)
+            assert job is not None
+            self.assertEqual(job.state, 'running')
+
+    def test_trigger_after_lost_job(self) -> None:
+        # A CLI scrape that was killed leaves its job running
+        with Database() as db:
+            lost = db.add_job('cli', state='running')
+            assert lost is not None and lost.id is not None
+            db.set_job_pid(lost.id, 2 ** 22 + 1)
+        job = Scheduler().trigger()
+        self.assertIsNotNone(job)
+        with Database() as db:
+            interrupted = db.get_job(lost.id)
+            assert interrupted is not None
+            self.assertEqual((interrupted.state, interrupted.error), ('done', 'Interrupted'))
+
+    def test_background_thread(self) -> None:
+        scheduler = Scheduler(command=[sys.executable, '-c', 'pass'])
+        scheduler.start()
+        try:
+            job = scheduler.trigger()
+            assert job is not None
+            for _ in range(100):
+                with Database() as db:
+                    current = db.get_job(job.id)
+                assert current is not None
+                if current.state == 'done':
+                    break
+                time.sleep(0.05)
+            self.assertEqual(current.state, 'done')
+        finally:
+            scheduler.stop()
+
+
+unittest.main()
@@ -19,6 +19,12 @@ CREATE TABLE IF NOT EXISTS token (
    expire          INTEGER  NOT NULL      /* The time to remove this entry */
 );
 
+/* A table to store the canonical merchant names that descriptions normalise to */
+CREATE TABLE IF NOT EXISTS merchant (
+   id              INTEGER  PRIMARY KEY,     /* A unique identifier for this table */
+   name            TEXT     NOT NULL UNIQUE  /* The normalised merchant name */
+);
+
 /* A table to store the raw transactions scaped from the accounts */
 CREATE TABLE IF NOT EXISTS txn (
    id              INTEGER  PRIMARY KEY,  /* A unique identifier for this table */
@@ -27,10 +33,20 @@ CREATE TABLE IF NOT EXISTS txn (
    description     TEXT     NOT NULL,     /* The description scraped from the transaction history */
    source          TEXT     NOT NULL,     /* The source of the transaction (ie. which account) */
    balance         INTEGER  NOT NULL,     /* The balance of the source after the transaction */
-   pending         BOOLEAN  NOT NULL      /* Whether the transaction is pending */
+   pending         BOOLEAN  NOT NULL,     /* Whether the transaction is pending */
+   merchant_id     INTEGER  REFERENCES merchant(id)  /* The merchant the description normalises to */
 );
 CREATE INDEX IF NOT exists txn_date_idx ON txn(date);
 CREATE INDEX IF NOT EXISTS txn_description_idx ON txn(description);
+CREATE INDEX IF NOT EXISTS txn_merchant_idx ON txn(merchant_id);
+CREATE INDEX IF NOT EXISTS txn_source_date_idx ON txn(source, date);
+
+/* A table to store how far back each source's transactions can still change */
+CREATE TABLE IF NOT EXISTS watermark (
+   source          TEXT     PRIMARY KEY,  /* The source of the transactions */
+   oldest_pending  TEXT     DEFAULT NULL, /* The date of the oldest pending transaction in YYYY-MM-DD */
+   last_posted     TEXT     DEFAULT NULL  /* The date of the latest posted transaction in YYYY-MM-DD */
+);
 
 /* A table to store the categories */
 CREATE TABLE IF NOT EXISTS category (
@@ -59,11 +75,101 @@ CREATE INDEX IF NOT EXISTS allocation_txn_idx ON allocation(txn_id);
 CREATE INDEX IF NOT EXISTS allocation_category_idx ON allocation(category_id);
 CREATE INDEX IF NOT EXISTS allocation_location_idx ON allocation(location_id);
 
+/* Bump the description map version whenever the merchants or their allocations change */
+CREATE TRIGGER IF NOT EXISTS allocation_insert_version AFTER INSERT ON allocation BEGIN
+   INSERT INTO setting VALUES ('description_map_version', 1) ON CONFLICT DO UPDATE SET value = value + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS allocation_update_version AFTER UPDATE ON allocation BEGIN
+   INSERT INTO setting VALUES ('description_map_version', 1) ON CONFLICT DO UPDATE SET value = value + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS allocation_delete_version AFTER DELETE ON allocation BEGIN
+   INSERT INTO setting VALUES ('description_map_version', 1) ON CONFLICT DO UPDATE SET value = value + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS txn_merchant_version AFTER UPDATE OF merchant_id ON txn WHEN OLD.merchant_id IS NOT NEW.merchant_id BEGIN
+   INSERT INTO setting VALUES ('description_map_version', 1) ON CONFLICT DO UPDATE SET value = value + 1;
+END;
+
+/* A table to store the latest change to each transaction and allocation, so clients can fetch only what changed */
+CREATE TABLE IF NOT EXISTS change (
+   version         INTEGER  PRIMARY KEY AUTOINCREMENT,  /* Increases with every change, and is never reused */
+   table_name      TEXT     NOT NULL,     /* Either txn or allocation */
+   row_id          INTEGER  NOT NULL,     /* The id of the changed row */
+   deleted         BOOLEAN  NOT NULL,     /* Whether the row was deleted */
+   UNIQUE (table_name, row_id)
+);
+
+/* Record each change, replacing the earlier change to the same row */
+CREATE TRIGGER IF NOT EXISTS txn_insert_change AFTER INSERT ON txn BEGIN
+   INSERT OR REPLACE INTO change (table_name, row_id, deleted) VALUES ('txn', NEW.id, 0);
+END;
+CREATE TRIGGER IF NOT EXISTS txn_update_change AFTER UPDATE OF date, amount, description, source, balance, pending ON txn
+WHEN OLD.date IS NOT NEW.date OR OLD.amount IS NOT NEW.amount OR OLD.description IS NOT NEW.description OR
+     OLD.source IS NOT NEW.source OR OLD.balance IS NOT NEW.balance OR OLD.pending IS NOT NEW.pending BEGIN
+   INSERT OR REPLACE INTO change (table_name, row_id, deleted) VALUES ('txn', NEW.id, 0);
+   /* Allocations show the date, description, source and pending state of their transaction */
+   INSERT OR REPLACE INTO change (table_name, row_id, deleted) SELECT 'allocation', id, 0 FROM allocation WHERE txn_id = NEW.id;
+END;
+CREATE TRIGGER IF NOT EXISTS txn_delete_change AFTER DELETE ON txn BEGIN
+   INSERT OR REPLACE INTO change (table_name, row_id, deleted) VALUES ('txn', OLD.id, 1);
+END;
+CREATE TRIGGER IF NOT EXISTS allocation_insert_change AFTER INSERT ON allocation BEGIN
+   INSERT OR REPLACE INTO change (table_name, row_id, deleted) VALUES ('allocation', NEW.id, 0);
+END;
+CREATE TRIGGER IF NOT EXISTS allocation_update_change AFTER UPDATE ON allocation BEGIN
+   INSERT OR REPLACE INTO change (table_name, row_id, deleted) VALUES ('allocation', NEW.id, 0);
+END;
+CREATE TRIGGER IF NOT EXISTS allocation_delete_change AFTER DELETE ON allocation BEGIN
+   INSERT OR REPLACE INTO change (table_name, row_id, deleted) VALUES ('allocation', OLD.id, 1);
+END;
+
+/* A table to store the suggested category/location for transactions that weren't auto-categorised */
+CREATE TABLE IF NOT EXISTS suggestion (
+   txn_id          INTEGER  PRIMARY KEY REFERENCES txn(id) ON DELETE CASCADE ON UPDATE CASCADE,
+   category        TEXT     NOT NULL,     /* The best scoring category */
+   category_score  REAL     NOT NULL,     /* The score of the category (0 to 1) */
+   location        TEXT     NOT NULL,     /* The best scoring location */
+   location_score  REAL     NOT NULL      /* The score of the location (0 to 1) */
+);
+
 /* A table to store the push subscriptions */
 CREATE TABLE IF NOT EXISTS push_subscription (
    id              INTEGER  PRIMARY KEY,      /* A unique identifier for this table */
    value           TEXT     NOT NULL UNIQUE   /* The subscription data */
 );
 
+/* A table to store the scraper jobs */
+CREATE TABLE IF NOT EXISTS job (
+   id              INTEGER  PRIMARY KEY,     /* A unique identifier for this table */
+   reason          TEXT     NOT NULL,        /* What queued the job (ie. manual, schedule or cli) */
+   schedule_key    TEXT     UNIQUE,          /* The schedule and time of a scheduled job, so it is only queued once */
+   state           TEXT     NOT NULL,        /* One of queued, running or done */
+   pid             INTEGER  DEFAULT NULL,    /* The process running the job */
+   queued          REAL     NOT NULL,        /* The time the job was queued */
+   started         REAL     DEFAULT NULL,    /* The time the job started running */
+   finished        REAL     DEFAULT NULL,    /* The time the job finished */
+   inserted        INTEGER  DEFAULT NULL,    /* The number of new transactions found */
+   failed          INTEGER  DEFAULT NULL,    /* The number of scrapers that failed */
+   error           TEXT     DEFAULT NULL     /* Why the job failed */
+);
+CREATE INDEX IF NOT EXISTS job_state_idx ON job(state);
+
+/* A table to store each run of the ingest pipeline */
+CREATE TABLE IF NOT EXISTS metric_run (
+   id              INTEGER  PRIMARY KEY,     /* A unique identifier for this table */
+   job_id          INTEGER  DEFAULT NULL REFERENCES job(id) ON DELETE SET NULL,
+   started         REAL     NOT NULL,        /* The time the run started */
+   finished        REAL     NOT NULL         /* The time the run finished */
+);
+
+/* A table to store the stage timings and counters of each ingest run */
+CREATE TABLE IF NOT EXISTS metric (
+   run_id          INTEGER  NOT NULL REFERENCES metric_run(id) ON DELETE CASCADE,
+   source          TEXT     NOT NULL,        /* The source the metric is for, or empty for the whole run */
+   kind            TEXT     NOT NULL,        /* Either stage (a time in seconds) or count */
+   name            TEXT     NOT NULL,        /* The name of the stage or counter */
+   value           REAL     NOT NULL         /* The value of the metric */
+);
+CREATE INDEX IF NOT EXISTS metric_run_idx ON metric(run_id);
+
 /* Make sure foreign key constraints are enabled */
 PRAGMA foreign_keys = ON;
@@ -11,5 +11,5 @@ export DISPLAY=:0
 xset dpms force on
 BASEDIR=$(dirname "$0")
 cd ${BASEDIR}/..
-/usr/bin/python3 insert_transactions.py --log budget.log --config budget.json
+/usr/bin/python3 insert_transactions.py --log budget.log --config budget.json "$@"
 xset dpms force off
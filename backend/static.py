@@ -0,0 +1,209 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# static.py: This file serves the built frontend, using the compressed copies
+# of each file made at build time
+#
+
+# System imports
+import os
+import re
+import gzip
+import hashlib
+import threading
+from mimetypes import guess_type
+from typing import Dict, NamedTuple, Optional, Set
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import FileResponse, PlainTextResponse, Response
+from starlette.types import Receive, Scope, Send
+
+
+# The content codings of the compressed copies of a file, most preferred first
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+# Assets with a content hash in their name, eg. assets/index-4f0a9c2e.js, never
+# change, so clients can keep them for as long as they like
+HASHED_ASSET = re.compile(r'^assets/.+-[\w-]{8}\.\w+$')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# Everything else has to be checked with the server before each use
+REVALIDATE = 'no-cache'
+
+
+def accepted_encodings(header: str) -> Set[str]:
+    '''
+    Parse an Accept-Encoding header
+
+    Args:
+        header: The header value
+
+    Returns:
+        The content codings the client accepts
+    '''
+    accepted = set()
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    '''
+    Check an If-None-Match header against an entity tag, using the weak
+    comparison
+
+    Args:
+        header: The header value, if any
+        etag: The entity tag of the current content
+
+    Returns:
+        True if the client's copy is current
+    '''
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag.removeprefix('W/') in [tag.strip().removeprefix('W/') for tag in header.split(',')]
+
+
+class CachedIndex(NamedTuple):
+    mtime: float
+    etag: str
+    bodies: Dict[str, bytes]
+
+
+class StaticAssets:
+    '''
+    An ASGI app that serves the files of the built frontend. For each file it
+    sends the smallest copy the client accepts, out of the file and its .br and
+    .gz siblings. Ranges are served from the file itself. The index page is
+    kept in memory, and only read again when the file changes.
+    '''
+
+    def __init__(self, directory: str, index: str = 'index.html'):
+        self.directory = os.path.realpath(directory)
+        self.index_path = os.path.join(self.directory, index)
+        self.lock = threading.Lock()
+        self.index: Optional[CachedIndex] = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        assert scope['type'] == 'http'
+        request = Request(scope, receive)
+        response = await run_in_threadpool(self.get_response, request)
+        await response(scope, receive, send)
+
+    def get_response(self, request: Request) -> Response:
+        '''
+        Get the response for a request
+
+        Args:
+            request: The request
+
+        Returns:
+            The response
+        '''
+        if request.method not in ('GET', 'HEAD'):
+            return PlainTextResponse('Method Not Allowed', status_code=405, headers={'Allow': 'GET, HEAD'})
+
+        name = request.scope['path'][len(request.scope.get('root_path', '')):].lstrip('/')
+        path = os.path.realpath(os.path.join(self.directory, name))
+        if path == self.directory or path == self.index_path:
+            return self.index_response(request)
+        if not path.startswith(self.directory + os.sep) or not os.path.isfile(path):
+            return PlainTextResponse('Not Found', status_code=404)
+
+        cache_control = IMMUTABLE if HASHED_ASSET.match(name.replace(os.sep, '/')) else REVALIDATE
+        headers = {'Cache-Control': cache_control}
+        encodings = [coding for coding, suffix in ENCODINGS.items() if os.path.isfile(path + suffix)]
+        if encodings:
+            headers['Vary'] = 'Accept-Encoding'
+
+        # Ranges are only offered on the file itself, as the offsets of each
+        # compressed copy differ
+        file_path = path
+        if 'range' not in request.headers:
+            accepted = accepted_encodings(request.headers.get('accept-encoding', ''))
+            for coding in encodings:
+                if coding in accepted:
+                    file_path = path + ENCODINGS[coding]
+                    headers['Content-Encoding'] = coding
+                    headers['Accept-Ranges'] = 'none'
+                    break
+
+        response = FileResponse(file_path, headers=headers, media_type=guess_type(path)[0], stat_result=os.stat(file_path))
+        if etag_matches(request.headers.get('if-none-match'), response.headers['etag']):
+            return self.not_modified(response.headers['etag'], headers)
+        return response
+
+    def load_index(self) -> CachedIndex:
+        '''
+        Get the index page, reading it again if it has changed
+
+        Returns:
+            The index page in each encoding
+        '''
+        mtime = os.stat(self.index_path).st_mtime
+        with self.lock:
+            if self.index is None or self.index.mtime != mtime:
+                with open(self.index_path, 'rb') as fp:
+                    body = fp.read()
+                bodies = {'identity': body}
+                for coding, suffix in ENCODINGS.items():
+                    if os.path.isfile(self.index_path + suffix):
+                        with open(self.index_path + suffix, 'rb') as fp:
+                            bodies[coding] = fp.read()
+                bodies.setdefault('gzip', gzip.compress(body, mtime=0))
+                etag = hashlib.sha1(body).hexdigest()[:20]
+                self.index = CachedIndex(mtime=mtime, etag=etag, bodies=bodies)
+            return self.index
+
+    def index_response(self, request: Request) -> Response:
+        '''
+        Get the response for the index page, which is also sent for each page
+        of the app
+
+        Args:
+            request: The request
+
+        Returns:
+            The response
+        '''
+        if not os.path.isfile(self.index_path):
+            return PlainTextResponse('Not Found', status_code=404)
+        index = self.load_index()
+        accepted = accepted_encodings(request.headers.get('accept-encoding', ''))
+        coding = next((coding for coding in ENCODINGS if coding in accepted and coding in index.bodies), 'identity')
+
+        # Each encoding is a different representation, so it needs its own tag
+        etag = f'"{index.etag}"' if coding == 'identity' else f'"{index.etag}-{coding}"'
+        headers = {'Cache-Control': REVALIDATE, 'Vary': 'Accept-Encoding', 'ETag': etag}
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return self.not_modified(etag, headers)
+        if coding != 'identity':
+            headers['Content-Encoding'] = coding
+        return Response(index.bodies[coding], media_type='text/html', headers=headers)
+
+    def not_modified(self, etag: str, headers: Dict[str, str]) -> Response:
+        '''
+        Get a response telling the client its copy is current
+
+        Args:
+            etag: The entity tag of the current content
+            headers: The caching headers of the full response
+
+        Returns:
+            The response
+        '''
+        headers = {key: value for key, value in headers.items() if key in ('Cache-Control', 'Vary')}
+        return Response(status_code=304, headers={**headers, 'ETag': etag})
@@ -0,0 +1,142 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# static.test.py: This file contains the unit tests for serving the built
+# frontend
+#
+
+# System imports
+import os
+import gzip
+import tempfile
+import unittest
+from starlette.applications import Starlette
+from starlette.routing import Mount
+from starlette.testclient import TestClient
+
+# Local imports
+from static import StaticAssets, accepted_encodings, etag_matches, IMMUTABLE, REVALIDATE
+from compress_assets import compress_assets
+
+
+class TestStaticAssets(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dist = os.path.join(self.tmp.name, 'dist')
+        os.makedirs(os.path.join(self.dist, 'assets'))
+        self.script = b'console.log("budget");\n' * 100
+        self.write('index.html', b'<html><body>' + b'<div></div>' * 100 + b'</body></html>')
+        self.write('assets/index-4f0a9c2e.js', self.script)
+        self.write('manifest.json', b'{"name": "budget"}')
+        self.write('favicon.ico', b'\0' * 1000)
+        self.written = compress_assets(self.dist)
+        self.assets = StaticAssets(self.dist)
+        self.client = TestClient(Starlette(routes=[Mount('/', self.assets)]))
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+        return super().tearDown()
+
+    def write(self, name: str, data: bytes) -> None:
+        with open(os.path.join(self.dist, name), 'wb') as fp:
+            fp.write(data)
+
+    def get(self, url: str, **headers: str):
+        # Ask for the body as it was sent, rather than decoded
+        return self.client.get(url, headers={'Accept-Encoding': 'identity', **headers})
+
+    def test_compress_assets(self) -> None:
+        compressed = {os.path.relpath(path, self.dist) for path, _, copies in self.written if copies}
+        self.assertEqual(compressed, {'index.html', 'assets/index-4f0a9c2e.js', 'favicon.ico'})
+        with open(os.path.join(self.dist, 'assets/index-4f0a9c2e.js.gz'), 'rb') as fp:
+            self.assertEqual(gzip.decompress(fp.read()), self.script)
+        self.assertFalse(os.path.exists(os.path.join(self.dist, 'manifest.json.gz')))
+
+    def test_precompressed(self) -> None:
+        resp = self.client.get('/assets/index-4f0a9c2e.js', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['content-encoding'], 'gzip')
+        self.assertEqual(resp.headers['vary'], 'Accept-Encoding')
+        self.assertEqual(resp.headers['cache-control'], IMMUTABLE)
+        self.assertTrue(resp.headers['content-type'].startswith('text/javascript'))
+        self.assertLess(int(resp.headers['content-length']), len(self.script))
+        self.assertEqual(resp.content, self.script)
+
+        # Without support for gzip, the file is sent as it is
+        resp = self.get('/assets/index-4f0a9c2e.js', **{'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('content-encoding', resp.headers)
+        self.assertEqual(resp.content, self.script)
+
+        # Files without a hash have to be checked each time
+        resp = self.get('/manifest.json')
+        self.assertEqual(resp.headers['cache-control'], REVALIDATE)
+        self.assertNotIn('vary', resp.headers)
+
+    def test_brotli(self) -> None:
+        self.write('assets/index-4f0a9c2e.js.br', b'brotli')
+        resp = self.get('/assets/index-4f0a9c2e.js', **{'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(resp.headers['content-encoding'], 'br')
+        self.assertEqual(resp.content, b'brotli')
+
+    def test_not_modified(self) -> None:
+        resp = self.client.get('/assets/index-4f0a9c2e.js', headers={'Accept-Encoding': 'gzip'})
+        etag = resp.headers['etag']
+        resp = self.client.get('/assets/index-4f0a9c2e.js', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers['etag'], etag)
+        self.assertEqual(resp.headers['cache-control'], IMMUTABLE)
+        self.assertEqual(resp.content, b'')
+
+        # The uncompressed file is a different representation
+        resp = self.get('/assets/index-4f0a9c2e.js', **{'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_range(self) -> None:
+        resp = self.client.get('/assets/index-4f0a9c2e.js', headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=0-9'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertNotIn('content-encoding', resp.headers)
+        self.assertEqual(resp.headers['content-range'], f'bytes 0-9/{len(self.script)}')
+        self.assertEqual(resp.content, self.script[:10])
+
+        resp = self.get('/assets/index-4f0a9c2e.js', Range=f'bytes={len(self.script)}-')
+        self.assertEqual(resp.status_code, 416)
+
+    def test_index(self) -> None:
+        for url in ['/', '/index.html']:
+            resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['content-encoding'], 'gzip')
+            self.assertEqual(resp.headers['cache-control'], REVALIDATE)
+            self.assertTrue(resp.content.startswith(b'<html>'))
+        etag = resp.headers['etag']
+
+        resp = self.client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': f'W/{etag}'})
+        self.assertEqual(resp.status_code, 304)
+
+        # The page is read again when it changes
+        self.write('index.html', b'<html>new</html>')
+        os.utime(os.path.join(self.dist, 'index.html'), (0, 0))
+        resp = self.get('/', **{'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, b'<html>new</html>')
+
+    def test_missing(self) -> None:
+        self.assertEqual(self.get('/missing.js').status_code, 404)
+        self.assertEqual(self.get('/assets').status_code, 404)
+        self.write('../secret.txt', b'secret')
+        self.assertEqual(self.get('/%2e%2e/secret.txt').status_code, 404)
+        self.assertEqual(self.client.post('/manifest.json').status_code, 405)
+
+    def test_parse_headers(self) -> None:
+        self.assertEqual(accepted_encodings('gzip, deflate, br;q=0.5, zstd;q=0, *;q=bad'), {'gzip', 'deflate', 'br'})
+        self.assertEqual(accepted_encodings(''), set())
+        self.assertTrue(etag_matches('"a", W/"b"', '"b"'))
+        self.assertTrue(etag_matches('*', '"b"'))
+        self.assertFalse(etag_matches('"a"', '"b"'))
+        self.assertFalse(etag_matches(None, '"b"'))
+
+
+unittest.main()
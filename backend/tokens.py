@@ -0,0 +1,240 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# tokens.py: This file stores the refresh tokens that are in use
+#
+
+# System imports
+import time
+import atexit
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, Optional
+
+# Local imports
+from database import Database
+from model import CachedToken
+
+
+class TokenStore(ABC):
+    '''
+    Stores the refresh tokens that are in use, so each can only be used once
+    '''
+
+    @abstractmethod
+    def add(self, token: CachedToken) -> None:
+        '''
+        Add a token
+
+        Args:
+            token: The token
+        '''
+
+    @abstractmethod
+    def get(self, value: str) -> Optional[CachedToken]:
+        '''
+        Get a token, if it exists and hasn't expired
+
+        Args:
+            value: The token value
+
+        Returns:
+            The token, or None
+        '''
+
+    @abstractmethod
+    def remove(self, value: str) -> None:
+        '''
+        Remove a token
+
+        Args:
+            value: The token value
+        '''
+
+    def load(self) -> None:
+        '''
+        Prepare the store for use
+        '''
+
+    def stop(self) -> None:
+        '''
+        Finish any outstanding work
+        '''
+
+
+class DatabaseTokenStore(TokenStore):
+    '''
+    Stores tokens directly in the token table
+    '''
+
+    def add(self, token: CachedToken) -> None:
+        with Database() as db:
+            db.add_cached_token(token)
+
+    def get(self, value: str) -> Optional[CachedToken]:
+        with Database() as db:
+            return db.get_cached_token(value)
+
+    def remove(self, value: str) -> None:
+        with Database() as db:
+            db.clear_cached_token(value)
+
+
+class MemoryTokenStore(TokenStore):
+    '''
+    Keeps tokens in memory, which is authoritative for reads. Changes are
+    written to the token table in batches by a background thread, and the
+    tokens are loaded from it again on the first use after a restart. Tokens
+    issued just before a crash may be lost, in which case their users have to
+    log in again.
+
+    Each process has its own copy. A token missing from memory is looked for in
+    the table too, so tokens issued by another API worker still work, but a
+    token used in one worker can be used again in another that loaded it
+    before. Use the database store when running several workers.
+    '''
+
+    def __init__(self, flush_interval: float = 1.0, batch_size: int = 256):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.tokens: Dict[str, int] = {}
+        self.loaded = False
+
+        # The changes that haven't been written yet, with None for a removal,
+        # and the batch that is being written. Both hide the table's copy of a
+        # removed token until the removal has committed.
+        self.pending: Dict[str, Optional[int]] = {}
+        self.flushing: Dict[str, Optional[int]] = {}
+        self.flush_lock = threading.Lock()
+        self.removals = 0
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        atexit.register(self.stop)
+
+    def load(self) -> None:
+        '''
+        Load the tokens from the database, and start writing changes back
+        '''
+        with self.lock:
+            if self.loaded:
+                return
+            with Database() as db:
+                self.tokens = {token.value: token.expire for token in db.get_cached_tokens()}
+            self.loaded = True
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name='token-store', daemon=True)
+            self.thread.start()
+
+    def add(self, token: CachedToken) -> None:
+        self.load()
+        with self.lock:
+            self.tokens[token.value] = token.expire
+            self.pending[token.value] = token.expire
+            if len(self.pending) >= self.batch_size:
+                self.wake.set()
+
+    def get(self, value: str) -> Optional[CachedToken]:
+        self.load()
+        with self.lock:
+            expire = self.tokens.get(value)
+            if expire is not None:
+                if expire > time.time():
+                    return CachedToken(value=value, expire=expire)
+                del self.tokens[value]
+                return None
+            if value in self.pending or value in self.flushing:
+                # Removed, but not written yet
+                return None
+            removals = self.removals
+
+        # Issued by another process since this one loaded. It is only cached if
+        # nothing was removed meanwhile, as the read may predate the removal.
+        with Database() as db:
+            token = db.get_cached_token(value)
+        if token is not None:
+            with self.lock:
+                if self.removals == removals:
+                    self.tokens[value] = token.expire
+        return token
+
+    def remove(self, value: str) -> None:
+        self.load()
+        with self.lock:
+            self.tokens.pop(value, None)
+            self.pending[value] = None
+            self.removals += 1
+            if len(self.pending) >= self.batch_size:
+                self.wake.set()
+
+    def flush(self) -> None:
+        '''
+        Write the outstanding changes to the database
+        '''
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.flushing = pending
+            if not pending:
+                return
+
+            added = [CachedToken(value=value, expire=expire) for value, expire in pending.items() if expire is not None]
+            removed = [value for value, expire in pending.items() if expire is None]
+            try:
+                with Database() as db:
+                    db.update_cached_tokens(added, removed)
+            except Exception:
+                # Keep the changes for the next attempt, unless they've been superseded
+                with self.lock:
+                    self.pending = pending | self.pending
+                raise
+            finally:
+                with self.lock:
+                    self.flushing = {}
+
+    def run(self) -> None:
+        '''
+        The background thread, which writes changes every interval, or sooner
+        if a batch fills up
+        '''
+        while not self.stopped.is_set():
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as exc:
+                logging.exception('Cannot save refresh tokens: %s', exc)
+
+    def stop(self) -> None:
+        with self.lock:
+            thread, self.thread = self.thread, None
+            self.loaded = False
+        self.stopped.set()
+        self.wake.set()
+        if thread:
+            thread.join()
+        self.flush()
+
+
+def create_token_store(config: Dict) -> TokenStore:
+    '''
+    Create the token store chosen in the config. The database store is the
+    default, as it is the only one that keeps refresh tokens single use across
+    several API workers.
+
+    Args:
+        config: Configuration data
+
+    Returns:
+        The token store
+    '''
+    kind = config.get('token_store', 'database')
+    if kind == 'memory':
+        return MemoryTokenStore(config.get('token_flush_interval', 1.0))
+    if kind == 'database':
+        return DatabaseTokenStore()
+    raise ValueError(f'Invalid token store \'{kind}\'')
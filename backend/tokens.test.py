@@ -0,0 +1,179 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 Josef Barnes
+#
+# tokens.test.py: This file contains the unit tests for the refresh token stores
+#
+
+# System imports
+import time
+import threading
+import unittest
+from unittest.mock import patch
+
+# Local imports
+from database import Database
+from model import CachedToken
+from tokens import DatabaseTokenStore, MemoryTokenStore, create_token_store
+
+
+class TestMemoryTokenStore(unittest.TestCase):
+    def setUp(self) -> None:
+        with Database() as db:
+            db.db.execute('DELETE FROM token')
+        self.store = MemoryTokenStore(flush_interval=60)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.store.stop()
+        return super().tearDown()
+
+    def db_tokens(self) -> set:
+        with Database() as db:
+            return {token.value for token in db.get_cached_tokens()}
+
+    def test_write_behind(self) -> None:
+        expire = int(time.time()) + 60
+        self.store.add(CachedToken(value='a', expire=expire))
+        self.store.add(CachedToken(value='b', expire=expire))
+        self.store.remove('a')
+
+        # Reads come from memory, before anything is written
+        with patch('tokens.Database', side_effect=AssertionError('Database used')):
+            self.assertEqual(self.store.get('b'), CachedToken(value='b', expire=expire))
+            self.assertIsNone(self.store.get('a'))
+        self.assertEqual(self.db_tokens(), set())
+
+        self.store.flush()
+        self.assertEqual(self.db_tokens(), {'b'})
+
+    def test_batches(self) -> None:
+        store = MemoryTokenStore(flush_interval=60, batch_size=10)
+        try:
+            for i in range(10):
+                store.add(CachedToken(value=str(i), expire=int(time.time()) + 60))
+            for _ in range(100):
+                if len(self.db_tokens()) == 10:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(len(self.db_tokens()), 10)
+        finally:
+            store.stop()
+
+    def test_recover(self) -> None:
+        self.store.add(CachedToken(value='kept', expire=int(time.time()) + 60))
+        self.store.add(CachedToken(value='used', expire=int(time.time()) + 60))
+        self.store.add(CachedToken(value='expired', expire=int(time.time()) - 1))
+        self.store.remove('used')
+        self.store.stop()
+
+        store = MemoryTokenStore(flush_interval=60)
+        try:
+            store.load()
+            self.assertEqual(set(store.tokens), {'kept'})
+            self.assertIsNotNone(store.get('kept'))
+            self.assertIsNone(store.get('used'))
+            self.assertIsNone(store.get('expired'))
+        finally:
+            store.stop()
+
+    def test_other_process(self) -> None:
+        self.store.load()
+        with Database() as db:
+            db.add_cached_token(CachedToken(value='other', expire=int(time.time()) + 60))
+        self.assertIsNotNone(self.store.get('other'))
+
+        # A removal that hasn't been written yet hides the table's copy
+        self.store.remove('other')
+        self.assertIsNone(self.store.get('other'))
+        self.assertEqual(self.db_tokens(), {'other'})
+
+    def test_expired(self) -> None:
+        self.store.add(CachedToken(value='a', expire=int(time.time()) - 1))
+        self.assertIsNone(self.store.get('a'))
+        self.assertNotIn('a', self.store.tokens)
+
+    def test_failed_write_is_retried(self) -> None:
+        self.store.add(CachedToken(value='a', expire=int(time.time()) + 60))
+        with patch.object(Database, 'update_cached_tokens', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                self.store.flush()
+        self.store.remove('a')
+        self.assertEqual(self.store.pending, {'a': None})
+        self.store.flush()
+        self.assertEqual(self.db_tokens(), set())
+
+    def test_remove_during_flush(self) -> None:
+        expire = int(time.time()) + 60
+        self.store.add(CachedToken(value='a', expire=expire))
+        self.store.add(CachedToken(value='b', expire=expire))
+        self.store.flush()
+
+        # Hold the next write open until the removals have been checked
+        writing = threading.Event()
+        release = threading.Event()
+        update_cached_tokens = Database.update_cached_tokens
+
+        def slow_update(db, added, removed):
+            writing.set()
+            release.wait(5)
+            update_cached_tokens(db, added, removed)
+
+        self.store.remove('a')
+        with patch.object(Database, 'update_cached_tokens', slow_update):
+            flush = threading.Thread(target=self.store.flush)
+            flush.start()
+            try:
+                self.assertTrue(writing.wait(5))
+                self.store.remove('b')
+                self.assertEqual(self.db_tokens(), {'a', 'b'})
+                self.assertIsNone(self.store.get('a'))
+                self.assertIsNone(self.store.get('b'))
+            finally:
+                release.set()
+                flush.join()
+        self.assertNotIn('a', self.store.tokens)
+        self.assertNotIn('b', self.store.tokens)
+        self.assertIsNone(self.store.get('a'))
+        self.store.flush()
+        self.assertEqual(self.db_tokens(), set())
+
+    def test_removal_while_reading_table(self) -> None:
+        self.store.load()
+        with Database() as db:
+            db.add_cached_token(CachedToken(value='other', expire=int(time.time()) + 60))
+
+        # The token is removed, and the removal written, after the table was
+        # read, so it isn't cached
+        get_cached_token = Database.get_cached_token
+
+        def racing_get(db, value):
+            token = get_cached_token(db, value)
+            self.store.remove(value)
+            self.store.pending.clear()
+            return token
+
+        with patch.object(Database, 'get_cached_token', racing_get):
+            self.assertIsNotNone(self.store.get('other'))
+        self.assertNotIn('other', self.store.tokens)
+
+
+class TestDatabaseTokenStore(unittest.TestCase):
+    def test_store(self) -> None:
+        store = DatabaseTokenStore()
+        store.add(CachedToken(value='db', expire=int(time.time()) + 60))
+        self.assertIsNotNone(store.get('db'))
+        store.remove('db')
+        self.assertIsNone(store.get('db'))
+
+    def test_create(self) -> None:
+        self.assertIsInstance(create_token_store({}), DatabaseTokenStore)
+        memory = create_token_store({'token_store': 'memory'})
+        self.assertIsInstance(memory, MemoryTokenStore)
+        memory.stop()
+        with self.assertRaises(ValueError):
+            create_token_store({'token_store': 'redis'})
+
+
+unittest.main()